@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+import random
+from dataclasses import dataclass
+from enum import IntEnum, auto
+from typing import Optional
+
+from utils import create_logger
+
+backoff_logger = create_logger(logger_name="karma_bot")
+
+
+class CircuitState(IntEnum):
+    CLOSED = auto()
+    OPEN = auto()
+    HALF_OPEN = auto()
+
+
+@dataclass(frozen=True)
+class BackoffPolicy:
+    """Jittered exponential delay between retries.
+
+    The n-th consecutive failure waits ``base_delay * multiplier ** n`` seconds, capped at ``max_delay`` and randomly spread by ``jitter`` (a fraction of
+    the delay) so that retries of different clients don't line up.
+
+    """
+
+    base_delay: float = 5
+    max_delay: float = 330
+    multiplier: float = 2
+    jitter: float = 0.2
+
+    def delay(self, attempt: int) -> float:
+        """Returns the number of seconds to wait before the retry.
+
+        :param attempt: Number of consecutive failures before this one, starting at 0.
+
+        :returns: Delay in seconds.
+
+        """
+        delay = min(self.max_delay, self.base_delay * self.multiplier**attempt)
+        return min(self.max_delay, delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class Backoff:
+    """Tracks consecutive failures of a task and waits between its retries without blocking the event loop.
+
+    The backoff also acts as a circuit breaker that other parts of the bot can query. The circuit is closed while the task works. After ``failure_threshold``
+    consecutive failures it opens, and it stays open while the task is cooling down. Once the cooldown is over, the circuit is half-open until the retry
+    either succeeds, which closes the circuit and resets the delay, or fails, which opens it again.
+
+    """
+
+    def __init__(self, default: BackoffPolicy, policies: Optional[dict[type[BaseException], BackoffPolicy]] = None, failure_threshold: int = 3) -> None:
+        """Creates the backoff with a closed circuit.
+
+        :param default: Policy for exceptions that don't have a policy of their own.
+        :param policies: Policies per exception class. Subclasses of a listed exception use its policy unless they are listed themselves.
+        :param failure_threshold: Number of consecutive failures after which the circuit opens.
+
+        """
+        self.default = default
+        self.policies = {} if policies is None else policies
+        self.failure_threshold = failure_threshold
+        self.failures = 0
+        self.state = CircuitState.CLOSED
+
+    @property
+    def is_open(self) -> bool:
+        """True while the task is failing and cooling down."""
+        return self.state == CircuitState.OPEN
+
+    def policy_for(self, exc: BaseException) -> BackoffPolicy:
+        """Returns the policy of the most specific exception class the exception is an instance of.
+
+        :param exc: The exception raised by the task.
+
+        :returns: The policy used for the exception.
+
+        """
+        for exc_class in type(exc).__mro__:
+            if exc_class in self.policies:
+                return self.policies[exc_class]
+        return self.default
+
+    def record_success(self) -> None:
+        """Resets the delay and closes the circuit after the task has worked.
+
+        :returns: None
+
+        """
+        if self.state != CircuitState.CLOSED:
+            backoff_logger.info(f"Recovered after {self.failures} consecutive failures. Circuit closed.")
+        self.failures = 0
+        self.state = CircuitState.CLOSED
+
+    async def wait_after_failure(self, exc: BaseException) -> float:
+        """Records the failure and sleeps for the delay of the exception's policy.
+
+        :param exc: The exception raised by the task.
+
+        :returns: The number of seconds waited.
+
+        """
+        delay = self.policy_for(exc).delay(self.failures)
+        self.failures += 1
+        if self.failures >= self.failure_threshold or self.state == CircuitState.HALF_OPEN:
+            self.state = CircuitState.OPEN
+        backoff_logger.info(f"Cooldown: {delay:.1f} seconds after {self.failures} consecutive failures, circuit {self.state.name}")
+
+        await asyncio.sleep(delay)
+        if self.state == CircuitState.OPEN:
+            self.state = CircuitState.HALF_OPEN
+        return delay
@@ -0,0 +1 @@
+"""Offline benchmarks of the bot. Run them from the repository root, e.g., ``python -m benchmarks.command_throughput``."""
@@ -0,0 +1,136 @@
+#!.venv/bin/python
+"""Compares parse_command with the three sequential regex searches it replaced, over a corpus of trading subreddit comments.
+
+The corpus is synthetic unless --corpus points to a JSONL comment dump, e.g., the one read by replay.py. Both matchers must agree on every body.
+
+Run from the repository root: ``python -m benchmarks.command_parser --comments 100000``
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import random
+import re
+import sys
+import time
+from itertools import islice
+from typing import Callable, Optional
+
+from command_parser import CLOSE, KARMA_MINUS, KARMA_PLUS, Command, parse_command
+
+LEGACY_KARMA_PP = re.compile(r"^(\++KARMA|KARMA\++)", re.IGNORECASE)
+LEGACY_KARMA_MM = re.compile(r"^(-+KARMA|KARMA-+)", re.IGNORECASE)
+LEGACY_CLOSE = re.compile(r"^(!CLOSE|CLOSE!)", re.IGNORECASE)
+
+ITEMS = ("Bloodied Explosive Handmade", "Two Shot Explosive Fixer", "Quad Tesla", "Unyielding Secret Service armor", "Leaders", "Bobby pins", "Ultracite ammo")
+
+CHATTER = (
+    "Interested! Sent you a chat.",
+    "What platform?",
+    "Would you take {price} caps for the {item}?",
+    "Sent you a friend request, my gamertag is {name}.",
+    "H: {item}\n\nW: {price} caps or {item}",
+    "Price check on the {item}? Seen it go for anywhere between {price} and {price} caps.",
+    "Thanks for the trade!",
+    "Still available? I can hop on in 10 minutes.",
+    "> {item} for {price}?\n\nYes, still have it.",
+    "Karma is given with +karma, see the wiki.",
+    "close to {price} caps would work",
+    "-1 from me, lowball",
+    "!remindme 2 hours",
+)
+
+COMMANDS = (
+    "+karma",
+    "+Karma thanks for the smooth trade",
+    "\\+karma",
+    "  +karma",
+    "karma+",
+    "++karma",
+    "-karma",
+    "karma-",
+    "!close",
+    "Close!",
+    "!CLOSE trade done",
+)
+
+
+def synthetic_corpus(comments: int, command_ratio: float, seed: int) -> list[str]:
+    """Generates comment bodies with the mix of chatter and commands of the subreddit.
+
+    :param comments: Number of bodies.
+    :param command_ratio: Fraction of the bodies starting with a command.
+    :param seed: Seed of the random generator.
+
+    :returns: The bodies.
+
+    """
+    rng = random.Random(seed)
+    bodies: list[str] = []
+    for _ in range(comments):
+        if rng.random() < command_ratio:
+            bodies.append(rng.choice(COMMANDS))
+        else:
+            template = rng.choice(CHATTER)
+            bodies.append(template.format(item=rng.choice(ITEMS), price=rng.randrange(100, 40000, 100), name=f"Vault{rng.randrange(1, 999)}Dweller"))
+    return bodies
+
+
+def dump_corpus(path: str, comments: int) -> list[str]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as dump:
+        return [str(json.loads(line).get("body") or "") for line in islice(dump, comments) if line.strip()]
+
+
+def legacy_parse(body: str) -> Optional[Command]:
+    comment_body = body.strip().replace("\\", "")
+    if LEGACY_KARMA_PP.search(comment_body):
+        return KARMA_PLUS
+    elif LEGACY_KARMA_MM.search(comment_body):
+        return KARMA_MINUS
+    elif LEGACY_CLOSE.search(comment_body):
+        return CLOSE
+    return None
+
+
+def best_time(parse: Callable[[str], Optional[Command]], bodies: list[str], repeat: int) -> float:
+    """Returns the fastest of repeat passes over the bodies, in seconds."""
+    timings: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            parse(body)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--comments", type=int, default=100_000, help="number of comment bodies")
+    parser.add_argument("--command-ratio", type=float, default=0.05, help="fraction of synthetic bodies starting with a command")
+    parser.add_argument("--corpus", help="JSONL comment dump to read the bodies from instead of generating them")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed passes; the fastest is reported")
+    parser.add_argument("--seed", type=int, default=76, help="seed of the synthetic corpus")
+    args = parser.parse_args()
+
+    bodies = dump_corpus(args.corpus, args.comments) if args.corpus else synthetic_corpus(args.comments, args.command_ratio, args.seed)
+    mismatches = [body for body in bodies if legacy_parse(body) != parse_command(body)]
+    for body in mismatches[:10]:
+        print(f"Mismatch: {body[:80]!r} legacy={legacy_parse(body)} parse_command={parse_command(body)}")
+
+    commands = sum(parse_command(body) is not None for body in bodies)
+    mean_length = sum(map(len, bodies)) / max(len(bodies), 1)
+    print(f"Bodies: {len(bodies)}, commands: {commands}, mean length: {mean_length:.0f} characters, mismatches: {len(mismatches)}")
+    legacy = best_time(legacy_parse, bodies, args.repeat)
+    combined = best_time(parse_command, bodies, args.repeat)
+    for name, elapsed in (("three regex searches", legacy), ("parse_command", combined)):
+        print(f"  {name:<24} {elapsed * 1e9 / max(len(bodies), 1):>8.0f} ns/comment {len(bodies) / elapsed:>12.0f} comments/s")
+    print(f"Speedup: {legacy / combined:.2f}x")
+    return int(bool(mismatches))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
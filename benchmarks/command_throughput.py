@@ -0,0 +1,211 @@
+#!.venv/bin/python
+"""Replays a synthetic comment stream through read_comments against a fake Reddit and an in-memory MongoDB, and reports the command throughput, latency
+and API calls per command.
+
+Run from the repository root: ``python -m benchmarks.command_throughput --trades 500 --api-latency 150``
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import inspect
+import logging
+import random
+import statistics
+import sys
+import time
+from typing import Any, Callable, Coroutine, Iterator, cast
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from benchmarks.fake_mongo import InMemoryDatabase
+from benchmarks.fake_reddit import BOT_NAME, FakeReddit, FakeRedditWorld
+from command_dispatcher import CommandDispatcher
+from comment_ledger import ProcessedCommentLedger
+from db_operations import ensure_indexes, karma_log_buffer, profile_cache, save_stream_checkpoint
+from flair_functions import flair_writer
+from inbox import InboxReadMarker, read_inbox
+from main import read_comments
+from metrics import close_check_outcomes_total, command_stage_seconds, karma_check_outcomes_total
+from request_scheduler import request_scheduler
+from stream_checkpoint import StreamCheckpoint
+
+FLAIRS = ("XBOX", "PlayStation", "PC")
+
+
+def trade(world: FakeRedditWorld, rng: random.Random, traders: list[str], repeat_ratio: float, close_ratio: float) -> Iterator[None]:
+    """Adds the comments of one trade, yielding between them so that trades can be interleaved.
+
+    The buyer answers the submission, the seller answers the buyer, and the buyer gives karma to the seller's comment. Some buyers give karma twice and
+    some sellers close the submission afterwards.
+
+    """
+    seller, buyer = rng.sample(traders, 2)
+    submission = world.add_submission(seller, flair=rng.choice(FLAIRS))
+    offer = world.add_comment(submission, buyer, "Interested! Sent you a chat.")
+    yield
+    answer = world.add_comment(offer, seller, "Thanks for the trade!")
+    yield
+    world.add_comment(answer, buyer, "+karma", is_command=True)
+    if rng.random() < repeat_ratio:
+        yield
+        world.add_comment(answer, buyer, "+karma thanks again", is_command=True)
+    if rng.random() < close_ratio:
+        yield
+        world.add_comment(submission, seller, "!close", is_command=True)
+
+
+def build_stream(world: FakeRedditWorld, args: argparse.Namespace) -> None:
+    """Adds the interleaved comments of the trades and the unrelated chatter to the world.
+
+    :param world: The fake subreddit.
+    :param args: The parsed command line arguments.
+
+    :returns: None
+
+    """
+    rng = random.Random(args.seed)
+    traders = [f"Trader_{index}" for index in range(args.traders)]
+    chatter_submission = world.add_submission("Trader_chatter", flair="Discussion")
+    trades = [trade(world, rng, traders, args.repeat_ratio, args.close_ratio) for _ in range(args.trades)]
+    while trades:
+        current = rng.randrange(len(trades))
+        try:
+            next(trades[current])
+        except StopIteration:
+            trades.pop(current)
+        while rng.random() < args.chatter_ratio:
+            world.add_comment(chatter_submission, rng.choice(traders), "Price check please")
+    # Karma adjustments of the moderators, sent by mentioning the bot
+    for _ in range(args.mentions):
+        world.add_mention(chatter_submission, rng.choice(world.moderators), f"u/{BOT_NAME} !karma u/{rng.choice(traders)} +2")
+
+
+def percentile(values: list[float], percent: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[percent - 1]
+
+
+def print_table(title: str, rows: dict[str, float], commands: int, per_command: bool = True) -> None:
+    print(f"\n{title}")
+    for name, value in sorted(rows.items(), key=lambda row: -row[1]):
+        print(f"  {name:<64} {value:>8.0f}" + (f" {value / commands:>8.2f}/command" if per_command else ""))
+
+
+async def run(args: argparse.Namespace) -> int:
+    """Runs the benchmark and prints the report.
+
+    :param args: The parsed command line arguments.
+
+    :returns: 0 if every command was answered before the timeout, otherwise 1.
+
+    """
+    world = FakeRedditWorld(latency=args.api_latency / 1000, jitter=args.jitter, rate_limit=args.rate_limit)
+    checkpoint_comment = world.add_comment(world.add_submission("Trader_seed"), "Trader_seed", "Checkpoint")
+    build_stream(world, args)
+    database = InMemoryDatabase(latency=args.db_latency / 1000)
+    karma_db = cast(AsyncIOMotorDatabase, database)
+    # Without the exception wrapper, so that errors in the stream readers end the benchmark instead of being retried
+    stream_reader: Callable[..., Coroutine[Any, Any, None]] = inspect.unwrap(read_comments)
+    inbox_reader: Callable[..., Coroutine[Any, Any, None]] = inspect.unwrap(read_inbox)
+
+    async with (
+        FakeReddit(world) as reddit,
+        flair_writer,
+        karma_log_buffer,
+        profile_cache.watching(karma_db),
+        CommandDispatcher(concurrency=args.workers, queue_size=args.queue_size) as dispatcher,
+        CommandDispatcher(concurrency=2) as inbox_dispatcher,
+        InboxReadMarker(reddit) as read_marker,
+    ):
+        request_scheduler.attach(reddit)
+        await ensure_indexes(karma_db)
+        await save_stream_checkpoint(StreamCheckpoint.STREAM_NAME, checkpoint_comment.fullname, 0, karma_db)
+        checkpoint = StreamCheckpoint(karma_db)
+        await checkpoint.load()
+        database.round_trips.clear()
+        world.api_calls.clear()
+
+        start = asyncio.get_running_loop().time()
+        world.publish(start, args.arrival_rate)
+        ledger = ProcessedCommentLedger(karma_db)
+        readers = (
+            asyncio.create_task(stream_reader(reddit, karma_db, dispatcher, checkpoint, ledger), name="comments"),
+            asyncio.create_task(inbox_reader(reddit, karma_db, inbox_dispatcher, ledger, read_marker), name="inbox"),
+        )
+        all_answered = asyncio.create_task(world.all_answered.wait())
+        await asyncio.wait((*readers, all_answered), timeout=args.timeout, return_when=asyncio.FIRST_COMPLETED)
+        all_answered.cancel()
+        elapsed = asyncio.get_running_loop().time() - start
+        for reader in readers:
+            reader.cancel()
+        for reader, reader_result in zip(readers, await asyncio.gather(*readers, return_exceptions=True)):
+            if isinstance(reader_result, Exception):
+                print(f"The {reader.get_name()} reader failed: {reader_result!r}")
+    # The flair writer, the karma log buffer and the inbox read marker have been flushed, so their calls are part of the counts
+
+    commands = world.commands
+    answered = len(world.command_latencies)
+    latencies = sorted(world.command_latencies)
+    print(f"Comments: {len(world.stream)}, commands: {commands}, answered: {answered}")
+    print(f"Workers: {args.workers}, API latency: {args.api_latency} ms, DB latency: {args.db_latency} ms, arrival rate: {args.arrival_rate or 'backlog'}")
+    print(f"Elapsed: {elapsed:.2f} s, throughput: {answered / elapsed:.2f} commands/s")
+    print(f"Command latency: p50 {percentile(latencies, 50):.3f} s, p99 {percentile(latencies, 99):.3f} s, max {max(latencies, default=0):.3f} s")
+
+    polls = {endpoint: calls for endpoint, calls in world.api_calls.items() if endpoint.endswith("/comments")}
+    command_calls = {endpoint: calls for endpoint, calls in world.api_calls.items() if endpoint not in polls}
+    print(f"API calls per command: {sum(command_calls.values()) / max(commands, 1):.2f}, plus {sum(polls.values())} listing requests of the stream")
+    print_table("API calls", dict(command_calls), commands)
+    print_table("MongoDB round-trips", dict(database.round_trips), commands)
+
+    outcomes: dict[str, float] = {}
+    for metric in (karma_check_outcomes_total, close_check_outcomes_total):
+        for _, (outcome,), value in metric.samples():
+            outcomes[outcome] = value
+    print_table("Check outcomes", outcomes, commands, per_command=False)
+
+    stage_sums: dict[str, float] = {}
+    stage_counts: dict[str, float] = {}
+    for suffix, label_values, value in command_stage_seconds.samples():
+        if suffix == "_sum":
+            stage_sums[label_values[0]] = value
+        elif suffix == "_count":
+            stage_counts[label_values[0]] = value
+    print("\nMean stage time")
+    for stage, total in stage_sums.items():
+        print(f"  {stage:<64} {total / stage_counts[stage] * 1000:>8.1f} ms over {stage_counts[stage]:.0f}")
+    return int(answered < commands)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trades", type=int, default=200, help="number of trades, each with one or more commands")
+    parser.add_argument("--traders", type=int, default=100, help="number of distinct users trading")
+    parser.add_argument("--repeat-ratio", type=float, default=0.1, help="fraction of buyers giving karma twice")
+    parser.add_argument("--close-ratio", type=float, default=0.3, help="fraction of sellers closing their submission")
+    parser.add_argument("--chatter-ratio", type=float, default=0.5, help="chance of an unrelated comment after every trade comment")
+    parser.add_argument("--mentions", type=int, default=5, help="number of karma adjustments sent by moderators mentioning the bot")
+    parser.add_argument("--arrival-rate", type=float, default=0, help="comments per second; 0 replays the stream as a backlog")
+    parser.add_argument("--api-latency", type=float, default=150, help="Reddit API latency in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="random spread of the API latency as a fraction")
+    parser.add_argument("--db-latency", type=float, default=5, help="MongoDB round-trip latency in milliseconds")
+    parser.add_argument("--rate-limit", type=int, help="simulate a budget of Reddit API requests per 10 minute window, e.g., 1000 like reddit.com")
+    parser.add_argument("--workers", type=int, default=8, help="command dispatcher workers")
+    parser.add_argument("--queue-size", type=int, default=25, help="command dispatcher queue size per worker")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for every command to be answered")
+    parser.add_argument("--seed", type=int, default=76, help="seed of the synthetic stream")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the bot while benchmarking")
+    args = parser.parse_args()
+
+    logging.getLogger("karma_bot").setLevel(args.log_level)
+    start = time.perf_counter()
+    exit_code = asyncio.run(run(args))
+    print(f"\nBenchmark finished in {time.perf_counter() - start:.1f} seconds")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
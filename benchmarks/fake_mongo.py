@@ -0,0 +1,196 @@
+"""In-memory stand-in for the parts of the Motor API the bot uses, with an injected round-trip latency."""
+
+from __future__ import annotations
+
+import asyncio
+import copy
+from collections import Counter
+from types import TracebackType
+from typing import Any, AsyncIterator, Mapping, Optional, cast
+
+from bson import ObjectId
+from pymongo import IndexModel, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import UpdateResult
+
+Document = dict[str, Any]
+
+
+def matches(document: Mapping[str, Any], query: Mapping[str, Any]) -> bool:
+    """Checks if the document matches the query. Supports equality and the comparison operators the bot uses.
+
+    :param document: The stored document.
+    :param query: The filter, e.g., ``{"from_user": "a", "count": {"$lt": 10}}``.
+
+    :returns: True if the document matches.
+
+    """
+    for field, condition in query.items():
+        value = document.get(field)
+        if isinstance(condition, Mapping) and condition and all(str(operator).startswith("$") for operator in cast(Mapping[str, Any], condition)):
+            for operator, operand in cast(Mapping[str, Any], condition).items():
+                if value is None and operator in ("$lt", "$lte", "$gt", "$gte"):
+                    return False
+                if operator == "$lt" and not value < operand:
+                    return False
+                if operator == "$lte" and not value <= operand:
+                    return False
+                if operator == "$gt" and not value > operand:
+                    return False
+                if operator == "$gte" and not value >= operand:
+                    return False
+                if operator == "$ne" and value == operand:
+                    return False
+                if operator == "$in" and value not in operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+class IdleChangeStream:
+    """Change stream that never reports a change. Only the bot writes to the in-memory database, and its writes go through the caches already."""
+
+    async def __aenter__(self) -> IdleChangeStream:
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        return None
+
+    def __aiter__(self) -> IdleChangeStream:
+        return self
+
+    async def __anext__(self) -> Document:
+        await asyncio.Event().wait()
+        raise StopAsyncIteration
+
+
+class InMemoryCollection:
+    """List of documents with unique indexes. Every call sleeps for the latency of one round-trip."""
+
+    def __init__(self, name: str, database: InMemoryDatabase) -> None:
+        self.name = name
+        self.database = database
+        self.documents: list[Document] = []
+        self._unique_keys: list[tuple[str, ...]] = [("_id",)]
+
+    async def _round_trip(self, operation: str) -> None:
+        self.database.round_trips[f"{self.name}.{operation}"] += 1
+        if self.database.latency:
+            await asyncio.sleep(self.database.latency)
+
+    def _check_unique(self, candidate: Document, replacing: Optional[Document] = None) -> None:
+        for keys in self._unique_keys:
+            key_values = tuple(candidate.get(key) for key in keys)
+            for document in self.documents:
+                if document is not replacing and tuple(document.get(key) for key in keys) == key_values:
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {'_'.join(keys)}", code=11000)
+
+    def _insert(self, document: Mapping[str, Any]) -> Document:
+        stored = copy.deepcopy(dict(document))
+        stored.setdefault("_id", ObjectId())
+        self._check_unique(stored)
+        self.documents.append(stored)
+        return stored
+
+    def _find(self, query: Mapping[str, Any]) -> Optional[Document]:
+        return next((document for document in self.documents if matches(document, query)), None)
+
+    def _apply_update(self, document: Document, update: Mapping[str, Any], inserting: bool) -> Document:
+        updated = copy.deepcopy(document)
+        updated.update(update.get("$set", {}))
+        if inserting:
+            updated.update(update.get("$setOnInsert", {}))
+        for field, amount in update.get("$inc", {}).items():
+            updated[field] = updated.get(field, 0) + amount
+        for field in update.get("$unset", {}):
+            updated.pop(field, None)
+        return updated
+
+    def _upsert(self, query: Mapping[str, Any], update: Mapping[str, Any], upsert: bool) -> tuple[Optional[Document], Optional[Document]]:
+        """Applies the update to the first matching document, or inserts one built from the query.
+
+        :returns: The document before and after the update. Both are None if nothing matched and upsert is False.
+
+        """
+        document = self._find(query)
+        if document is not None:
+            updated = self._apply_update(document, update, inserting=False)
+            self._check_unique(updated, replacing=document)
+            self.documents[self.documents.index(document)] = updated
+            return document, updated
+        if not upsert:
+            return None, None
+
+        seed = {field: value for field, value in query.items() if not isinstance(value, Mapping)}
+        return None, self._insert(self._apply_update(seed, update, inserting=True))
+
+    async def create_indexes(self, indexes: list[IndexModel]) -> list[str]:
+        await self._round_trip("create_indexes")
+        names: list[str] = []
+        for index in indexes:
+            if index.document.get("unique"):
+                self._unique_keys.append(tuple(index.document["key"]))
+            names.append(index.document["name"])
+        return names
+
+    async def find_one(self, query: Mapping[str, Any], projection: Optional[Mapping[str, Any]] = None) -> Optional[Document]:
+        await self._round_trip("find_one")
+        return copy.deepcopy(self._find(query))
+
+    async def find(self, query: Mapping[str, Any], projection: Optional[Mapping[str, Any]] = None, limit: int = 0) -> AsyncIterator[Document]:
+        await self._round_trip("find")
+        found = [copy.deepcopy(document) for document in self.documents if matches(document, query)]
+        for document in found[:limit] if limit else found:
+            yield document
+
+    async def find_one_and_update(
+        self, query: Mapping[str, Any], update: Mapping[str, Any], upsert: bool = False, return_document: bool = ReturnDocument.BEFORE
+    ) -> Optional[Document]:
+        await self._round_trip("find_one_and_update")
+        before, after = self._upsert(query, update, upsert)
+        return copy.deepcopy(after if return_document == ReturnDocument.AFTER else before)
+
+    async def update_one(self, query: Mapping[str, Any], update: Mapping[str, Any], upsert: bool = False) -> UpdateResult:
+        await self._round_trip("update_one")
+        before, after = self._upsert(query, update, upsert)
+        return UpdateResult({"n": int(after is not None), "nModified": int(before is not None)}, acknowledged=True)
+
+    async def insert_one(self, document: Mapping[str, Any]) -> None:
+        await self._round_trip("insert_one")
+        self._insert(document)
+
+    async def insert_many(self, documents: list[Document], ordered: bool = True) -> None:
+        await self._round_trip("insert_many")
+        write_errors: list[dict[str, Any]] = []
+        for index, document in enumerate(documents):
+            try:
+                self._insert(document)
+            except DuplicateKeyError as duplicate_error:
+                write_errors.append({"index": index, "code": 11000, "errmsg": str(duplicate_error)})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "nInserted": len(documents) - len(write_errors)})
+
+    def watch(self, *args: Any, **kwargs: Any) -> IdleChangeStream:
+        return IdleChangeStream()
+
+
+class InMemoryDatabase:
+    """Dict of in-memory collections standing in for an ``AsyncIOMotorDatabase``."""
+
+    def __init__(self, latency: float = 0) -> None:
+        """Creates an empty database.
+
+        :param latency: Seconds every call sleeps to simulate the round-trip to MongoDB.
+
+        """
+        self.latency = latency
+        self.round_trips: Counter[str] = Counter()
+        self._collections: dict[str, InMemoryCollection] = {}
+
+    def __getitem__(self, collection_name: str) -> InMemoryCollection:
+        if collection_name not in self._collections:
+            self._collections[collection_name] = InMemoryCollection(collection_name, self)
+        return self._collections[collection_name]
@@ -0,0 +1,336 @@
+"""Local stand-in for the Reddit API behind a real asyncpraw ``Reddit`` instance, with an injected request latency.
+
+Only the transport is replaced: :class:`FakeReddit` overrides ``Reddit.request``, so the bot works with genuine asyncpraw models and every request it makes
+is counted by endpoint.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import random
+import re
+import time
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass, field
+from typing import IO, Any, Optional, cast
+
+from asyncpraw import Reddit
+
+SUBREDDIT = "Fallout76Marketplace"
+BOT_NAME = "Vault-TecTradingCo"
+
+
+def base36(number: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    encoded = ""
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = digits[remainder] + encoded
+        if number == 0:
+            return encoded
+
+
+@dataclass
+class FakeSubmission:
+    id: str
+    author: str
+    flair: str
+
+    @property
+    def fullname(self) -> str:
+        return f"t3_{self.id}"
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "kind": "t3",
+            "data": {
+                "id": self.id,
+                "name": self.fullname,
+                "author": self.author,
+                "title": f"H: Items W: Caps ({self.id})",
+                "link_flair_text": self.flair,
+                "permalink": f"/r/{SUBREDDIT}/comments/{self.id}/",
+                "subreddit": SUBREDDIT,
+                "removed": False,
+                "mod_note": None,
+                "created_utc": 0.0,
+            },
+        }
+
+
+@dataclass
+class FakeComment:
+    id: str
+    submission: FakeSubmission
+    parent_id: str
+    author: str
+    body: str
+    is_command: bool = False
+    visible_at: float = float("inf")  # Event loop time at which the comment shows up in the listings
+    created_utc: float = 0.0
+    is_mention: bool = False  # Username mentions are delivered through the inbox, where comments have a context link instead of a permalink
+    replies: list[FakeComment] = field(default_factory=lambda: list[FakeComment]())
+
+    @property
+    def fullname(self) -> str:
+        return f"t1_{self.id}"
+
+    def to_json(self, replies: Optional[list[FakeComment]] = None) -> dict[str, Any]:
+        permalink = f"/r/{SUBREDDIT}/comments/{self.submission.id}/_/{self.id}/"
+        if self.is_mention:
+            data: dict[str, Any] = {"context": f"{permalink}?context=3", "subject": "username mention", "was_comment": True, "new": True, "dest": BOT_NAME}
+        else:
+            data = {"link_id": self.submission.fullname, "permalink": permalink, "replies": listing([reply.to_json() for reply in replies]) if replies else ""}
+        return {
+            "kind": "t1",
+            "data": {
+                "id": self.id,
+                "name": self.fullname,
+                "author": self.author,
+                "body": self.body,
+                "parent_id": self.parent_id,
+                "subreddit": SUBREDDIT,
+                "removed": False,
+                "mod_note": None,
+                "created_utc": self.created_utc,
+                **data,
+            },
+        }
+
+
+def listing(children: list[dict[str, Any]], after: Optional[str] = None) -> dict[str, Any]:
+    return {"kind": "Listing", "data": {"children": children, "after": after, "before": None}}
+
+
+class FakeRedditWorld:
+    """The subreddit seen by the bot: submissions, comments appearing over time, moderators, couriers, and the rate limit budget.
+
+    Every request sleeps for ``latency`` seconds, spread by ``jitter``, and is counted per endpoint. When the bot replies to a command comment, the time since
+    the comment appeared in the listings is recorded as the command latency. If ``rate_limit`` is set, the responses report the requests left out of
+    ``rate_limit`` per ``rate_limit_window`` seconds, without rejecting any request.
+
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.1,
+        jitter: float = 0.2,
+        moderators: tuple[str, ...] = ("Mod_A", "Mod_B"),
+        couriers: tuple[str, ...] = ("Courier_A",),
+        rate_limit: Optional[int] = None,
+        rate_limit_window: float = 600,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.moderators = moderators
+        self.couriers = couriers
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.submissions: dict[str, FakeSubmission] = {}
+        self.comments: dict[str, FakeComment] = {}
+        self.stream: list[FakeComment] = []  # In id order, i.e., oldest first
+        self.mentions: list[FakeComment] = []  # Only delivered through the inbox, in id order
+        self._unread: set[str] = set()
+        self.api_calls: Counter[str] = Counter()
+        self.command_latencies: list[float] = []
+        self.all_answered = asyncio.Event()
+        self._sequence = 36**5  # Real ids have at least six characters
+        self._unanswered_closes: defaultdict[str, deque[FakeComment]] = defaultdict(deque)
+        self._pending_commands: set[str] = set()
+        self._window_started = 0.0
+        self._window_used = 0
+
+    def _next_id(self) -> str:
+        self._sequence += 1
+        return base36(self._sequence)
+
+    def add_submission(self, author: str, flair: str = "XBOX") -> FakeSubmission:
+        submission = FakeSubmission(id=self._next_id(), author=author, flair=flair)
+        self.submissions[submission.id] = submission
+        return submission
+
+    def add_comment(self, parent: FakeSubmission | FakeComment, author: str, body: str, is_command: bool = False) -> FakeComment:
+        submission = parent if isinstance(parent, FakeSubmission) else parent.submission
+        comment = FakeComment(id=self._next_id(), submission=submission, parent_id=parent.fullname, author=author, body=body, is_command=is_command)
+        if isinstance(parent, FakeComment):
+            parent.replies.append(comment)
+        self.comments[comment.id] = comment
+        self.stream.append(comment)
+        return comment
+
+    def add_mention(self, submission: FakeSubmission, author: str, body: str) -> FakeComment:
+        """Adds a comment mentioning the bot. It shows up in the bot's inbox, but not in the comment stream.
+
+        :param submission: The submission the comment is posted to.
+        :param author: The username of the author.
+        :param body: The text of the comment, starting with the mention.
+
+        :returns: The comment.
+
+        """
+        mention = FakeComment(
+            id=self._next_id(), submission=submission, parent_id=submission.fullname, author=author, body=body, is_command=True, is_mention=True
+        )
+        self.comments[mention.id] = mention
+        self.mentions.append(mention)
+        return mention
+
+    def publish(self, start: float, arrival_rate: float) -> None:
+        """Schedules when the comments appear in the listings.
+
+        :param start: Event loop time at which the first comment appears.
+        :param arrival_rate: Comments per second. 0 makes every comment appear at once, like a backlog after downtime.
+
+        """
+        wall_clock_offset = time.time() - asyncio.get_running_loop().time()
+        for position, comment in enumerate(self.stream):
+            comment.visible_at = start if arrival_rate <= 0 else start + position / arrival_rate
+            comment.created_utc = comment.visible_at + wall_clock_offset
+            if comment.is_command:
+                self._pending_commands.add(comment.id)
+                if comment.body.lower().startswith(("!close", "close!")):
+                    self._unanswered_closes[comment.submission.id].append(comment)
+        # Mentions are all in the inbox from the start
+        for mention in self.mentions:
+            mention.visible_at = start
+            mention.created_utc = start + wall_clock_offset
+            self._pending_commands.add(mention.id)
+            self._unread.add(mention.id)
+        if not self._pending_commands:
+            self.all_answered.set()
+
+    @property
+    def commands(self) -> int:
+        return sum(comment.is_command for comment in self.stream) + len(self.mentions)
+
+    def _visible_comments(self) -> list[FakeComment]:
+        now = asyncio.get_running_loop().time()
+        return [comment for comment in self.stream if comment.visible_at <= now]
+
+    def rate_limit_headers(self) -> dict[str, str]:
+        now = asyncio.get_running_loop().time()
+        if now - self._window_started >= self.rate_limit_window:
+            self._window_started, self._window_used = now, 0
+        self._window_used += 1
+        return {
+            "x-ratelimit-remaining": str(max(0, cast(int, self.rate_limit) - self._window_used)),
+            "x-ratelimit-used": str(self._window_used),
+            "x-ratelimit-reset": str(int(self._window_started + self.rate_limit_window - now)),
+        }
+
+    def _record_reply(self, thing_id: str) -> None:
+        kind, _, thing = thing_id.partition("_")
+        if kind == "t1":
+            comment: Optional[FakeComment] = self.comments.get(thing)
+        else:
+            closes = self._unanswered_closes[thing]
+            comment = closes.popleft() if closes else None
+        if comment is None or comment.id not in self._pending_commands:
+            return
+        self._pending_commands.discard(comment.id)
+        self.command_latencies.append(asyncio.get_running_loop().time() - comment.visible_at)
+        if not self._pending_commands:
+            self.all_answered.set()
+
+    async def handle(self, method: str, path: str, params: dict[str, Any], data: dict[str, Any]) -> Any:
+        """Answers one API request after the injected latency.
+
+        :param method: HTTP method.
+        :param path: API path without the domain.
+        :param params: Query parameters.
+        :param data: Form data.
+
+        :returns: The parsed JSON response.
+
+        """
+        path = path.strip("/")
+        endpoint = re.sub(r"comments/\w+(/_/\w+)?$", lambda match: "comments/{id}" + ("/_/{comment}" if match[1] else ""), path)
+        endpoint = re.sub(r"^user/[\w-]+/", "user/{name}/", endpoint)
+        self.api_calls[f"{method} {endpoint}"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+        if path == f"r/{SUBREDDIT}/comments":
+            return self._comments_listing(params)
+        if match := re.fullmatch(r"comments/(\w+)/_/(\w+)", path):
+            return self._thread(match[1], match[2])
+        if match := re.fullmatch(r"comments/(\w+)", path):
+            return [listing([self.submissions[match[1]].to_json()]), listing([])]
+        if path == "api/info":
+            return listing([self.comments[fullname.split("_", 1)[1]].to_json() for fullname in str(params["id"]).split(",")])
+        if path == "api/comment":
+            return self._reply(data)
+        if path == "message/unread":
+            now = asyncio.get_running_loop().time()
+            unread = [mention for mention in self.mentions if mention.id in self._unread and mention.visible_at <= now]
+            return listing([mention.to_json() for mention in unread[::-1]])
+        if path == "api/read_message":
+            self._unread.difference_update(fullname.split("_", 1)[1] for fullname in str(data["id"]).split(","))
+            return {}
+        if match := re.fullmatch(r"user/([\w-]+)/about", path):
+            return {"kind": "t2", "data": {"name": match[1], "id": match[1].lower()}}
+        if path == f"r/{SUBREDDIT}/about/moderators":
+            moderators = [{"name": name, "id": f"t2_{name}", "mod_permissions": ["all"], "date": 0.0} for name in self.moderators]
+            return {"kind": "UserList", "data": {"children": moderators}}
+        if path == f"r/{SUBREDDIT}/wiki/custom_bot_config/courier_list":
+            content = "couriers:\n" + "".join(f"  - {name}\n" for name in self.couriers)
+            return {"kind": "wikipage", "data": {"content_md": content, "revision_id": "1", "revision_by": None, "revision_date": 0, "may_revise": False}}
+        if path == "api/v1/me":
+            return {"name": BOT_NAME, "id": "bot"}
+        # Moderation and flair endpoints: distinguish, lock, selectflair
+        return {}
+
+    def _comments_listing(self, params: dict[str, Any]) -> dict[str, Any]:
+        newest_first = self._visible_comments()[::-1]
+        if params.get("before"):
+            before = int(str(params["before"]).split("_", 1)[1], 36)
+            newest_first = [comment for comment in newest_first if int(comment.id, 36) > before]
+        if params.get("after"):
+            after = int(str(params["after"]).split("_", 1)[1], 36)
+            newest_first = [comment for comment in newest_first if int(comment.id, 36) < after]
+        limit = int(params.get("limit", 25))
+        page = newest_first[:limit]
+        after_fullname = page[-1].fullname if len(newest_first) > limit else None
+        return listing([comment.to_json() for comment in page], after=after_fullname)
+
+    def _thread(self, submission_id: str, comment_id: str) -> list[dict[str, Any]]:
+        comment = self.comments[comment_id]
+        parent = self.comments.get(comment.parent_id.split("_", 1)[1]) if comment.parent_id.startswith("t1_") else None
+        tree = [parent.to_json(replies=[comment])] if parent is not None else [comment.to_json()]
+        return [listing([self.submissions[submission_id].to_json()]), listing(tree)]
+
+    def _reply(self, data: dict[str, Any]) -> dict[str, Any]:
+        thing_id = str(data["thing_id"])
+        kind, _, thing = thing_id.partition("_")
+        parent: FakeSubmission | FakeComment = self.comments[thing] if kind == "t1" else self.submissions[thing]
+        submission = parent if isinstance(parent, FakeSubmission) else parent.submission
+        # The bot's replies are not part of the replayed stream
+        reply = FakeComment(id=self._next_id(), submission=submission, parent_id=thing_id, author=BOT_NAME, body=str(data["text"]))
+        self.comments[reply.id] = reply
+        self._record_reply(thing_id)
+        return {"json": {"errors": [], "data": {"things": [reply.to_json()]}}}
+
+
+class FakeReddit(Reddit):  # type: ignore[misc]
+    """Reddit instance whose requests are answered by a :class:`FakeRedditWorld` instead of reddit.com."""
+
+    def __init__(self, world: FakeRedditWorld) -> None:
+        super().__init__(client_id="benchmark", client_secret="benchmark", user_agent="karma bot benchmark", username=BOT_NAME, password="benchmark")
+        self.world = world
+
+    async def request(
+        self,
+        *,
+        data: dict[str, Any] | bytes | IO[Any] | str | None = None,
+        files: dict[str, IO[Any]] | None = None,
+        json: dict[Any, Any] | list[Any] | None = None,
+        method: str,
+        params: str | dict[str, str | int] | None = None,
+        path: str,
+    ) -> Any:
+        response = await self.world.handle(method, path, params if isinstance(params, dict) else {}, data if isinstance(data, dict) else {})
+        # Feed the rate limit headers to asyncprawcore's rate limiter like a real response would, so that the request scheduler sees the budget
+        if self.world.rate_limit is not None and self._core is not None:
+            self._core._rate_limiter.update(self.world.rate_limit_headers())
+        return response
@@ -1,31 +1,38 @@
 from __future__ import annotations
 
 import asyncio
-from typing import Any, Literal, TypedDict, cast
+import time
+from typing import Optional, cast
 
-from asyncpraw.models import Comment, Submission, Subreddit
+from asyncpraw.models import Comment, Message
 
 import bot_responses
-from conversation_checks import CloseChecks, KarmaChecks, checks_for_close_command, checks_for_karma_command, is_courier, is_mod
-from db_operations import check_already_rewarded, find_or_create_user_profile, get_daily_given_karma, get_mongo_collection, update_karma_logs
-from flair_functions import close_post_trade, update_flair
+from command_context import CommandContext, ThreadSnapshot
+from conversation_checks import CloseChecks, KarmaChecks, checks_for_close_command, checks_for_karma_command, is_mod, privileged_users
+from db_operations import (
+    check_already_rewarded,
+    get_mongo_collection,
+    increment_user_karma,
+    is_karma_logged,
+    karma_log_permalink,
+    release_daily_karma,
+    reserve_daily_karma,
+    update_karma_logs,
+)
+from flair_functions import build_user_flair, close_post_trade, update_flair
+from metrics import close_check_outcomes_total, command_latency_seconds, command_stage_seconds, karma_check_outcomes_total
+from rosters import courier_roster
 from utils import Connections, create_logger
 
 bot_commands_logger = create_logger(logger_name="karma_bot")
 
+DAILY_KARMA_LIMIT = 10
 
-class GamerTag(TypedDict):
-    """A dictionary representing a gamer tag."""
 
-    username: str
-    platform: Literal["PC", "XBOX", "PlayStation"]
-    user_id: int
+async def update_karma(reddit_username: str, karma_change: int, connections: Connections) -> None:
+    """Updates the karma of the user based on the karma_change value. Both the flair and the database are updated.
 
-
-async def update_karma(parent_post: Comment | Submission, karma_change: int, connections: Connections) -> None:
-    """Updates the karma of the author of the parent_post based on the karma_change value. Both the flair and the database are updated.
-
-    :param parent_post: The comment or submission object whose author's karma is to be updated.
+    :param reddit_username: The user whose karma is to be updated.
     :param karma_change: The change in karma value. Positive for an increase, negative for a decrease.
     :param connections: An instance of the Connections class containing database and subreddit connection.
 
@@ -33,76 +40,108 @@ async def update_karma(parent_post: Comment | Submission, karma_change: int, con
 
     """
     users_collection = await get_mongo_collection(collection_name="user_karma", fallout76marketplace_karma_db=connections.karma_db)
-    profile = await find_or_create_user_profile(parent_post.author.name, users_collection)
-    profile = cast(dict[str, Any], profile)
-    bot_commands_logger.info(f"Karma before {profile['reddit_username']}: {profile['karma']}")
-    profile["karma"] += karma_change
-    update_task = asyncio.ensure_future(users_collection.update_one({"reddit_username": parent_post.author.name}, {"$set": {"karma": profile["karma"]}}))
+    with command_stage_seconds.time(stage="db"):
+        profile = await increment_user_karma(reddit_username, karma_change, users_collection)
+    bot_commands_logger.info(f"Karma before {profile['reddit_username']}: {profile['karma'] - karma_change}")
 
     # Reconstructing user flair from their profile on db
-    gamertags: list[GamerTag] = profile["gamertags"]
-    platforms_emojis = {f":{gamertag['platform'].lower()}:" for gamertag in gamertags}
-    flair_label = "Verified Courier" if await is_courier(parent_post.author, connections.fo76_subreddit) else "Karma"
-    user_flair = f"{' '.join(platforms_emojis).strip()} {flair_label}: {profile['karma'] + profile['m76_karma']}"
-    await update_flair(parent_post=parent_post, user_flair=user_flair, karma=profile["karma"], connections=connections)
-
-    await update_task
+    with command_stage_seconds.time(stage="flair"):
+        user_flair = build_user_flair(profile, await courier_roster.contains(reddit_username, connections.fo76_subreddit))
+        await update_flair(reddit_username=reddit_username, user_flair=user_flair, karma=profile["karma"], connections=connections)
     bot_commands_logger.info(f"Karma after {profile['reddit_username']}: {profile['karma']}")
 
 
-async def karma_command(comment: Comment, karma_change: int, connections: Connections) -> None:
+async def award_karma(from_user: str, to_user: str, karma_change: int, comment: Comment | Message, connections: Connections) -> None:
+    """Changes the karma of to_user, then logs the change.
+
+    The log entry tells a retry of the command that the karma has already been changed, see :func:`is_karma_logged`, so it is only written once the
+    change has been applied.
+
+    :param from_user: The username of the user who gives the karma.
+    :param to_user: The username of the user who receives the karma.
+    :param karma_change: The change in karma value. Positive for an increase, negative for a decrease.
+    :param comment: The comment or message with the command.
+    :param connections: An instance of the Connections class containing database and subreddit connection.
+
+    :returns: None
+
+    """
+    await update_karma(to_user, karma_change, connections)
+    await update_karma_logs(from_user, to_user, karma_change, comment, connections)
+
+
+async def karma_command(context: CommandContext, karma_change: int) -> None:
     """Handle the karma command.
 
     Logs the received command and performs necessary checks before awarding karma. If the user is a moderator, it directly updates the karma. If not, it checks
     if the user is authorized to award karma based on certain criteria.
 
-    :param comment: The comment that triggered the karma command.
+    :param context: CommandContext of the comment that triggered the karma command.
     :param karma_change: The amount of karma to be awarded (positive) or subtracted (negative).
-    :param connections: Connections object containing connections to the database and Reddit API.
 
     :returns: None
 
     """
-    is_user_mod = await is_mod(comment.author, connections.fo76_subreddit)
+    comment, connections = context.comment, context.connections
+    with command_stage_seconds.time(stage="checks"):
+        is_user_mod = await is_mod(comment.author, connections.fo76_subreddit)
     bot_commands_logger.info(f"{'+karma' if karma_change == 1 else '-karma'}: from u/{comment.author.name}, {is_user_mod = }, {comment.id}")
-    already_rewarded_chk = (KarmaChecks.ALREADY_REWARDED, "")  # Initializing variable for later use
-    if not is_user_mod:
-        karma_checks = KarmaChecks.UNAUTHORIZED if karma_change == -1 else await checks_for_karma_command(comment, connections.fo76_subreddit)
-
-        # Only worth checking if previous checks have passed
-        if karma_checks == KarmaChecks.KARMA_CHECKS_PASSED:
-            p_comment = await comment.parent()
-            await p_comment.load()
-            already_rewarded_chk = await check_already_rewarded(
-                comment.author.name,
-                p_comment.author.name,
-                comment.submission.id,
-                connections,
-            )
-            karma_checks = already_rewarded_chk[0]
-
-        # Only worth checking if previous checks have passed
-        if karma_checks == KarmaChecks.KARMA_CHECKS_PASSED:
-            daily_karma = await get_daily_given_karma(comment.author.name, connections)
-            if daily_karma >= 10:
-                karma_checks = KarmaChecks.KARMA_AWARDING_LIMIT_REACHED
-    else:
-        karma_checks = KarmaChecks.KARMA_CHECKS_PASSED
-    bot_commands_logger.info(f"Comment(id={comment.id}) Checks Result: {karma_checks.name}, already_rewarded_chk={already_rewarded_chk}")
+    karma_logged = daily_karma_reserved = False
+
+    async def thread() -> ThreadSnapshot:
+        with command_stage_seconds.time(stage="checks"):
+            return await context.thread()
+
+    async def privileged() -> frozenset[str]:
+        with command_stage_seconds.time(stage="checks"):
+            return await privileged_users(connections.fo76_subreddit)
+
+    async def find_reward(to_user: str) -> Optional[str]:
+        nonlocal karma_logged
+        with command_stage_seconds.time(stage="db"):
+            karma_checks, permalink = await check_already_rewarded(comment.author.name, to_user, comment.submission.id, connections)
+        if karma_checks == KarmaChecks.ALREADY_REWARDED and permalink == karma_log_permalink(comment):
+            # Rewarded by an earlier attempt of this command that failed afterwards, so only the reply is left to do
+            karma_logged = True
+            return None
+        return permalink if karma_checks == KarmaChecks.ALREADY_REWARDED else None
+
+    async def reserve() -> bool:
+        nonlocal daily_karma_reserved
+        if karma_logged:
+            return True
+        with command_stage_seconds.time(stage="db"):
+            daily_karma_reserved = await reserve_daily_karma(comment.author.name, DAILY_KARMA_LIMIT, comment.created_utc, connections)
+        return daily_karma_reserved
+
+    async def award(to_user: str) -> None:
+        try:
+            await award_karma(comment.author.name, to_user, karma_change, comment, connections)
+        except BaseException:
+            # The karma hasn't been given, so it must not count towards the daily limit, also not when the command is retried
+            if daily_karma_reserved:
+                await asyncio.shield(release_daily_karma(comment.author.name, comment.created_utc, connections))
+            raise
+
+    karma_checks, rewarded_permalink = await checks_for_karma_command(karma_change, is_user_mod, thread, privileged, find_reward, reserve)
+    if is_user_mod and karma_checks == KarmaChecks.KARMA_CHECKS_PASSED:
+        with command_stage_seconds.time(stage="db"):
+            karma_logged = await is_karma_logged(comment, connections)
+    bot_commands_logger.info(f"Comment(id={comment.id}) Checks Result: {karma_checks.name}, {rewarded_permalink = }, {karma_logged = }")
+    karma_check_outcomes_total.inc(outcome=karma_checks.name)
 
     match karma_checks:
         case KarmaChecks.KARMA_CHECKS_PASSED:
-            p_comment = await comment.parent()
-            await p_comment.load()
+            parent_author = cast(str, (await context.thread()).parent.author)
             async with asyncio.TaskGroup() as tg:
-                tg.create_task(update_karma_logs(comment.author.name, p_comment.author.name, comment, connections))
-                tg.create_task(update_karma(p_comment, karma_change, connections))
+                if not karma_logged:
+                    tg.create_task(award(parent_author))
                 if karma_change == 1:
-                    tg.create_task(bot_responses.karma_rewarded_comment(comment))
+                    tg.create_task(bot_responses.karma_rewarded_comment(context))
                 else:
-                    tg.create_task(bot_responses.karma_subtract_comment(comment))
+                    tg.create_task(bot_responses.karma_subtract_comment(context))
         case KarmaChecks.ALREADY_REWARDED:
-            await bot_responses.already_rewarded_comment(comment, permalink=already_rewarded_chk[1])
+            await bot_responses.already_rewarded_comment(context, permalink=rewarded_permalink)
         case KarmaChecks.CANNOT_REWARD_YOURSELF:
             await bot_responses.cannot_reward_yourself_comment(comment)
         case KarmaChecks.CONVERSATION_NOT_LONG_ENOUGH:
@@ -118,32 +157,37 @@ async def karma_command(comment: Comment, karma_change: int, connections: Connec
             await bot_responses.more_than_two_users_involved(comment)
         case KarmaChecks.UNAUTHORIZED:
             await bot_responses.karma_subtract_failed(comment)
+    command_latency_seconds.observe(time.time() - comment.created_utc, command="karma")
 
 
-async def close_command(comment: Comment, fo76_subreddit: Subreddit) -> None:
+async def close_command(context: CommandContext) -> None:
     """Handle the close command.
 
     Logs the received command and performs necessary checks before closing the submission. If the user is a moderator, it directly closes the submission. If
     not, it checks if the user is authorized to close the submission based on certain criteria.
 
-    :param comment: The comment that triggered the close command.
-    :param fo76_subreddit: SubredditHelper Subreddit object to make API calls related to subreddit.
+    :param context: CommandContext of the comment that triggered the close command.
 
     :returns: None
 
     """
-    is_user_mod = await is_mod(comment.author, fo76_subreddit)
-    bot_commands_logger.info(f"Received Closing command: {comment}, is_mod: {is_user_mod}")
-    if not is_user_mod:
-        close_checks = await checks_for_close_command(comment)
-    else:
-        close_checks = CloseChecks.CLOSE_CHECKS_PASSED
+    comment = context.comment
+    with command_stage_seconds.time(stage="checks"):
+        is_user_mod = await is_mod(comment.author, context.connections.fo76_subreddit)
+        bot_commands_logger.info(f"Received Closing command: {comment}, is_mod: {is_user_mod}")
+        if not is_user_mod:
+            close_checks = await checks_for_close_command(context)
+        else:
+            close_checks = CloseChecks.CLOSE_CHECKS_PASSED
+    close_check_outcomes_total.inc(outcome=close_checks.name)
 
     match close_checks:
         case CloseChecks.CLOSE_CHECKS_PASSED:
-            await close_post_trade(comment)
+            with command_stage_seconds.time(stage="flair"):
+                await close_post_trade(context)
             await bot_responses.close_submission_comment(comment.submission)
         case CloseChecks.NOT_TRADING_SUBMISSION:
             await bot_responses.close_submission_failed(comment, is_trading_post=False)
         case CloseChecks.NOT_OP:
             await bot_responses.close_submission_failed(comment, is_trading_post=True)
+    command_latency_seconds.observe(time.time() - comment.created_utc, command="close")
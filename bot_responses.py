@@ -1,39 +1,108 @@
+import asyncio
 import logging
+import time
+from typing import Awaitable, Callable, TypeVar
 
 from asyncpraw.exceptions import APIException
-from asyncpraw.models import Comment, Submission
+from asyncpraw.models import Comment, Message, Submission
+from asyncprawcore.exceptions import RequestException, ServerError
+
+from backoff import BackoffPolicy
+from command_context import CommandContext
+from metrics import command_stage_seconds
+from request_scheduler import Priority, request_scheduler
 
 response_logger = logging.getLogger("karma_bot")
 
+T = TypeVar("T")
+
+# Network errors and Reddit 5xx responses are worth retrying, everything else is raised straight away
+TRANSIENT_ERRORS = (RequestException, ServerError)
+STEP_RETRY_POLICY = BackoffPolicy(base_delay=1, max_delay=8)
+STEP_ATTEMPTS = 3
+
+DISCLAIMER = (
+    "\n\n^(This action was performed by a bot. Please contact the mods for any questions. "
+    "[See disclaimer](https://www.reddit.com/user/Vault-TecTradingCo/comments/lkllre/disclaimer_for_rfallout76marketplace/)) "
+)
+
+
+async def run_step(step_name: str, action: Callable[[], Awaitable[T]], attempts: int = STEP_ATTEMPTS) -> tuple[T, float]:
+    """Runs one API call of the reply pipeline at high request priority, retrying it on transient errors.
+
+    :param step_name: Name of the step used in the logs.
+    :param action: Zero argument coroutine function that makes the API call.
+    :param attempts: Maximum number of times the call is made.
+
+    :returns: The result of the call and the time it took in seconds, including retries.
+
+    """
+    start = time.perf_counter()
+    for attempt in range(attempts - 1):
+        try:
+            async with request_scheduler.slot(Priority.HIGH):
+                return await action(), time.perf_counter() - start
+        except TRANSIENT_ERRORS:
+            delay = STEP_RETRY_POLICY.delay(attempt)
+            response_logger.warning(f"Transient error in reply step {step_name}, retrying in {delay:.1f} seconds", exc_info=True)
+            await asyncio.sleep(delay)
+    async with request_scheduler.slot(Priority.HIGH):
+        return await action(), time.perf_counter() - start
+
 
 async def reply(reddit_post: Comment | Submission, body: str) -> None:
-    # Adds disclaimer text
-    response = body + "\n\n^(This action was performed by a bot. Please contact the mods for any questions. "
-    response += "[See disclaimer](https://www.reddit.com/user/Vault-TecTradingCo/comments/lkllre/disclaimer_for_rfallout76marketplace/)) "
+    """Replies to the comment or submission, then distinguishes and locks the reply.
+
+    Distinguishing and locking are independent, so they are done concurrently once the reply exists. Each of them is retried on its own, and a failed
+    moderation step doesn't undo the reply. The reply itself is not retried because a failed request may still have posted it.
+
+    :param reddit_post: The comment or submission to reply to. If a comment has been deleted, the bot replies to its submission instead.
+    :param body: Text of the reply without the disclaimer.
+
+    :returns: None
+
+    """
+    response = body + DISCLAIMER
+    start = time.perf_counter()
     try:
-        new_comment = await reddit_post.reply(response)
+        new_comment, reply_latency = await run_step("reply", lambda: reddit_post.reply(response), attempts=1)
         response_logger.info(f"Bot replied to the {type(reddit_post).__name__} id {reddit_post.id}")
-        await new_comment.mod.distinguish(how="yes")
-        await new_comment.mod.lock()
     except APIException:
-        new_comment = await reddit_post.submission.reply(response)
-        response_logger.warning(f"The comment with id {reddit_post.id} was deleted; therefore, the bot replied to submission {reddit_post.submission.id}.")
-        await new_comment.mod.distinguish(how="yes")
-        await new_comment.mod.lock()
+        submission = reddit_post.submission
+        new_comment, reply_latency = await run_step("reply", lambda: submission.reply(response), attempts=1)
+        response_logger.warning(f"The comment with id {reddit_post.id} was deleted; therefore, the bot replied to submission {submission.id}.")
+
+    if new_comment is None:
+        response_logger.error(f"Reddit didn't return the reply to {reddit_post.id}, so it can't be distinguished and locked")
+        return
+
+    step_results: tuple[tuple[object, float] | BaseException, tuple[object, float] | BaseException] = await asyncio.gather(
+        run_step("distinguish", lambda: new_comment.mod.distinguish(how="yes")),
+        run_step("lock", lambda: new_comment.mod.lock()),
+        return_exceptions=True,
+    )
+    latencies = [f"reply={reply_latency:.2f}s"]
+    for step_name, result in zip(("distinguish", "lock"), step_results):
+        if isinstance(result, BaseException):
+            response_logger.error(f"Failed to {step_name} reply {new_comment.id}", exc_info=result)
+        else:
+            latencies.append(f"{step_name}={result[1]:.2f}s")
+    response_logger.info(f"Reply {new_comment.id} latency: {', '.join(latencies)}")
+    command_stage_seconds.observe(time.perf_counter() - start, stage="reply")
 
 
-async def karma_rewarded_comment(comment: Comment) -> None:
+async def karma_rewarded_comment(context: CommandContext) -> None:
     """Comment reply when karma is given successfully.
 
-    :param comment: The comment that triggered the command.
+    :param context: CommandContext of the comment that triggered the command.
 
     :returns: None
 
     """
-    p_comment = await comment.parent()
-    await p_comment.load()
+    comment = context.comment
+    thread = await context.thread()
     comment_body = (
-        f"Hi u/{comment.author.name}! You have successfully rewarded u/{p_comment.author.name} with one karma point! Please note that karma may take "
+        f"Hi u/{comment.author.name}! You have successfully rewarded u/{thread.parent.author} with one karma point! Please note that karma may take "
         f"sometime to update."
     )
     await reply(comment, comment_body)
@@ -116,18 +185,18 @@ async def deleted_or_removed(comment: Comment) -> None:
     await reply(comment, comment_body)
 
 
-async def already_rewarded_comment(comment: Comment, permalink: str) -> None:
+async def already_rewarded_comment(context: CommandContext, permalink: str) -> None:
     """Comment reply if the user has already been rewarded in a submission.
 
-    :param comment: The comment that triggered the command.
+    :param context: CommandContext of the comment that triggered the command.
     :param permalink: The link to the comment where the user gave karma.
 
     :returns: None
 
     """
-    p_comment = await comment.parent()
-    await p_comment.load()
-    comment_body = f"Hi u/{comment.author.name}! You have already rewarded {p_comment.author.name} in this submission. See [here]({permalink})"
+    comment = context.comment
+    thread = await context.thread()
+    comment_body = f"Hi u/{comment.author.name}! You have already rewarded {thread.parent.author} in this submission. See [here]({permalink})"
     await reply(comment, comment_body)
 
 
@@ -161,18 +230,17 @@ async def karma_trading_posts_only(comment: Comment) -> None:
     await reply(comment, comment_body)
 
 
-async def karma_subtract_comment(comment: Comment) -> None:
+async def karma_subtract_comment(context: CommandContext) -> None:
     """Comment reply when karma is subtracted successfully.
 
-    :param comment: The comment that triggered the command.
+    :param context: CommandContext of the comment that triggered the command.
 
     :returns: None
 
     """
-    p_comment = await comment.parent()
-    await p_comment.load()
-    comment_body = f"{p_comment.author.name}'s karma has been decremented by one. Please note that karma may take some time to update."
-    await reply(comment, comment_body)
+    thread = await context.thread()
+    comment_body = f"{thread.parent.author}'s karma has been decremented by one. Please note that karma may take some time to update."
+    await reply(context.comment, comment_body)
 
 
 async def karma_subtract_failed(comment: Comment) -> None:
@@ -213,3 +281,18 @@ async def close_submission_failed(comment: Comment, is_trading_post: bool) -> No
     else:
         comment_body = "This type of submission cannot be closed. Please refer to the wiki page for more information."
     await reply(comment, comment_body)
+
+
+async def mod_command_reply(item: Comment | Message, body: str) -> None:
+    """Answers a mod command received in the inbox.
+
+    The reply is neither distinguished nor locked, because private messages can't be, and mentions can come from subreddits the bot doesn't moderate.
+
+    :param item: The private message or the comment mentioning the bot.
+    :param body: Text of the reply without the disclaimer.
+
+    :returns: None
+
+    """
+    _, reply_latency = await run_step("reply", lambda: item.reply(body + DISCLAIMER), attempts=1)
+    response_logger.info(f"Bot answered the mod command in {type(item).__name__} id {item.id} in {reply_latency:.2f}s")
@@ -0,0 +1,58 @@
+#!.venv/bin/python
+"""Explains every hot query of the bot and fails if any of them falls back to a collection scan."""
+
+from __future__ import annotations
+
+import asyncio
+import sys
+from typing import Any, Iterator, Mapping
+
+from dotenv import load_dotenv
+
+from db_operations import HOT_QUERIES, get_mongo_collection
+from utils import create_logger, get_karma_db
+
+load_dotenv()
+
+check_indexes_logger = create_logger(logger_name="karma_bot", set_format=True)
+
+
+def plan_stages(plan: Mapping[str, Any]) -> Iterator[str]:
+    """Yields the stage names of a query plan and all of its input stages.
+
+    :param plan: The winning plan from the explain output.
+
+    :returns: Generator of stage names.
+
+    """
+    yield plan["stage"]
+    if "inputStage" in plan:
+        yield from plan_stages(plan["inputStage"])
+    for input_stage in plan.get("inputStages", []):
+        yield from plan_stages(input_stage)
+
+
+async def main() -> int:
+    """Runs explain on every hot query and reports the stages of the winning plan.
+
+    :returns: 0 if every query uses an index, otherwise 1.
+
+    """
+    success = True
+    async with get_karma_db() as karma_db:
+        for query_name, (collection_name, query) in HOT_QUERIES.items():
+            collection = await get_mongo_collection(collection_name=collection_name, fallout76marketplace_karma_db=karma_db)
+            explanation = await collection.find(query).explain()
+            winning_plan = explanation["queryPlanner"]["winningPlan"]
+            # Plans from the slot based execution engine nest the classic plan under queryPlan
+            stages = list(plan_stages(winning_plan.get("queryPlan", winning_plan)))
+            if "COLLSCAN" in stages:
+                check_indexes_logger.error(f"{query_name} on {collection_name} does a collection scan: {' <- '.join(stages)}")
+                success = False
+            else:
+                check_indexes_logger.info(f"{query_name} on {collection_name}: {' <- '.join(stages)}")
+    return int(not success)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
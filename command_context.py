@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Optional
+
+from asyncpraw.models import Comment, Submission
+
+from request_scheduler import Priority, request_scheduler
+from utils import Connections
+
+
+@dataclass(frozen=True)
+class PostSnapshot:
+    """The parts of a comment or submission the checks need."""
+
+    fullname: str
+    author: Optional[str]  # None if the post has been deleted
+    removed: bool
+    permalink: str
+
+    @property
+    def is_removed_or_deleted(self) -> bool:
+        return self.author is None or self.removed
+
+    @classmethod
+    def from_post(cls, post: Comment | Submission) -> PostSnapshot:
+        """Takes a snapshot of a fetched comment or submission.
+
+        :param post: The fetched comment or submission.
+
+        :returns: The snapshot.
+
+        """
+        return cls(
+            fullname=post.fullname,
+            author=None if post.author is None else post.author.name,
+            removed=bool(post.mod_note or post.removed),
+            permalink=post.permalink,
+        )
+
+
+@dataclass(frozen=True)
+class ThreadSnapshot:
+    """Immutable view of the command comment, its parent, and the submission at the time of the command."""
+
+    comment: PostSnapshot
+    parent: PostSnapshot  # The submission itself for top-level comments
+    submission: PostSnapshot
+    submission_flair: str
+    is_root: bool
+
+
+async def fetch_thread(comment: Comment) -> ThreadSnapshot:
+    """Fetches the comment together with its parent comment and the submission in one request.
+
+    The comment permalink with ``context=1`` returns the submission and a comment tree starting at the parent comment.
+
+    :param comment: The command comment.
+
+    :returns: The snapshot of the thread.
+
+    """
+    submission_id = comment.link_id.split("_", 1)[1]
+    submission_listing, comment_listing = await comment._reddit.get(f"comments/{submission_id}/_/{comment.id}", params={"context": 1})
+    submission: Submission = submission_listing.children[0]
+
+    # The tree starts at the parent comment, or at the comment itself if it is top-level
+    fetched_comments: dict[str, Comment] = {}
+    queue = list(comment_listing.children)
+    while queue:
+        fetched = queue.pop()
+        if isinstance(fetched, Comment):
+            fetched_comments[fetched.fullname] = fetched
+            # The fetch has filled the reply forests already. CommentForest is only iterable through __getitem__, which type checkers don't recognize.
+            replies = fetched.replies
+            queue.extend(replies[index] for index in range(len(replies)))
+
+    fetched_comment = fetched_comments.get(comment.fullname, comment)
+    submission_snapshot = PostSnapshot.from_post(submission)
+    is_root = comment.parent_id == comment.link_id
+    if is_root:
+        parent_snapshot = submission_snapshot
+    else:
+        parent = fetched_comments.get(comment.parent_id)
+        if parent is None:
+            parent = await comment.parent()
+            await parent.load()
+        parent_snapshot = PostSnapshot.from_post(parent)
+
+    return ThreadSnapshot(
+        comment=PostSnapshot.from_post(fetched_comment),
+        parent=parent_snapshot,
+        submission=submission_snapshot,
+        submission_flair="" if submission.link_flair_text is None else submission.link_flair_text,
+        is_root=is_root,
+    )
+
+
+class CommandContext:
+    """Everything a single bot command needs, with the thread around the command comment fetched at most once.
+
+    The same context is passed to the checks, the database operations, the flair functions, and the bot responses so that they share one snapshot of the
+    thread instead of each fetching the parent and the submission again.
+
+    """
+
+    def __init__(self, comment: Comment, connections: Connections) -> None:
+        """Creates the context. Nothing is fetched until it is first needed.
+
+        :param comment: The comment that triggered the command.
+        :param connections: Connections object containing connections to the database and Reddit API.
+
+        """
+        self.comment = comment
+        self.connections = connections
+        self._thread: Optional[ThreadSnapshot] = None
+
+    async def thread(self) -> ThreadSnapshot:
+        """Returns the snapshot of the command comment, its parent and the submission, fetching it on first use.
+
+        :returns: The snapshot of the thread.
+
+        """
+        if self._thread is None:
+            async with request_scheduler.slot(Priority.HIGH):
+                self._thread = await fetch_thread(self.comment)
+        return self._thread
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+from traceback import format_exc
+from types import TracebackType
+from typing import Awaitable, Callable, Optional
+
+from utils import create_logger, error_reporter
+
+dispatcher_logger = create_logger(logger_name="karma_bot")
+
+Command = Callable[[], Awaitable[None]]
+
+
+class CommandDispatcher:
+    """Runs bot commands on a bounded pool of asyncio workers.
+
+    Every worker owns its own queue, and commands are routed to a worker by their key (the submission id). Commands on the same submission are therefore
+    processed one after the other in the order they were submitted, while commands on different submissions run in parallel. The queues are bounded, so when
+    all workers are busy :meth:`submit` waits for a free slot and the stream reader slows down instead of piling up unbounded work.
+
+    """
+
+    def __init__(self, concurrency: int = 8, queue_size: int = 25) -> None:
+        """Creates the dispatcher. Workers are started when entering the async context manager.
+
+        :param concurrency: Number of workers, i.e., how many submissions can be processed in parallel.
+        :param queue_size: Maximum number of pending commands per worker before :meth:`submit` starts waiting.
+
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self._queues: list[asyncio.Queue[Command]] = [asyncio.Queue(maxsize=queue_size) for _ in range(concurrency)]
+        self._workers: list[asyncio.Task[None]] = []
+        self._draining = False
+
+    async def __aenter__(self) -> CommandDispatcher:
+        self._workers = [asyncio.create_task(self._worker(queue), name=f"command-worker-{index}") for index, queue in enumerate(self._queues)]
+        dispatcher_logger.info(f"Started {self.concurrency} command workers with queue size {self.queue_size}")
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        if self._workers:
+            await self.drain()
+
+    @property
+    def depth(self) -> int:
+        """Number of commands waiting to be processed across all workers."""
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def submit(self, key: str, command: Command) -> None:
+        """Queues the command on the worker responsible for the key.
+
+        Waits if that worker's queue is full.
+
+        :param key: Ordering key. Commands sharing a key are processed sequentially in submission order.
+        :param command: Zero argument coroutine function that executes the command.
+
+        :raises RuntimeError: If the dispatcher is draining, since the command could be queued after the workers have stopped.
+
+        :returns: None
+
+        """
+        if self._draining:
+            raise RuntimeError(f"The dispatcher is draining, refusing the command for key {key}")
+
+        queue = self._queues[hash(key) % self.concurrency]
+        if queue.full():
+            dispatcher_logger.warning(f"Command queue for key {key} is full ({self.depth} commands pending). Waiting for a free slot.")
+        await queue.put(command)
+
+    async def join(self) -> None:
+        """Waits until every submitted command has been processed.
+
+        :returns: None
+
+        """
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+
+    async def drain(self, timeout: Optional[float] = None) -> bool:
+        """Waits for the submitted commands to be processed, then stops the workers. New commands are refused from the start of the drain.
+
+        Commands still running or queued when the timeout expires are cancelled, so that a stuck command cannot hold up a shutdown. Queued commands are
+        dropped without running.
+
+        :param timeout: Maximum number of seconds to wait. None waits until every command has been processed.
+
+        :returns: True if every command was processed, False if some were cancelled.
+
+        """
+        self._draining = True
+        try:
+            await asyncio.wait_for(self.join(), timeout=timeout)
+            drained = True
+        except TimeoutError:
+            dispatcher_logger.error(f"Commands not processed within {timeout} seconds, cancelling the running ones and dropping {self.depth} queued ones")
+            drained = False
+            for queue in self._queues:
+                while not queue.empty():
+                    queue.get_nowait()
+                    queue.task_done()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        return drained
+
+    async def _worker(self, queue: asyncio.Queue[Command]) -> None:
+        """Processes the commands from the queue one at a time. Exceptions are reported and do not stop the worker.
+
+        :param queue: The queue owned by this worker.
+
+        :returns: None
+
+        """
+        while True:
+            command = await queue.get()
+            try:
+                await command()
+            except Exception as general_exc:
+                dispatcher_logger.exception("Exception while processing command", exc_info=True)
+                error_reporter.report(exception_name=type(general_exc).__name__, exception_message=str(general_exc), exception_body=format_exc())
+            finally:
+                queue.task_done()
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Optional, Union
+
+# Longest prefix of a body that is searched for a command. Commands are anchored at the start, so the rest of a long comment is never scanned.
+COMMAND_PREFIX_LENGTH = 32
+
+# Every command starts with one of these characters, a backslash escaping a leading sign in markdown, or whitespace stripped before the match
+COMMAND_START_CHARACTERS = frozenset("+-!kKcC\\")
+
+COMMAND_PATTERN = re.compile(r"(?P<plus>\++KARMA|KARMA\++)|(?P<minus>-+KARMA|KARMA-+)|(?P<close>!CLOSE|CLOSE!)", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class KarmaCommand:
+    """+karma or -karma, changing the karma of the parent author by delta."""
+
+    delta: int
+
+
+@dataclass(frozen=True)
+class CloseCommand:
+    """!close, closing the trade of the submission."""
+
+
+Command = Union[KarmaCommand, CloseCommand]
+
+KARMA_PLUS = KarmaCommand(delta=1)
+KARMA_MINUS = KarmaCommand(delta=-1)
+CLOSE = CloseCommand()
+
+
+def parse_command(body: str) -> Optional[Command]:
+    """Finds the command at the start of a comment body.
+
+    The body is matched like ``body.strip().replace("\\", "")`` against the +karma, -karma and !close patterns, but with one combined match on the first
+    COMMAND_PREFIX_LENGTH characters. Bodies whose first character cannot start a command are rejected without running the pattern.
+
+    :param body: Markdown body of the comment.
+
+    :returns: The command, or None if the body doesn't start with a command.
+
+    """
+    if not body:
+        return None
+    if body[0] not in COMMAND_START_CHARACTERS:
+        if not body[0].isspace():
+            return None
+        body = body.lstrip()
+        if not body or body[0] not in COMMAND_START_CHARACTERS:
+            return None
+
+    match = COMMAND_PATTERN.match(body[:COMMAND_PREFIX_LENGTH].replace("\\", ""))
+    if match is None:
+        return None
+    elif match.lastgroup == "plus":
+        return KARMA_PLUS
+    elif match.lastgroup == "minus":
+        return KARMA_MINUS
+    else:
+        return CLOSE
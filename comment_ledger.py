@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+from collections import OrderedDict
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import PyMongoError
+
+from command_dispatcher import Command, CommandDispatcher
+from db_operations import claim_comment, complete_comment, find_unfinished_claims, karma_log_buffer, release_comment
+from utils import create_logger
+
+ledger_logger = create_logger(logger_name="karma_bot")
+
+
+class ProcessedCommentLedger:
+    """Makes sure the command in a comment is processed once it has been seen, and only once.
+
+    Comments can be delivered again by the catch-up after a restart, by a stream restart after an error, or to another running instance. Recently claimed
+    comment ids are kept in a bounded LRU so repeats are rejected without a database call. Everything else is claimed in the processed_comments collection,
+    whose unique _id rejects comments that have been claimed before.
+
+    A claim is only final once its command has completed. Commands that fail or are cancelled release their claim, and the claims of commands lost in a
+    crash run out after a lease, so that :meth:`unfinished_comments` hands them out to be tried again. On shutdown, :meth:`wait_for_submissions` and
+    :meth:`release_unfinished` make sure that no claim of a command that never ran is left behind.
+
+    A retried command relies on the karma log to tell whether its karma has already been changed, so the karma log buffer is flushed before a claim is
+    completed or released. If the karma logs can't be inserted, the claim is left to run out after its lease instead, while the buffer keeps retrying them.
+
+    """
+
+    def __init__(self, karma_db: AsyncIOMotorDatabase, capacity: int = 10_000) -> None:
+        """Creates the ledger with an empty LRU.
+
+        :param karma_db: MongoDB database used to get the collections
+        :param capacity: Maximum number of comment ids kept in memory.
+
+        """
+        self.karma_db = karma_db
+        self.capacity = capacity
+        self._recent: OrderedDict[str, None] = OrderedDict()
+        # Claimed by this process and neither completed nor released
+        self._unfinished: set[str] = set()
+        self._submissions: set[asyncio.Task[bool]] = set()
+
+    def _remember(self, comment_id: str) -> None:
+        self._recent[comment_id] = None
+        self._recent.move_to_end(comment_id)
+        if len(self._recent) > self.capacity:
+            self._recent.popitem(last=False)
+
+    async def claim(self, comment_id: str) -> bool:
+        """Claims the comment for processing.
+
+        :param comment_id: The id of the comment that triggered the command.
+
+        :returns: True if the comment should be processed, False if it has already been claimed.
+
+        """
+        if comment_id in self._recent:
+            self._recent.move_to_end(comment_id)
+            ledger_logger.info(f"Skipping comment {comment_id}, it has already been processed")
+            return False
+
+        claimed = await claim_comment(comment_id, self.karma_db)
+        self._remember(comment_id)
+        if claimed:
+            self._unfinished.add(comment_id)
+        else:
+            ledger_logger.info(f"Skipping comment {comment_id}, it has already been claimed in the database")
+        return claimed
+
+    async def _karma_logs_inserted(self, comment_id: str) -> bool:
+        if await karma_log_buffer.flush():
+            return True
+        self._unfinished.discard(comment_id)
+        ledger_logger.error(f"The karma logs could not be inserted, leaving the claim of {comment_id} to run out after its lease")
+        return False
+
+    async def complete(self, comment_id: str) -> None:
+        """Records that the command of the comment has been processed, once the karma logs of the command have been inserted.
+
+        :param comment_id: The id of the comment that triggered the command.
+
+        :returns: None
+
+        """
+        if not await self._karma_logs_inserted(comment_id):
+            return
+        await complete_comment(comment_id, self.karma_db)
+        self._unfinished.discard(comment_id)
+
+    async def release(self, comment_id: str) -> None:
+        """Gives up the claim of a command that failed or was never run, so that it can be claimed again.
+
+        :param comment_id: The id of the comment that triggered the command.
+
+        :returns: None
+
+        """
+        if not await self._karma_logs_inserted(comment_id):
+            return
+        self._recent.pop(comment_id, None)
+        self._unfinished.discard(comment_id)
+        try:
+            await release_comment(comment_id, self.karma_db)
+        except PyMongoError:
+            ledger_logger.error(f"Failed to release the claim of {comment_id}, it can be claimed again once its lease runs out", exc_info=True)
+
+    async def wait_for_submissions(self, timeout: Optional[float] = None) -> None:
+        """Waits for the claims and submissions that are still running, e.g., those of a stream cancelled on shutdown, to hand their commands over.
+
+        Submissions that are still waiting for a free slot on the dispatcher when the timeout expires are cancelled and release their claim.
+
+        :param timeout: Maximum number of seconds to wait. None waits until every submission is done.
+
+        :returns: None
+
+        """
+        if not self._submissions:
+            return
+
+        _, pending = await asyncio.wait(self._submissions, timeout=timeout)
+        for submission in pending:
+            submission.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            ledger_logger.error(f"Cancelled {len(pending)} submissions that were still waiting for the dispatcher after {timeout} seconds")
+
+    async def release_unfinished(self) -> int:
+        """Releases the claims of the commands that were claimed by this process but never ran, e.g., those still queued when a drain timed out.
+
+        :returns: Number of claims released.
+
+        """
+        unfinished = list(self._unfinished)
+        await asyncio.gather(*(self.release(comment_id) for comment_id in unfinished))
+        return len(unfinished)
+
+    async def unfinished_comments(self) -> list[str]:
+        """Returns the ids of the comments whose commands were claimed but not completed, e.g., because the bot crashed while processing them.
+
+        Inbox items are claimed by fullname and left out, they stay unread until their command completes and come back with the inbox.
+
+        :returns: Ids of the comments, without those claimed by this process.
+
+        """
+        return [comment_id for comment_id in await find_unfinished_claims(self.karma_db) if "_" not in comment_id and comment_id not in self._recent]
+
+    async def submit_once(self, comment_id: str, dispatcher: CommandDispatcher, key: str, command: Command) -> bool:
+        """Claims the comment and queues its command on the dispatcher if the claim succeeds.
+
+        The claim and the submission run in a task that is shielded from cancellation, so a stream cancelled on shutdown never leaves a comment claimed
+        without its command queued. The task is tracked until it is done, see :meth:`wait_for_submissions`. The claim is completed once the command has run,
+        and released if the command raises or is cancelled, or if the dispatcher refuses the command because it is draining.
+
+        :param comment_id: The id of the comment that triggered the command.
+        :param dispatcher: CommandDispatcher that executes the command
+        :param key: Ordering key of the command on the dispatcher.
+        :param command: Zero argument coroutine function that executes the command.
+
+        :returns: True if the command has been queued, False if the comment has already been claimed.
+
+        """
+
+        async def run_and_record() -> None:
+            try:
+                await command()
+            except BaseException:
+                await asyncio.shield(self.release(comment_id))
+                raise
+            await self.complete(comment_id)
+
+        async def claim_and_submit() -> bool:
+            if not await self.claim(comment_id):
+                return False
+            try:
+                await dispatcher.submit(key, run_and_record)
+            except BaseException:
+                await self.release(comment_id)
+                raise
+            return True
+
+        submission = asyncio.create_task(claim_and_submit(), name=f"submit-{comment_id}")
+        self._submissions.add(submission)
+        submission.add_done_callback(self._submissions.discard)
+        return await asyncio.shield(submission)
@@ -2,10 +2,12 @@ from __future__ import annotations
 
 import re
 from enum import IntEnum, auto
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 
-import yaml
-from asyncpraw.models import Comment, Redditor, Submission, Subreddit
+from asyncpraw.models import Redditor, Subreddit
+
+from command_context import CommandContext, ThreadSnapshot
+from rosters import courier_roster, moderator_cache
 
 
 class CloseChecks(IntEnum):
@@ -26,147 +28,96 @@ class KarmaChecks(IntEnum):
     UNAUTHORIZED = auto()
 
 
-def is_removed_or_deleted(content: Comment | Submission) -> bool:
-    """Checks if comment, parent comment or submission has been removed/deleted.
-
-    If it is deleted, the author is None. If it is removed, the removed_by will have moderator name.
-
-    :param content: Reddit's comment or submission
-
-    :returns: True if the items is deleted or removed. Otherwise, False.
-
-    """
-    return content.author is None or content.mod_note or content.removed
-
-
-async def is_mod(user: Redditor, subreddit: Subreddit) -> bool:
+async def is_mod(user: Optional[Redditor], subreddit: Subreddit) -> bool:
     """Checks if the author is a moderator.
 
+    The moderator list is served from the shared moderator cache, so this usually doesn't make any API calls.
+
     :param user: The Reddit user whose moderator status will be checked.
     :param subreddit: The subreddit where the user's moderator status will be checked.
 
     :returns: True if the user is a moderator, otherwise False.
 
     """
-    moderators_list = await subreddit.moderator()
-    return user in moderators_list
-
-
-async def is_courier(author: Optional[Redditor], subreddit: Subreddit) -> bool:
-    """Checks if the author is a courier.
-
-    :param author: The Redditor to be checked.
-    :param subreddit: The subreddit where the user's courier status will be checked.
-
-    :returns: True if the user is a courier, otherwise False.
-
-    """
-    if author is None:
+    if user is None:
         return False
 
-    wiki = await subreddit.wiki.get_page("custom_bot_config/courier_list")
-    yaml_format = yaml.safe_load(wiki.content_md)
-    courier_list = (x.lower() for x in yaml_format["couriers"])
-    return author.name.lower() in courier_list
+    return await moderator_cache.contains(user.name, subreddit)
 
 
-async def is_mod_or_courier(author: Optional[Redditor], subreddit: Subreddit) -> bool:
-    """Checks if the author is a moderator or a courier.
+async def privileged_users(subreddit: Subreddit) -> frozenset[str]:
+    """Returns the lowercase names of the moderators and couriers.
 
-    :param author: The Redditor to be checked.
-    :param subreddit: The subreddit where the user's moderator/courier status will be checked.
+    :param subreddit: The subreddit whose moderators and couriers are returned.
 
-    :returns: True if the user is a moderator or a courier, otherwise False.
+    :returns: Frozenset of lowercase usernames.
 
     """
-    return await is_mod(author, subreddit) or await is_courier(author, subreddit)
+    return await moderator_cache.get(subreddit) | await courier_roster.get(subreddit)
 
 
 SUBMISSION_FLAIR_REGEX = re.compile("^(XBOX|PlayStation|PC)$", re.IGNORECASE)
 
 
-async def flair_checks(comment: Comment) -> bool:
+def flair_checks(thread: ThreadSnapshot) -> bool:
     """Checks if submission is eligible for trading by checking the flair.
 
-    The karma can only be exchanged under the submission with flair XBOX, PlayStation, or PC. :param comment: praw Comment that triggered the command.
+    The karma can only be exchanged under the submission with flair XBOX, PlayStation, or PC. :param thread: ThreadSnapshot of the command comment.
 
     """
-    submission = comment.submission
-    await submission.load()
-    submission_flair_text = "" if submission.link_flair_text is None else submission.link_flair_text
-    match = SUBMISSION_FLAIR_REGEX.match(submission_flair_text)
+    match = SUBMISSION_FLAIR_REGEX.match(thread.submission_flair)
     if match is None:
         return False
     else:
         return True
 
 
-async def checks_for_close_command(comment: Comment) -> CloseChecks:
+def evaluate_close_checks(thread: ThreadSnapshot) -> CloseChecks:
     """Performs checks to determine if the submission can be closed.
 
-    :param comment: The comment object that triggered the command.
+    :param thread: ThreadSnapshot of the comment that triggered the command.
 
     :returns: A CloseChecks enum value indicating the result of the checks.
 
     """
-    await comment.load()
-    submission = comment.submission
-    await submission.load()
-
     # Only OP can close the trade
-    if comment.author != submission.author:
+    if thread.comment.author != thread.submission.author:
         return CloseChecks.NOT_OP
 
-    if await flair_checks(comment):
+    if flair_checks(thread):
         return CloseChecks.CLOSE_CHECKS_PASSED
     else:
         return CloseChecks.NOT_TRADING_SUBMISSION
 
 
-async def checks_for_karma_command(comment: Comment, fo76_subreddit: Subreddit) -> KarmaChecks:
-    """Performs checks for karma command comments.
+def evaluate_karma_checks(thread: ThreadSnapshot, privileged: frozenset[str]) -> KarmaChecks:
+    """Performs checks for karma command comments. Doesn't make any API calls.
 
-    :param comment: the command comment.
-    :param fo76_subreddit: SubredditHelper Subreddit object to make API calls related to subreddit.
+    :param thread: ThreadSnapshot of the command comment.
+    :param privileged: Lowercase names of the moderators and couriers, who don't count towards the users involved.
 
     :returns: A KarmaChecks enum value indicating the result of the checks.
 
     """
-    if not await flair_checks(comment):
+    if not flair_checks(thread):
         return KarmaChecks.INCORRECT_SUBMISSION_TYPE
 
     # Make sure author isn't rewarding themselves
-    parent_post = await comment.parent()
-    await parent_post.load()
-    if comment.author == parent_post.author:
+    if thread.comment.author == thread.parent.author:
         return KarmaChecks.CANNOT_REWARD_YOURSELF
 
-    comment_thread = []  # Stores all comments in an array
-    users_involved = set()  # Stores all the users involved
-    comment_thread.append(comment)
-    users_involved.add(comment.author)
-
-    # If the karma comment is not root meaning it ha a parent comment
-    if not comment.is_root:
-        parent_comment = await comment.parent()
-        await parent_comment.load()
-        comment_thread.append(parent_comment)
-        users_involved.add(parent_comment.author)
+    # If the karma comment is not root meaning it has a parent comment
+    comment_thread = [thread.comment] if thread.is_root else [thread.comment, thread.parent]
+    comment_thread.append(thread.submission)
 
-    comment_thread.append(comment.submission)
-    users_involved.add(comment.submission.author)
-
-    # Remove mods and couriers from the users involved
-    for user in users_involved.copy():
-        if await is_mod_or_courier(user, fo76_subreddit):
-            users_involved.remove(user)
+    # Deleted posts have no author and are kept as None. Mods and couriers are removed from the users involved.
+    users_involved = {None if content.author is None else content.author.lower() for content in comment_thread} - privileged
 
     # If the conversation is shorter than two comments
     if len(comment_thread) <= 2:
         return KarmaChecks.CONVERSATION_NOT_LONG_ENOUGH
 
-    removed_or_deleted = any([is_removed_or_deleted(content) for content in comment_thread])
-    if removed_or_deleted:
+    if any(content.is_removed_or_deleted for content in comment_thread):
         return KarmaChecks.DELETED_OR_REMOVED
 
     # If there are more than two people involved
@@ -175,3 +126,56 @@ async def checks_for_karma_command(comment: Comment, fo76_subreddit: Subreddit)
 
     # If all checks pass
     return KarmaChecks.KARMA_CHECKS_PASSED
+
+
+async def checks_for_close_command(context: CommandContext) -> CloseChecks:
+    """Performs checks to determine if the submission can be closed.
+
+    :param context: CommandContext of the comment that triggered the command.
+
+    :returns: A CloseChecks enum value indicating the result of the checks.
+
+    """
+    return evaluate_close_checks(await context.thread())
+
+
+async def checks_for_karma_command(
+    karma_change: int,
+    is_user_mod: bool,
+    thread: Callable[[], Awaitable[ThreadSnapshot]],
+    privileged: Callable[[], Awaitable[frozenset[str]]],
+    find_reward: Callable[[str], Awaitable[Optional[str]]],
+    reserve_daily_karma: Callable[[], Awaitable[bool]],
+) -> tuple[KarmaChecks, str]:
+    """Applies the rules of the karma command in order. The state a rule depends on is only looked up once the rules before it have passed.
+
+    The lookups are passed in, so the bot can make them against Reddit and the database while replay.py keeps the state in memory. Moderators skip every
+    rule except the one about a deleted parent.
+
+    :param karma_change: +1 or -1.
+    :param is_user_mod: Whether the author of the command is a moderator.
+    :param thread: Returns the ThreadSnapshot of the command comment.
+    :param privileged: Returns the lowercase names of the moderators and couriers.
+    :param find_reward: Returns the permalink of the karma the author has already given to the given user on the submission, or None.
+    :param reserve_daily_karma: Counts the karma towards the daily limit of the author. Returns False if the limit has been reached.
+
+    :returns: A KarmaChecks enum value indicating the result of the checks, and the permalink of the earlier karma if it is ALREADY_REWARDED.
+
+    """
+    if is_user_mod:
+        karma_checks = KarmaChecks.DELETED_OR_REMOVED if (await thread()).parent.author is None else KarmaChecks.KARMA_CHECKS_PASSED
+        return karma_checks, ""
+    if karma_change == -1:
+        return KarmaChecks.UNAUTHORIZED, ""
+
+    snapshot = await thread()
+    karma_checks = evaluate_karma_checks(snapshot, await privileged())
+    if karma_checks != KarmaChecks.KARMA_CHECKS_PASSED or snapshot.parent.author is None:
+        return karma_checks, ""
+
+    permalink = await find_reward(snapshot.parent.author)
+    if permalink is not None:
+        return KarmaChecks.ALREADY_REWARDED, permalink
+    if not await reserve_daily_karma():
+        return KarmaChecks.KARMA_AWARDING_LIMIT_REACHED, ""
+    return KarmaChecks.KARMA_CHECKS_PASSED, ""
@@ -1,16 +1,306 @@
 from __future__ import annotations
 
-from typing import Any, Mapping
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from types import TracebackType
+from typing import Any, AsyncGenerator, Mapping, Optional, Sequence
 
-from asyncpraw.models import Comment
+from asyncpraw.models import Comment, Message
 from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
-from pymongo import ReturnDocument
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.collation import Collation, CollationStrength
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 
 from conversation_checks import KarmaChecks
 from utils import Connections, create_logger, next_midnight_timestamp
 
 db_operations_logs = create_logger("karma_bot")
 
+# A claimed command that has neither completed nor been released within the lease is considered crashed and can be claimed again
+CLAIM_LEASE = timedelta(minutes=10)
+# Number of times a command is tried before its claim is left alone until it expires
+MAX_CLAIM_ATTEMPTS = 3
+
+# Reddit usernames are case-insensitive, but profiles are keyed by the spelling on Reddit. Names typed by a moderator are matched with this collation.
+USERNAME_COLLATION = Collation(locale="en", strength=CollationStrength.SECONDARY)
+
+# Fields of a new user profile, except karma which is either set or incremented by the upsert
+NEW_PROFILE_DEFAULTS: dict[str, Any] = {"gamertags": [], "m76_karma": 0}
+
+# Indexes backing the queries below, keyed by collection name
+INDEXES: dict[str, list[IndexModel]] = {
+    "karma_logs": [
+        # check_already_rewarded
+        IndexModel([("from_user", ASCENDING), ("to_user", ASCENDING), ("submission_id", ASCENDING)], name="from_user_to_user_submission_id"),
+        # is_karma_logged
+        IndexModel([("comment_permalink", ASCENDING)], name="comment_permalink"),
+    ],
+    "daily_given_karma": [
+        # reserve_daily_karma and release_daily_karma
+        IndexModel([("from_user", ASCENDING), ("day", ASCENDING)], name="from_user_day_unique", unique=True),
+        # Counters are removed a day after their day has ended
+        IndexModel([("expire_at", ASCENDING)], name="expire_at_ttl", expireAfterSeconds=0),
+    ],
+    "processed_comments": [
+        # claim_comment relies on the unique _id index. Claims are kept for 30 days, long after any retry or catch-up could deliver the comment again.
+        IndexModel([("claimed_at", ASCENDING)], name="claimed_at_ttl", expireAfterSeconds=30 * 86400),
+        # find_unfinished_claims
+        IndexModel([("completed", ASCENDING), ("lease_until", ASCENDING)], name="completed_lease_until"),
+    ],
+    "user_karma": [
+        # increment_user_karma. Duplicate profiles from before the index are merged by ensure_indexes before it is built.
+        IndexModel([("reddit_username", ASCENDING)], name="reddit_username_unique", unique=True),
+        # find_user_profiles
+        IndexModel([("reddit_username", ASCENDING)], name="reddit_username_case_insensitive", collation=USERNAME_COLLATION),
+    ],
+}
+
+# A sample of every query on the hot path with the collection it runs on. Used by check_indexes.py to verify that none of them scans a collection.
+HOT_QUERIES: dict[str, tuple[str, dict[str, Any]]] = {
+    "check_already_rewarded": ("karma_logs", {"from_user": "user_a", "to_user": "user_b", "submission_id": "abc123"}),
+    "reserve_daily_karma": ("daily_given_karma", {"from_user": "user_a", "day": 1700086400.0, "count": {"$lt": 10}}),
+    "find_unfinished_claims": ("processed_comments", {"completed": False, "lease_until": {"$lte": datetime(2023, 11, 16, tzinfo=timezone.utc)}}),
+    "is_karma_logged": ("karma_logs", {"comment_permalink": "/r/Fallout76Marketplace/comments/abc123/_/def456/"}),
+    "user_profile": ("user_karma", {"reddit_username": "user_a"}),
+}
+
+
+class KarmaLogBuffer:
+    """Write-behind buffer for karma log entries.
+
+    Entries are inserted with one unordered ``insert_many`` every ``flush_interval`` seconds, or as soon as ``batch_size`` entries are pending. Entries
+    that are pending or being inserted are visible through :meth:`find_pending`, so :func:`check_already_rewarded` sees an award as soon as it is logged.
+    Entries that fail to insert for any reason other than a duplicate key are kept for the next flush.
+
+    A buffered entry is lost if the bot crashes before it is inserted. Since a logged karma change is how a retried command knows that its karma has
+    already been changed, see :func:`is_karma_logged`, the processed comments ledger flushes the buffer before it completes or releases a claim. A claim
+    is therefore never given up while the karma log of its command only exists in memory.
+
+    """
+
+    def __init__(self, flush_interval: float = 2, batch_size: int = 50) -> None:
+        """Creates the buffer. Entries are inserted directly until the buffer is started by entering the async context manager.
+
+        :param flush_interval: Maximum number of seconds an entry waits before it is inserted.
+        :param batch_size: Number of pending entries that triggers an early flush.
+
+        """
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._collection: Optional[AsyncIOMotorCollection] = None
+        self._pending: list[dict[str, Any]] = []
+        self._in_flight: list[dict[str, Any]] = []
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task[None]] = None
+
+    async def __aenter__(self) -> KarmaLogBuffer:
+        self._flusher = asyncio.create_task(self._flush_periodically(), name="karma-log-buffer")
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+        if self._pending:
+            db_operations_logs.error(f"Could not insert {len(self._pending)} karma log entries on shutdown: {self._pending}")
+
+    @property
+    def pending(self) -> int:
+        """Number of entries waiting to be inserted."""
+        return len(self._pending) + len(self._in_flight)
+
+    async def add(self, karma_logs_collection: AsyncIOMotorCollection, karma_log: dict[str, Any]) -> None:
+        """Queues the entry for insertion.
+
+        :param karma_logs_collection: The karma_logs collection.
+        :param karma_log: The entry to insert.
+
+        :returns: None
+
+        """
+        if self._flusher is None:
+            await karma_logs_collection.insert_one(karma_log)
+            return
+
+        self._collection = karma_logs_collection
+        self._pending.append(karma_log)
+        if len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+
+    def find_pending(self, query: Mapping[str, Any]) -> Optional[dict[str, Any]]:
+        """Returns the first entry not yet inserted whose fields are equal to the query.
+
+        :param query: Field values to match. Only equality is supported.
+
+        :returns: The matching entry or None.
+
+        """
+        for karma_log in (*self._in_flight, *self._pending):
+            if all(karma_log.get(field) == value for field, value in query.items()):
+                return karma_log
+        return None
+
+    async def flush(self) -> bool:
+        """Inserts all pending entries. Entries queued during a flush that is already running are inserted after it.
+
+        :returns: True if every entry queued before the call has been inserted, False if some are still pending.
+
+        """
+        async with self._flush_lock:
+            if not self._pending or self._collection is None:
+                return True
+
+            self._in_flight, self._pending = self._pending, []
+            try:
+                await self._collection.insert_many(self._in_flight, ordered=False)
+            except BulkWriteError as bulk_exc:
+                # Duplicates were inserted by an earlier attempt of a flush that failed midway
+                failed_indexes = {error["index"] for error in bulk_exc.details["writeErrors"] if error["code"] != 11000}
+                self._pending[:0] = [self._in_flight[index] for index in sorted(failed_indexes)]
+                db_operations_logs.error(f"Failed to insert {len(failed_indexes)} of {len(self._in_flight)} karma log entries", exc_info=True)
+                return not failed_indexes
+            except PyMongoError:
+                self._pending[:0] = self._in_flight
+                db_operations_logs.error(f"Failed to insert {len(self._in_flight)} karma log entries, retrying in the next flush", exc_info=True)
+                return False
+            else:
+                db_operations_logs.info(f"Inserted {len(self._in_flight)} karma log entries")
+                return True
+            finally:
+                self._in_flight = []
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
+
+
+karma_log_buffer = KarmaLogBuffer()
+
+
+class ProfileCache:
+    """Bounded LRU cache of user_karma profiles keyed by reddit_username.
+
+    Profiles returned by the bot's own writes are stored as they are (write-through). Changes made by anything else, e.g., tools that edit gamertags or
+    m76_karma, are picked up from a change stream on user_karma while :meth:`watching` is active. Without a running change stream nothing is cached,
+    because cached profiles could go stale without notice.
+
+    """
+
+    def __init__(self, capacity: int = 5_000) -> None:
+        """Creates an empty cache.
+
+        :param capacity: Maximum number of profiles kept in memory.
+
+        """
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._profiles: OrderedDict[str, Mapping[str, Any]] = OrderedDict()
+        self._usernames_by_id: dict[Any, str] = {}
+        self._enabled = False
+
+    def get(self, reddit_username: str) -> Optional[Mapping[str, Any]]:
+        """Returns the cached profile of the user and counts the hit or miss.
+
+        :param reddit_username: The user whose profile is returned.
+
+        :returns: The cached profile or None.
+
+        """
+        profile = self._profiles.get(reddit_username)
+        if profile is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._profiles.move_to_end(reddit_username)
+        return profile
+
+    def put(self, profile: Mapping[str, Any]) -> None:
+        """Stores the latest version of the profile.
+
+        :param profile: The profile as returned by the database.
+
+        :returns: None
+
+        """
+        if not self._enabled:
+            return
+
+        reddit_username = profile["reddit_username"]
+        self._profiles[reddit_username] = profile
+        self._profiles.move_to_end(reddit_username)
+        self._usernames_by_id[profile["_id"]] = reddit_username
+        if len(self._profiles) > self.capacity:
+            _, evicted = self._profiles.popitem(last=False)
+            self._usernames_by_id.pop(evicted["_id"], None)
+
+    def invalidate(self, document_id: Any) -> None:
+        """Removes the profile with the given _id from the cache.
+
+        :param document_id: The _id of the profile.
+
+        :returns: None
+
+        """
+        reddit_username = self._usernames_by_id.pop(document_id, None)
+        if reddit_username is not None:
+            self._profiles.pop(reddit_username, None)
+
+    @asynccontextmanager
+    async def watching(self, karma_db: AsyncIOMotorDatabase) -> AsyncGenerator[ProfileCache, None]:
+        """Enables the cache while following the change stream of user_karma.
+
+        Updated profiles that are cached are replaced by the full document from the change stream, and deleted ones are removed. If the change stream
+        stops, the cache is cleared and disabled.
+
+        :param karma_db: MongoDB database used to get the collections
+
+        :returns: The cache itself.
+
+        """
+        users_collection = await get_mongo_collection(collection_name="user_karma", fallout76marketplace_karma_db=karma_db)
+        watcher = asyncio.create_task(self._follow_changes(users_collection), name="profile-cache-watcher")
+        try:
+            yield self
+        finally:
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+            db_operations_logs.info(f"Profile cache: {self.hits} hits, {self.misses} misses")
+
+    async def _follow_changes(self, users_collection: AsyncIOMotorCollection) -> None:
+        try:
+            async with users_collection.watch(full_document="updateLookup") as change_stream:
+                self._enabled = True
+                async for change in change_stream:
+                    document_id = change["documentKey"]["_id"]
+                    if document_id not in self._usernames_by_id:
+                        continue
+                    full_document = change.get("fullDocument")
+                    if change["operationType"] in ("update", "replace") and full_document is not None:
+                        self.put(full_document)
+                    else:
+                        self.invalidate(document_id)
+        except PyMongoError:
+            db_operations_logs.error("The user_karma change stream stopped, disabling the profile cache", exc_info=True)
+        finally:
+            self._enabled = False
+            self._profiles.clear()
+            self._usernames_by_id.clear()
+
+
+profile_cache = ProfileCache()
+
 
 async def get_mongo_collection(collection_name: str, fallout76marketplace_karma_db: AsyncIOMotorDatabase) -> AsyncIOMotorCollection:
     """Returns the user databased from dataBased Cluster from MongoDB
@@ -21,29 +311,118 @@ async def get_mongo_collection(collection_name: str, fallout76marketplace_karma_
     return fallout76marketplace_karma_db[collection_name]
 
 
-async def find_or_create_user_profile(reddit_username: str, users_collection: AsyncIOMotorCollection) -> Mapping[str, Any]:
-    """Finds the user in the users_collection, or creates one if it doesn't exist using default values.
+async def merge_duplicate_profiles(users_collection: AsyncIOMotorCollection) -> int:
+    """Merges the profiles that share a reddit_username into the oldest one, which keeps the sum of their karma and all of their gamertags.
+
+    Before reddit_username_unique existed, concurrent first commands for a user could create two profiles, and the unique index cannot be built while
+    they exist.
 
-    :param reddit_username: The user whose profile to find or create
-    :param users_collection: The collection in which the profile will be searched or inserted
+    :param users_collection: The user_karma collection.
 
-    :returns: Dict object with user profile info
+    :returns: Number of duplicate profiles merged and deleted.
 
     """
-    profile = await users_collection.find_one({"reddit_username": reddit_username})
-    if profile is None:
-        profile = await users_collection.find_one_and_update(
-            {"reddit_username": reddit_username},
-            {
-                "$setOnInsert": {
-                    "gamertags": [],
-                    "karma": 0,
-                    "m76_karma": 0,
-                },
-            },
-            upsert=True,
-            return_document=ReturnDocument.AFTER,
-        )
+    pipeline: list[dict[str, Any]] = [
+        {"$group": {"_id": "$reddit_username", "ids": {"$push": "$_id"}, "profiles": {"$sum": 1}}},
+        {"$match": {"profiles": {"$gt": 1}}},
+    ]
+    merged = 0
+    async for duplicate in users_collection.aggregate(pipeline, allowDiskUse=True):
+        profiles = [profile async for profile in users_collection.find({"_id": {"$in": duplicate["ids"]}}).sort("_id", ASCENDING)]
+        kept, others = profiles[0], profiles[1:]
+        gamertags = list(kept.get("gamertags", []))
+        for profile in others:
+            gamertags.extend(gamertag for gamertag in profile.get("gamertags", []) if gamertag not in gamertags)
+        merged_fields = {
+            "karma": sum(profile.get("karma", 0) for profile in profiles),
+            "m76_karma": sum(profile.get("m76_karma", 0) for profile in profiles),
+            "gamertags": gamertags,
+        }
+        await users_collection.update_one({"_id": kept["_id"]}, {"$set": merged_fields})
+        await users_collection.delete_many({"_id": {"$in": [profile["_id"] for profile in others]}})
+        db_operations_logs.warning(f"Merged {len(others)} duplicate profiles of u/{duplicate['_id']} into {kept['_id']}: {merged_fields}")
+        merged += len(others)
+    return merged
+
+
+async def ensure_indexes(karma_db: AsyncIOMotorDatabase) -> None:
+    """Creates the indexes the bot relies on. Indexes that already exist are left untouched, so this is safe to call on every start.
+
+    Creating reddit_username_unique migrates user_karma: if it fails on duplicate usernames, the duplicates are merged by
+    :func:`merge_duplicate_profiles` and the index is created again. An index that still cannot be created, e.g., because an index on the same keys
+    exists under another name, is logged and skipped so that the bot still starts. The queries it backs keep working, only slower or without the
+    uniqueness guarantee, until the conflicting index is dropped by hand and the bot restarted.
+
+    :param karma_db: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    for collection_name, indexes in INDEXES.items():
+        collection = await get_mongo_collection(collection_name=collection_name, fallout76marketplace_karma_db=karma_db)
+        created: list[str] = []
+        for index in indexes:
+            try:
+                try:
+                    created += await collection.create_indexes([index])
+                except DuplicateKeyError:
+                    if collection_name != "user_karma":
+                        raise
+                    merged = await merge_duplicate_profiles(collection)
+                    db_operations_logs.warning(f"Merged {merged} duplicate profiles to create the index {index.document['name']}")
+                    created += await collection.create_indexes([index])
+            except OperationFailure:
+                db_operations_logs.error(f"Could not create the index {index.document['name']} on {collection_name}, skipping it", exc_info=True)
+        db_operations_logs.info(f"Ensured indexes on {collection_name}: {', '.join(created)}")
+
+
+async def find_user_profiles(usernames: Sequence[str], users_collection: AsyncIOMotorCollection) -> dict[str, Mapping[str, Any]]:
+    """Finds the profiles of the users. Cached profiles are returned without a database call, the others are fetched with one query and cached.
+
+    The usernames don't have to be spelled with the case used on Reddit. Only exact spellings are found in the cache, the others are matched by the
+    database with USERNAME_COLLATION.
+
+    :param usernames: The users whose profiles to find, e.g., as typed by a moderator.
+    :param users_collection: The user_karma collection.
+
+    :returns: The profiles keyed by lowercase username. Users without a profile are left out.
+
+    """
+    profiles: dict[str, Mapping[str, Any]] = {}
+    uncached: list[str] = []
+    for username in usernames:
+        cached_profile = profile_cache.get(username)
+        if cached_profile is None:
+            uncached.append(username)
+        else:
+            profiles[username.lower()] = cached_profile
+
+    if uncached:
+        async for profile in users_collection.find({"reddit_username": {"$in": uncached}}, collation=USERNAME_COLLATION):
+            profile_cache.put(profile)
+            profiles[profile["reddit_username"].lower()] = profile
+    return profiles
+
+
+async def increment_user_karma(reddit_username: str, karma_change: int, users_collection: AsyncIOMotorCollection) -> Mapping[str, Any]:
+    """Atomically changes the karma of the user by karma_change, creating the profile with default values if it doesn't exist.
+
+    The increment is applied by the database, so concurrent changes to the same user are never lost.
+
+    :param reddit_username: The user whose karma will be changed
+    :param karma_change: The change in karma value. Positive for an increase, negative for a decrease.
+    :param users_collection: The collection in which the profile will be updated or inserted
+
+    :returns: Dict object with user profile info after the change
+
+    """
+    profile: Mapping[str, Any] = await users_collection.find_one_and_update(
+        {"reddit_username": reddit_username},
+        {"$inc": {"karma": karma_change}, "$setOnInsert": NEW_PROFILE_DEFAULTS},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    profile_cache.put(profile)
     return profile
 
 
@@ -58,8 +437,12 @@ async def check_already_rewarded(from_user: str, to_user: str, submission_id: st
     :returns: An instance of KarmaChecks enum indicating the result of the check.
 
     """
-    karma_logs_collection = await get_mongo_collection(collection_name="karma_logs", fallout76marketplace_karma_db=connections.karma_db)
-    karma_log = await karma_logs_collection.find_one({"from_user": from_user, "to_user": to_user, "submission_id": submission_id})
+    query = {"from_user": from_user, "to_user": to_user, "submission_id": submission_id}
+    # Entries still waiting in the write-behind buffer aren't in the collection yet
+    karma_log: Optional[Mapping[str, Any]] = karma_log_buffer.find_pending(query)
+    if karma_log is None:
+        karma_logs_collection = await get_mongo_collection(collection_name="karma_logs", fallout76marketplace_karma_db=connections.karma_db)
+        karma_log = await karma_logs_collection.find_one(query)
     if karma_log is None:
         result = KarmaChecks.KARMA_CHECKS_PASSED
         return result, ""
@@ -68,39 +451,257 @@ async def check_already_rewarded(from_user: str, to_user: str, submission_id: st
         return result, karma_log["comment_permalink"]
 
 
-async def update_karma_logs(from_user: str, to_user: str, comment: Comment, connections: Connections) -> None:
+def karma_log_permalink(comment: Comment | Message) -> str:
+    """Returns the permalink under which the karma changed by the comment or message is logged.
+
+    :param comment: The comment or message that changed the karma.
+
+    :returns: The permalink of the comment, or the URL of the message.
+
+    """
+    if isinstance(comment, Message):
+        return f"https://www.reddit.com/message/messages/{comment.id}"
+    # Comments from the inbox, e.g., username mentions, have a context link instead of a permalink. Using hasattr would raise on the lazy object.
+    if "context" in comment.__dict__:
+        return str(comment.context).split("?", 1)[0]
+    return str(comment.permalink)
+
+
+async def is_karma_logged(comment: Comment | Message, connections: Connections) -> bool:
+    """Checks if the karma change of the comment or message has been logged, i.e., by an earlier attempt of its command that failed afterwards.
+
+    :param comment: The comment or message that changes the karma.
+    :param connections: Connections object containing connections to the database and Reddit API.
+
+    :returns: True if the karma change has already been applied.
+
+    """
+    query = {"comment_permalink": karma_log_permalink(comment)}
+    if karma_log_buffer.find_pending(query) is not None:
+        return True
+    karma_logs_collection = await get_mongo_collection(collection_name="karma_logs", fallout76marketplace_karma_db=connections.karma_db)
+    return await karma_logs_collection.find_one(query, projection={"_id": True}) is not None
+
+
+async def update_karma_logs(from_user: str, to_user: str, karma_change: int, comment: Comment | Message, connections: Connections) -> None:
     """Update karma logs by inserting a dictionary.
 
+    The entry is queued on the karma log buffer, which inserts it with the next batch. Entries logged before karma_change was recorded have no sign, so
+    recompute_karma.py skips the users who have any.
+
     :param from_user: The username of the user who initiated the reward.
     :param to_user: The username of the user who received the reward.
-    :param comment: The comment that initiated the karma action, granting karma points.
+    :param karma_change: The change in karma value. Positive for an increase, negative for a decrease.
+    :param comment: The comment that initiated the karma action, granting karma points. Manual adjustments by the mods can also come from a private
+        message, which has no submission.
     :param connections: Connections object containing connections to the database and Reddit API.
 
     """
-    db_operations_logs.info(f"Inserting karma logs: from_user={from_user}, to_user={to_user}, submission_id={comment.submission.id}, comment_id={comment.id}")
+    submission_id = None if isinstance(comment, Message) else comment.submission.id
+    permalink = karma_log_permalink(comment)
+    db_operations_logs.info(f"Inserting karma logs: from_user={from_user}, to_user={to_user}, submission_id={submission_id}, comment_id={comment.id}")
     karma_logs_collection = await get_mongo_collection(collection_name="karma_logs", fallout76marketplace_karma_db=connections.karma_db)
-    await karma_logs_collection.insert_one(
+    await karma_log_buffer.add(
+        karma_logs_collection,
         {
             "from_user": from_user,
             "to_user": to_user,
-            "submission_id": comment.submission.id,
-            "comment_permalink": comment.permalink,
+            "karma_change": karma_change,
+            "submission_id": submission_id,
+            "comment_permalink": permalink,
             "utc_created": comment.created_utc,
-        }
+        },
     )
 
 
-async def get_daily_given_karma(from_user: str, connections: Connections) -> int:
-    """Retrieve the amount of karma given by a specific user on a daily basis.
+async def reserve_daily_karma(from_user: str, limit: int, created_utc: float, connections: Connections) -> bool:
+    """Counts one more karma given by the user on the day of the command, unless the user has already given limit karma that day.
+
+    The check and the increment are done by a single upsert on the user's counter for the day, so concurrent commands cannot exceed the limit. If the
+    counter is already at the limit, the filter doesn't match and the upsert fails on the unique index. The upsert is tried twice because two concurrent
+    first commands of the day race to insert the counter, and the loser has to increment the counter inserted by the winner.
+
+    :param from_user: The username of the user who is giving karma.
+    :param limit: The maximum amount of karma a user can give per day.
+    :param created_utc: Creation time of the command comment. The karma counts towards that day, even if the command is processed later, e.g., while
+        catching up after a restart.
+    :param connections: Connections object containing connections to the database and Reddit API.
+
+    :returns: True if the karma was counted, False if the user has reached the limit.
+
+    """
+    daily_karma_collection = await get_mongo_collection(collection_name="daily_given_karma", fallout76marketplace_karma_db=connections.karma_db)
+    next_midnight = next_midnight_timestamp(created_utc)
+    for _ in range(2):
+        try:
+            counter = await daily_karma_collection.find_one_and_update(
+                {"from_user": from_user, "day": next_midnight, "count": {"$lt": limit}},
+                {"$inc": {"count": 1}, "$setOnInsert": {"expire_at": datetime.fromtimestamp(next_midnight + 86400, tz=timezone.utc)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            continue
+        db_operations_logs.info(f"{from_user} gave {counter['count']} karma on the day ending at {next_midnight:.0f}.")
+        return True
+
+    db_operations_logs.info(f"{from_user} has reached the daily limit of {limit} karma.")
+    return False
 
-    :param str from_user: The username of the user whose given karma is to be retrieved.
-    :param Connections connections: An object representing connections to databases or APIs.
 
-    :returns: The amount of karma given by the specified user on a daily basis.
+async def release_daily_karma(from_user: str, created_utc: float, connections: Connections) -> None:
+    """Gives back karma counted by :func:`reserve_daily_karma` for a command that failed to award it.
+
+    :param from_user: The username of the user who was giving karma.
+    :param created_utc: Creation time of the command comment, as passed to reserve_daily_karma.
+    :param connections: Connections object containing connections to the database and Reddit API.
+
+    :returns: None
 
     """
-    karma_logs_collection = await get_mongo_collection(collection_name="karma_logs", fallout76marketplace_karma_db=connections.karma_db)
-    next_midnight = next_midnight_timestamp()
-    count = await karma_logs_collection.count_documents({"from_user": from_user, "utc_created": {"$lt": next_midnight, "$gt": next_midnight - 86400}})
-    db_operations_logs.info(f"{from_user} gave {count} karma in past 24 hours.")
-    return count
+    daily_karma_collection = await get_mongo_collection(collection_name="daily_given_karma", fallout76marketplace_karma_db=connections.karma_db)
+    next_midnight = next_midnight_timestamp(created_utc)
+    await daily_karma_collection.update_one({"from_user": from_user, "day": next_midnight, "count": {"$gt": 0}}, {"$inc": {"count": -1}})
+    db_operations_logs.info(f"Gave back 1 karma to the daily limit of {from_user} for the day ending at {next_midnight:.0f}.")
+
+
+async def get_stream_checkpoint(stream_name: str, karma_db: AsyncIOMotorDatabase) -> Optional[Mapping[str, Any]]:
+    """Returns the last saved position of a stream.
+
+    :param stream_name: Name of the stream, e.g., comment_stream.
+    :param karma_db: MongoDB database used to get the collections
+
+    :returns: Dict with the fullname and utc_created of the last processed item, or None if the stream has never been saved.
+
+    """
+    bot_state_collection = await get_mongo_collection(collection_name="bot_state", fallout76marketplace_karma_db=karma_db)
+    checkpoint: Optional[Mapping[str, Any]] = await bot_state_collection.find_one({"_id": stream_name})
+    return checkpoint
+
+
+async def save_stream_checkpoint(stream_name: str, fullname: str, utc_created: float, karma_db: AsyncIOMotorDatabase) -> None:
+    """Saves the position of a stream.
+
+    :param stream_name: Name of the stream, e.g., comment_stream.
+    :param fullname: Fullname of the last processed item.
+    :param utc_created: Creation timestamp of the last processed item.
+    :param karma_db: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    bot_state_collection = await get_mongo_collection(collection_name="bot_state", fallout76marketplace_karma_db=karma_db)
+    await bot_state_collection.update_one({"_id": stream_name}, {"$set": {"fullname": fullname, "utc_created": utc_created}}, upsert=True)
+
+
+def new_claim(comment_id: str, now: datetime) -> dict[str, Any]:
+    """Returns the processed_comments document of a first claim.
+
+    :param comment_id: The id of the comment that triggered the command.
+    :param now: Time of the claim. The claim expires 30 days later.
+
+    :returns: The claim document.
+
+    """
+    return {"_id": comment_id, "claimed_at": now, "completed": False, "attempts": 1, "lease_until": now + CLAIM_LEASE}
+
+
+async def claim_comment(comment_id: str, karma_db: AsyncIOMotorDatabase) -> bool:
+    """Records that the command in the comment is being processed, unless it has been completed or is being processed elsewhere.
+
+    A claim is leased for CLAIM_LEASE. Claims that are released, or whose lease has run out because the process processing them crashed, are claimed
+    again up to MAX_CLAIM_ATTEMPTS times in total. Claims recorded before completion was tracked have no completed field and count as completed.
+
+    :param comment_id: The id of the comment that triggered the command.
+    :param karma_db: MongoDB database used to get the collections
+
+    :returns: True if the comment has been claimed, False if its command has been completed, is being processed, or has failed too often.
+
+    """
+    processed_comments_collection = await get_mongo_collection(collection_name="processed_comments", fallout76marketplace_karma_db=karma_db)
+    now = datetime.now(tz=timezone.utc)
+    try:
+        await processed_comments_collection.insert_one(new_claim(comment_id, now))
+    except DuplicateKeyError:
+        retried_claim = await processed_comments_collection.update_one(
+            {"_id": comment_id, "completed": False, "lease_until": {"$lte": now}, "attempts": {"$lt": MAX_CLAIM_ATTEMPTS}},
+            {"$set": {"lease_until": now + CLAIM_LEASE}, "$inc": {"attempts": 1}},
+        )
+        if retried_claim.modified_count == 0:
+            return False
+        db_operations_logs.info(f"Claimed {comment_id} again, its earlier attempt was released or its lease ran out")
+    return True
+
+
+async def complete_comment(comment_id: str, karma_db: AsyncIOMotorDatabase) -> None:
+    """Records that the command in the comment has been processed, so that it is never claimed again.
+
+    :param comment_id: The id of the comment that triggered the command.
+    :param karma_db: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    processed_comments_collection = await get_mongo_collection(collection_name="processed_comments", fallout76marketplace_karma_db=karma_db)
+    await processed_comments_collection.update_one({"_id": comment_id}, {"$set": {"completed": True}, "$unset": {"lease_until": ""}})
+
+
+async def claim_comments(comment_ids: list[str], karma_db: AsyncIOMotorDatabase) -> list[str]:
+    """Claims many comments with one unordered insert. Comments that have been claimed before are left out, whatever the state of their claim.
+
+    :param comment_ids: The ids of the comments that triggered the commands.
+    :param karma_db: MongoDB database used to get the collections
+
+    :returns: The ids of the comments that have been claimed.
+
+    """
+    processed_comments_collection = await get_mongo_collection(collection_name="processed_comments", fallout76marketplace_karma_db=karma_db)
+    now = datetime.now(tz=timezone.utc)
+    try:
+        await processed_comments_collection.insert_many([new_claim(comment_id, now) for comment_id in comment_ids], ordered=False)
+    except BulkWriteError as bulk_exc:
+        if any(error["code"] != 11000 for error in bulk_exc.details["writeErrors"]):
+            raise
+        duplicates = {error["index"] for error in bulk_exc.details["writeErrors"]}
+        return [comment_id for index, comment_id in enumerate(comment_ids) if index not in duplicates]
+    return comment_ids
+
+
+async def complete_comments(comment_ids: list[str], karma_db: AsyncIOMotorDatabase) -> None:
+    """Records that the commands in the comments have been processed.
+
+    :param comment_ids: The ids of the comments that triggered the commands.
+    :param karma_db: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    processed_comments_collection = await get_mongo_collection(collection_name="processed_comments", fallout76marketplace_karma_db=karma_db)
+    await processed_comments_collection.update_many({"_id": {"$in": comment_ids}}, {"$set": {"completed": True}, "$unset": {"lease_until": ""}})
+
+
+async def release_comment(comment_id: str, karma_db: AsyncIOMotorDatabase) -> None:
+    """Ends the lease of a claim whose command failed or was never run, so that it can be claimed again right away.
+
+    :param comment_id: The id of the comment that triggered the command.
+    :param karma_db: MongoDB database used to get the collections
+
+    :returns: None
+
+    """
+    processed_comments_collection = await get_mongo_collection(collection_name="processed_comments", fallout76marketplace_karma_db=karma_db)
+    await processed_comments_collection.update_one({"_id": comment_id, "completed": False}, {"$set": {"lease_until": datetime.now(tz=timezone.utc)}})
+
+
+async def find_unfinished_claims(karma_db: AsyncIOMotorDatabase, limit: int = 100) -> list[str]:
+    """Returns the claims whose command has neither completed nor is being processed, and that can still be claimed again.
+
+    :param karma_db: MongoDB database used to get the collections
+    :param limit: Maximum number of claims returned.
+
+    :returns: The ids of the claimed comments and inbox items.
+
+    """
+    processed_comments_collection = await get_mongo_collection(collection_name="processed_comments", fallout76marketplace_karma_db=karma_db)
+    query = {"completed": False, "lease_until": {"$lte": datetime.now(tz=timezone.utc)}, "attempts": {"$lt": MAX_CLAIM_ATTEMPTS}}
+    return [claim["_id"] async for claim in processed_comments_collection.find(query, projection={"_id": True}, limit=limit)]
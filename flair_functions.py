@@ -1,6 +1,16 @@
-from asyncpraw.models import Comment, Submission
+from __future__ import annotations
 
-from conversation_checks import is_mod_or_courier
+import asyncio
+from dataclasses import dataclass
+from types import TracebackType
+from typing import Any, Literal, Mapping, Optional, TypedDict
+
+from asyncpraw.models import Subreddit
+
+from backoff import BackoffPolicy
+from command_context import CommandContext
+from conversation_checks import privileged_users
+from request_scheduler import Priority, request_scheduler
 from utils import Connections, create_logger
 
 flair_func_logger = create_logger(logger_name="karma_bot")
@@ -11,10 +21,202 @@ ZERO_TO_FIFTY_FLAIR = "3c680234-4a4d-11eb-8124-0edd2b620987"
 MODS_AND_COURIERS_FLAIR = "51524056-4a4d-11eb-814b-0e7b734c1fd5"
 
 
-async def update_flair(parent_post: Comment | Submission, user_flair: str, karma: int, connections: Connections) -> None:
+class GamerTag(TypedDict):
+    """A dictionary representing a gamer tag."""
+
+    username: str
+    platform: Literal["PC", "XBOX", "PlayStation"]
+    user_id: int
+
+
+def build_user_flair(profile: Mapping[str, Any], is_user_courier: bool) -> str:
+    """Reconstructs the user flair text from their profile on db.
+
+    :param profile: The user profile from the user_karma collection.
+    :param is_user_courier: Whether the user is a verified courier.
+
+    :returns: The flair text, e.g., ":pc: :xbox: Karma: 12".
+
+    """
+    gamertags: list[GamerTag] = profile["gamertags"]
+    # One emoji per platform in the order the gamertags were added, so the same profile always gives the same text
+    platforms_emojis = dict.fromkeys(f":{gamertag['platform'].lower()}:" for gamertag in gamertags)
+    flair_label = "Verified Courier" if is_user_courier else "Karma"
+    return f"{' '.join(platforms_emojis).strip()} {flair_label}: {profile['karma'] + profile['m76_karma']}"
+
+
+def flair_template_for(karma: int, is_user_mod_or_courier: bool) -> str:
+    """Returns the flair template matching the user's karma value and mod/courier status.
+
+    :param karma: User karma value
+    :param is_user_mod_or_courier: Whether the user is a moderator or a verified courier.
+
+    :returns: The flair template id.
+
+    """
+    # If user is mod assigns the green flair
+    if is_user_mod_or_courier:
+        return MODS_AND_COURIERS_FLAIR
+    elif karma < 49:
+        return ZERO_TO_FIFTY_FLAIR
+    elif 50 <= karma < 99:
+        return FIFTY_TO_HUNDRED_FLAIR
+    else:
+        return ABOVE_HUNDRED_FLAIR
+
+
+@dataclass
+class PendingFlair:
+    subreddit: Subreddit
+    username: str
+    text: str
+    flair_template_id: str
+    attempts: int = 0
+
+
+class FlairWriter:
+    """Coalesces user flair writes and flushes them in batches.
+
+    Only the latest flair of each user is kept, so a user whose karma changes several times between two flushes is flaired once. The pending flairs are
+    written every ``flush_interval`` seconds, or as soon as ``batch_size`` users are pending. Reddit's bulk flair endpoint (``/api/flaircsv``) cannot set a
+    flair template, which decides the flair color, so every flair in a batch is set with its own request, ``concurrency`` at a time. A failed write is
+    retried in the next flushes, up to ``max_attempts`` times, unless a newer flair for the user has been queued in the meantime.
+
+    On exit, the pending flairs are flushed until none is left. A failed batch doesn't stop the later ones, its flairs are retried after them with a
+    backoff. :attr:`written` and :attr:`failed` count the flairs written and the flairs dropped after their last attempt.
+
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = 5,
+        batch_size: int = 100,
+        concurrency: int = 5,
+        max_attempts: int = 3,
+        priority: Priority = Priority.NORMAL,
+        retry_backoff: BackoffPolicy = BackoffPolicy(base_delay=1, max_delay=30),
+    ) -> None:
+        """Creates the writer. Flairs are written directly until the writer is started by entering the async context manager.
+
+        :param flush_interval: Maximum number of seconds a flair waits before it is written.
+        :param batch_size: Number of pending users that triggers an early flush. Also the maximum number of flairs written per flush.
+        :param concurrency: Maximum number of flair requests in flight.
+        :param max_attempts: Maximum number of times a flair write is tried before it is dropped.
+        :param priority: Request priority of the flair writes.
+        :param retry_backoff: Delay after a failed flush on exit, before the remaining flairs are flushed.
+
+        """
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.priority = priority
+        self.retry_backoff = retry_backoff
+        self.written = 0
+        self.failed = 0
+        self._pending: dict[str, PendingFlair] = {}
+        self._batch_ready = asyncio.Event()
+        self._flusher: Optional[asyncio.Task[None]] = None
+
+    async def __aenter__(self) -> FlairWriter:
+        self._flusher = asyncio.create_task(self._flush_periodically(), name="flair-writer")
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        failed_flushes = 0
+        while self._pending:
+            if await self.flush():
+                failed_flushes = 0
+                continue
+            # The failed flairs are pending again, after the ones that haven't been tried yet. Every flair is dropped after max_attempts, so this ends.
+            await asyncio.sleep(self.retry_backoff.delay(failed_flushes))
+            failed_flushes += 1
+
+    @property
+    def pending(self) -> int:
+        """Number of users whose flair is waiting to be written."""
+        return len(self._pending)
+
+    async def set(self, subreddit: Subreddit, username: str, text: str, flair_template_id: str) -> None:
+        """Queues the flair of the user, replacing any flair still pending for them.
+
+        :param subreddit: The subreddit where the flair is set.
+        :param username: The user whose flair is set.
+        :param text: The flair text.
+        :param flair_template_id: The id of the flair template.
+
+        :returns: None
+
+        """
+        flair = PendingFlair(subreddit=subreddit, username=username, text=text, flair_template_id=flair_template_id)
+        if self._flusher is None:
+            await self._write(flair)
+            return
+
+        self._pending[username.lower()] = flair
+        if len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self) -> bool:
+        """Writes up to ``batch_size`` pending flairs.
+
+        :returns: True if every flair was written, False if any write failed.
+
+        """
+        batch = [self._pending.pop(key) for key in list(self._pending)[: self.batch_size]]
+        if not batch:
+            return True
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def write_limited(flair: PendingFlair) -> None:
+            async with semaphore:
+                await self._write(flair)
+
+        results = await asyncio.gather(*(write_limited(flair) for flair in batch), return_exceptions=True)
+        failed = 0
+        for flair, result in zip(batch, results):
+            if isinstance(result, BaseException):
+                failed += 1
+                flair.attempts += 1
+                flair_func_logger.error(f"Failed to update the user flair for {flair.username} (attempt {flair.attempts})", exc_info=result)
+                # Retry in the next flush unless a newer flair has been queued already
+                if flair.attempts < self.max_attempts:
+                    self._pending.setdefault(flair.username.lower(), flair)
+                else:
+                    self.failed += 1
+        flair_func_logger.info(f"Flushed {len(batch) - failed} user flairs, {failed} failed, {len(self._pending)} pending")
+        return failed == 0
+
+    async def _write(self, flair: PendingFlair) -> None:
+        async with request_scheduler.slot(self.priority):
+            await flair.subreddit.flair.set(flair.username, text=flair.text, flair_template_id=flair.flair_template_id)
+        self.written += 1
+        flair_func_logger.info(f"Updated the user flair for {flair.username} to {flair.text}")
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
+
+
+flair_writer = FlairWriter()
+
+
+async def update_flair(reddit_username: str, user_flair: str, karma: int, connections: Connections) -> None:
     """Assigns flair to user based on karma value and mod/courier status.
 
-    :param parent_post: The comment/submission whose author flair will be updated.
+    The flair is queued on the flair writer, which writes it with the next batch.
+
+    :param reddit_username: The user whose flair will be updated.
     :param user_flair: The updated user flair text.
     :param karma: User karma value
     :param connections: Connections object containing subreddit object and mongodb connection
@@ -22,33 +224,25 @@ async def update_flair(parent_post: Comment | Submission, user_flair: str, karma
     :returns: None
 
     """
-    author_name = parent_post.author.name
     fallout76marketplace = connections.fo76_subreddit
-
-    # If user is mod assigns the green flair
-    if await is_mod_or_courier(parent_post.author, fallout76marketplace):
-        await fallout76marketplace.flair.set(author_name, text=user_flair, flair_template_id=MODS_AND_COURIERS_FLAIR)
-    elif karma < 49:
-        await fallout76marketplace.flair.set(author_name, text=user_flair, flair_template_id=ZERO_TO_FIFTY_FLAIR)
-    elif 50 <= karma < 99:
-        await fallout76marketplace.flair.set(author_name, text=user_flair, flair_template_id=FIFTY_TO_HUNDRED_FLAIR)
-    else:
-        await fallout76marketplace.flair.set(author_name, text=user_flair, flair_template_id=ABOVE_HUNDRED_FLAIR)
-    flair_func_logger.info(f"Updated the user flair for {author_name} to {user_flair}")
+    flair_template_id = flair_template_for(karma, reddit_username.lower() in await privileged_users(fallout76marketplace))
+    await flair_writer.set(fallout76marketplace, reddit_username, text=user_flair, flair_template_id=flair_template_id)
 
 
 TRADE_ENDED_ID = "1e0c3870-a456-11ea-aa7a-0ee73ab9d31f"
 
 
-async def close_post_trade(comment: Comment) -> None:
+async def close_post_trade(context: CommandContext) -> None:
     """Changes the flair to Trade Closed and locks submission.
 
-    :param comment: Comment that triggered the command.
+    :param context: CommandContext of the comment that triggered the command.
 
     :returns: None
 
     """
-    submission = comment.submission
-    await submission.flair.select(TRADE_ENDED_ID)
-    await submission.mod.lock()
+    submission = context.comment.submission
+    async with request_scheduler.slot(Priority.HIGH):
+        await submission.flair.select(TRADE_ENDED_ID)
+    async with request_scheduler.slot(Priority.HIGH):
+        await submission.mod.lock()
     flair_func_logger.info(f"Closed the submission with id {submission.id}")
@@ -0,0 +1,301 @@
+from __future__ import annotations
+
+import asyncio
+import re
+from dataclasses import dataclass
+from functools import partial
+from types import TracebackType
+from typing import Optional, Union
+
+from asyncpraw import Reddit
+from asyncpraw.models import Comment, Message
+from asyncprawcore.exceptions import AsyncPrawcoreException, NotFound, TooManyRequests
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+import bot_responses
+from backoff import Backoff, BackoffPolicy
+from bot_commands import award_karma
+from command_dispatcher import CommandDispatcher
+from comment_ledger import ProcessedCommentLedger
+from conversation_checks import is_mod
+from db_operations import find_user_profiles, get_mongo_collection, is_karma_logged
+from flair_functions import build_user_flair, update_flair
+from metrics import inbox_items_total
+from request_scheduler import Priority, request_scheduler
+from rosters import courier_roster
+from utils import Connections, create_logger
+
+inbox_logger = create_logger(logger_name="karma_bot")
+
+# Backoff of the inbox stream, separate from the comment stream so that a failing inbox doesn't open the circuit of the comment stream
+inbox_backoff = Backoff(
+    default=BackoffPolicy(base_delay=30, max_delay=330),
+    policies={
+        AsyncPrawcoreException: BackoffPolicy(base_delay=10, max_delay=330),
+        TooManyRequests: BackoffPolicy(base_delay=60, max_delay=600),
+    },
+)
+
+MAX_KARMA_ADJUSTMENT = 100
+MAX_FLAIR_REFRESH_USERS = 500
+
+# Mentions start with the bot's username, which is not part of the command
+LEADING_MENTION = re.compile(r"^\s*/?u/[\w-]+[\s:,]*", re.IGNORECASE)
+KARMA_ADJUSTMENT = re.compile(r"^!karma\s+/?(?:u/)?(?P<username>[\w-]{3,20})\s+(?P<karma_change>[+-]?\d{1,6})\b", re.IGNORECASE)
+FLAIR_REFRESH = re.compile(r"^!refresh-?flairs?\b(?P<usernames>.*)", re.IGNORECASE | re.DOTALL)
+USERNAME = re.compile(r"/?(?:u/)?(?P<username>[\w-]{3,20})", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class KarmaAdjustment:
+    """!karma u/username +3, changing the karma of a user by hand."""
+
+    username: str
+    karma_change: int
+
+
+@dataclass(frozen=True)
+class FlairRefresh:
+    """!refreshflairs u/first u/second ..., rebuilding the flairs of the users from their profiles."""
+
+    usernames: tuple[str, ...]
+
+
+ModCommand = Union[KarmaAdjustment, FlairRefresh]
+
+
+def parse_mod_command(body: str) -> Optional[ModCommand]:
+    """Finds the mod command in a private message or in a comment mentioning the bot.
+
+    :param body: Markdown body of the message or comment.
+
+    :returns: The command, or None if the body doesn't start with a mod command.
+
+    """
+    text = LEADING_MENTION.sub("", body.replace("\\", ""), count=1).strip()
+    if match := KARMA_ADJUSTMENT.match(text):
+        return KarmaAdjustment(username=match["username"], karma_change=int(match["karma_change"]))
+    if match := FLAIR_REFRESH.match(text):
+        usernames: dict[str, str] = {}
+        for token in re.split(r"[\s,]+", match["usernames"]):
+            if username_match := USERNAME.fullmatch(token):
+                usernames.setdefault(username_match["username"].lower(), username_match["username"])
+        return FlairRefresh(usernames=tuple(usernames.values())) if usernames else None
+    return None
+
+
+class InboxReadMarker:
+    """Marks inbox items read in batches.
+
+    Items are marked read every ``flush_interval`` seconds, or as soon as ``batch_size`` items are pending. Reddit accepts 25 items per request. Items that
+    fail to be marked are kept for the next flush. An item that is still unread after a restart is read again, but its command has been claimed in the
+    processed comments ledger already, so it is not executed twice.
+
+    """
+
+    def __init__(self, reddit: Reddit, flush_interval: float = 10, batch_size: int = 25) -> None:
+        """Creates the marker. Items are marked directly until the marker is started by entering the async context manager.
+
+        :param reddit: The Reddit instance whose inbox is read.
+        :param flush_interval: Maximum number of seconds an item stays unread after it has been handled.
+        :param batch_size: Number of pending items that triggers an early flush, and the number of items per request.
+
+        """
+        self.reddit = reddit
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending: list[Comment | Message] = []
+        self._batch_ready = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task[None]] = None
+
+    async def __aenter__(self) -> InboxReadMarker:
+        self._flusher = asyncio.create_task(self._flush_periodically(), name="inbox-read-marker")
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    @property
+    def pending(self) -> int:
+        """Number of items waiting to be marked read."""
+        return len(self._pending)
+
+    async def add(self, item: Comment | Message) -> None:
+        """Queues the item to be marked read.
+
+        :param item: The message or comment read from the inbox.
+
+        :returns: None
+
+        """
+        self._pending.append(item)
+        if self._flusher is None:
+            await self.flush()
+        elif len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self) -> None:
+        """Marks all pending items read, one request per batch_size items.
+
+        :returns: None
+
+        """
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[: self.batch_size]
+                try:
+                    async with request_scheduler.slot(Priority.LOW):
+                        await self.reddit.inbox.mark_read(batch)
+                except AsyncPrawcoreException:
+                    inbox_logger.error(f"Failed to mark {len(batch)} inbox items read, retrying in the next flush", exc_info=True)
+                    return
+                del self._pending[: len(batch)]
+                inbox_logger.info(f"Marked {len(batch)} inbox items read")
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
+
+
+async def adjust_karma(item: Comment | Message, command: KarmaAdjustment, reddit: Reddit, connections: Connections) -> None:
+    """Changes the karma of a user on behalf of a moderator, logging the change like a karma command.
+
+    :param item: The message or comment containing the command.
+    :param command: The parsed command.
+    :param reddit: The Reddit instance, used to look up the username as it is spelled on Reddit.
+    :param connections: Connections object containing connections to the database and Reddit API.
+
+    :returns: None
+
+    """
+    if command.karma_change == 0 or abs(command.karma_change) > MAX_KARMA_ADJUSTMENT:
+        await bot_responses.mod_command_reply(item, f"Karma can be changed by 1 to {MAX_KARMA_ADJUSTMENT} points at a time.")
+        return
+
+    # Profiles are keyed by the exact username, so the spelling of the command is replaced by the one on Reddit
+    try:
+        async with request_scheduler.slot(Priority.HIGH):
+            redditor = await reddit.redditor(command.username, fetch=True)
+    except NotFound:
+        await bot_responses.mod_command_reply(item, f"u/{command.username} doesn't exist. The karma has not been changed.")
+        return
+    username: str = redditor.name
+
+    # A retry of a command that failed after changing the karma only replies
+    if not await is_karma_logged(item, connections):
+        inbox_logger.info(f"u/{item.author.name} changes the karma of u/{username} by {command.karma_change:+d}")
+        await award_karma(item.author.name, username, command.karma_change, item, connections)
+    await bot_responses.mod_command_reply(item, f"u/{username}'s karma has been changed by {command.karma_change:+d}. The flair may take some time to update.")
+
+
+async def refresh_flairs(item: Comment | Message, command: FlairRefresh, connections: Connections) -> None:
+    """Rebuilds the flairs of the users from their profiles. Cached profiles are used as they are, the others are fetched with one query.
+
+    The usernames are matched regardless of case, like Reddit does, so the moderator doesn't have to spell them as they are stored.
+
+    :param item: The message or comment containing the command.
+    :param command: The parsed command.
+    :param connections: Connections object containing connections to the database and Reddit API.
+
+    :returns: None
+
+    """
+    usernames = command.usernames[:MAX_FLAIR_REFRESH_USERS]
+    users_collection = await get_mongo_collection(collection_name="user_karma", fallout76marketplace_karma_db=connections.karma_db)
+    profiles = await find_user_profiles(usernames, users_collection)
+
+    couriers = await courier_roster.get(connections.fo76_subreddit)
+    for profile in profiles.values():
+        username = profile["reddit_username"]
+        user_flair = build_user_flair(profile, username.lower() in couriers)
+        await update_flair(reddit_username=username, user_flair=user_flair, karma=profile["karma"], connections=connections)
+
+    inbox_logger.info(f"u/{item.author.name} refreshed the flairs of {len(profiles)} users")
+    response = f"Refreshing the flairs of {len(profiles)} users. The flairs may take some time to update."
+    not_found = [username for username in usernames if username.lower() not in profiles]
+    if not_found:
+        response += f"\n\nNo profile found for: {', '.join(f'u/{username}' for username in not_found)}"
+    if len(command.usernames) > len(usernames):
+        response += f"\n\nOnly the first {MAX_FLAIR_REFRESH_USERS} users have been refreshed."
+    await bot_responses.mod_command_reply(item, response)
+
+
+async def run_mod_command(item: Comment | Message, command: ModCommand, reddit: Reddit, connections: Connections, read_marker: InboxReadMarker) -> None:
+    match command:
+        case KarmaAdjustment():
+            await adjust_karma(item, command, reddit, connections)
+        case FlairRefresh():
+            await refresh_flairs(item, command, connections)
+    await read_marker.add(item)
+
+
+async def dispatch_inbox_item(
+    item: Comment | Message, reddit: Reddit, conn: Connections, dispatcher: CommandDispatcher, ledger: ProcessedCommentLedger, read_marker: InboxReadMarker
+) -> bool:
+    """Hands the mod command in the inbox item over to the dispatcher. Commands from users who aren't moderators are ignored.
+
+    Items with a command are marked read once the command has completed. An item whose command failed stays unread, so the inbox delivers it again after
+    a restart and the command is retried.
+
+    :param item: Unread private message, username mention, or reply to the bot.
+    :param reddit: The Reddit instance
+    :param conn: Connections object containing connections to the database and Reddit API.
+    :param dispatcher: CommandDispatcher that executes the inbox commands
+    :param ledger: Ledger of the items whose commands have already been processed
+    :param read_marker: Marks the item read once its command has completed
+
+    :returns: True if the command has been handed over, False if the item can be marked read right away.
+
+    """
+    # Username mentions and replies to the bot are comments whose subject tells them apart
+    kind = "message" if isinstance(item, Message) else str(getattr(item, "subject", "comment")).lower().replace(" ", "_")
+    author = item.author
+    command = None if author is None else parse_mod_command(item.body)
+    inbox_items_total.inc(kind=kind, command="none" if command is None else type(command).__name__)
+    if author is None or command is None:
+        return False
+
+    if not await is_mod(author, conn.fo76_subreddit):
+        inbox_logger.info(f"Ignoring the mod command of u/{author.name} in {item.fullname}, they are not a moderator")
+        return False
+
+    # Claimed by fullname, since message and comment ids are not unique across kinds. Commands of the same moderator are executed in the order they
+    # were sent.
+    return await ledger.submit_once(item.fullname, dispatcher, author.name.lower(), partial(run_mod_command, item, command, reddit, conn, read_marker))
+
+
+async def read_inbox(
+    reddit_instance: Reddit, karma_db: AsyncIOMotorDatabase, dispatcher: CommandDispatcher, ledger: ProcessedCommentLedger, read_marker: InboxReadMarker
+) -> None:
+    """Reads the unread private messages, username mentions and replies to the bot, and hands the mod commands over to the inbox dispatcher.
+
+    Comments in the inbox are also part of the comment stream, so karma and close commands are left to it. Items without a mod command, or whose command
+    has already been processed, are marked read right away, the others once their command has completed.
+
+    :param reddit_instance: The Reddit Instance from AsyncPRAW. Used to make API calls.
+    :param karma_db: MongoDB database used to get the collections
+    :param dispatcher: CommandDispatcher that executes the inbox commands, separate from the one of the comment stream
+    :param ledger: Ledger of the items whose commands have already been processed
+    :param read_marker: Marks the items read in batches
+
+    :returns: Nothing is returned
+
+    """
+    fo76_subreddit = await reddit_instance.subreddit("Fallout76Marketplace")
+    conn = Connections(fo76_subreddit=fo76_subreddit, karma_db=karma_db)
+    inbox_logger.info("Reading the inbox")
+
+    async for item in reddit_instance.inbox.stream():
+        inbox_backoff.record_success()
+        if not await dispatch_inbox_item(item, reddit_instance, conn, dispatcher, ledger, read_marker):
+            await read_marker.add(item)
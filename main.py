@@ -2,67 +2,144 @@
 from __future__ import annotations
 
 import asyncio
-import re
+import signal
 import time
+from functools import partial, wraps
+from os import getenv
 from traceback import format_exc
-from typing import Awaitable, Callable, Never
+from typing import Any, Awaitable, Callable, Coroutine, Never, ParamSpec
 
 from asyncpraw import Reddit
-from asyncprawcore.exceptions import AsyncPrawcoreException
+from asyncpraw.models import Comment
+from asyncprawcore.exceptions import AsyncPrawcoreException, RequestException, ServerError, TooManyRequests
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
+from backoff import Backoff, BackoffPolicy
 from bot_commands import close_command, karma_command
-from utils import Connections, create_logger, create_reddit_instance, get_karma_db, send_traceback_to_discord
+from command_context import CommandContext
+from command_dispatcher import CommandDispatcher
+from command_parser import CloseCommand, KarmaCommand, parse_command
+from comment_ledger import ProcessedCommentLedger
+from db_operations import ensure_indexes, karma_log_buffer, profile_cache
+from flair_functions import flair_writer
+from inbox import InboxReadMarker, inbox_backoff, read_inbox
+from metrics import (
+    MetricsServer,
+    dispatcher_queue_depth,
+    inbox_circuit_state,
+    inbox_queue_depth,
+    pending_flairs,
+    pending_karma_logs,
+    profile_cache_hits_total,
+    profile_cache_misses_total,
+    reddit_rate_limit_remaining,
+    reddit_requests_waiting,
+    registry,
+    stream_circuit_state,
+    stream_lag_seconds,
+)
+from request_scheduler import request_scheduler
+from stream_checkpoint import StreamCheckpoint
+from utils import Connections, create_logger, create_reddit_instance, error_reporter, get_karma_db
 
 load_dotenv()
 
+main_logger = create_logger(logger_name="karma_bot", set_format=True)
 
-def exception_wrapper(func: Callable[[Reddit, AsyncIOMotorDatabase], Awaitable[None]]) -> Callable[[Reddit, AsyncIOMotorDatabase], Awaitable[None]]:
+# Backoff of the comment stream. Other parts of the bot can check stream_backoff.is_open to know if Reddit is currently failing.
+stream_backoff = Backoff(
+    default=BackoffPolicy(base_delay=30, max_delay=330),
+    policies={
+        AsyncPrawcoreException: BackoffPolicy(base_delay=10, max_delay=330),
+        RequestException: BackoffPolicy(base_delay=5, max_delay=120),
+        ServerError: BackoffPolicy(base_delay=15, max_delay=330),
+        TooManyRequests: BackoffPolicy(base_delay=60, max_delay=600),
+    },
+)
+
+P = ParamSpec("P")
+
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def exception_wrapper(func: Callable[P, Awaitable[None]], backoff: Backoff = stream_backoff) -> Callable[P, Coroutine[Any, Any, Never]]:
     """Decorator to handle the exceptions and to ensure the code doesn't exit unexpectedly.
 
+    After an exception the function is restarted once the backoff delay has passed. The delay is awaited, so the rest of the bot keeps running.
+
     :param func: function that needs to be called
+    :param backoff: Backoff of the stream run by the function. Defaults to the comment stream.
 
     :returns: wrapper function
-    :rtype: Callable[[Reddit, AsyncIOMotorDatabase], Awaitable[None]]
+    :rtype: Callable[P, Coroutine[Any, Any, Never]]
 
     """
 
-    async def wrapper(reddit_instance: Reddit, karma_db: AsyncIOMotorDatabase) -> Never:
-        global cool_down_timer
-
+    @wraps(func)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> Never:
         while True:
             try:
-                await func(reddit_instance, karma_db)
+                await func(*args, **kwargs)
             except AsyncPrawcoreException as asyncpraw_exc:
                 main_logger.exception("AsyncPrawcoreException", exc_info=True)
-                await send_traceback_to_discord(exception_name=type(asyncpraw_exc).__name__, exception_message=str(asyncpraw_exc), exception_body=format_exc())
-
-                time.sleep(cool_down_timer)
-                cool_down_timer = (cool_down_timer + 30) % 360
-                main_logger.info(f"Cooldown: {cool_down_timer} seconds")
+                error_reporter.report(exception_name=type(asyncpraw_exc).__name__, exception_message=str(asyncpraw_exc), exception_body=format_exc())
+                await backoff.wait_after_failure(asyncpraw_exc)
             except Exception as general_exc:
                 main_logger.critical("Serious Exception", exc_info=True)
-                await send_traceback_to_discord(exception_name=type(general_exc).__name__, exception_message=str(general_exc), exception_body=format_exc())
-
-                time.sleep(cool_down_timer)
-                cool_down_timer = (cool_down_timer + 30) % 360
-                main_logger.info(f"Cooldown: {cool_down_timer} seconds")
+                error_reporter.report(exception_name=type(general_exc).__name__, exception_message=str(general_exc), exception_body=format_exc())
+                await backoff.wait_after_failure(general_exc)
 
     return wrapper
 
 
-KARMA_PP = re.compile(r"^(\++KARMA|KARMA\++)", re.IGNORECASE)
-KARMA_MM = re.compile(r"^(-+KARMA|KARMA-+)", re.IGNORECASE)
-CLOSE = re.compile(r"^(!CLOSE|CLOSE!)", re.IGNORECASE)
+async def dispatch_comment(comment: Comment, conn: Connections, dispatcher: CommandDispatcher, ledger: ProcessedCommentLedger) -> None:
+    """Hands the comment over to the dispatcher if it contains a command that hasn't been processed before.
+
+    :param comment: Comment from r/Fallout76MarketPlace
+    :param conn: Connections object containing connections to the database and Reddit API.
+    :param dispatcher: CommandDispatcher that executes the commands
+    :param ledger: Ledger of the comments whose commands have already been processed
+
+    :returns: Nothing is returned
+
+    """
+    if comment.author is None:
+        return
+
+    if comment.author.name.lower() == "automoderator":
+        return
+
+    match parse_command(comment.body):
+        case KarmaCommand(delta=karma_change):
+            command = partial(karma_command, CommandContext(comment, conn), karma_change)
+        case CloseCommand():
+            command = partial(close_command, CommandContext(comment, conn))
+        case None:
+            return
+
+    await ledger.submit_once(comment.id, dispatcher, comment.link_id, command)
 
 
 @exception_wrapper
-async def read_comments(reddit_instance: Reddit, karma_db: AsyncIOMotorDatabase) -> None:
-    """Checks comments as they come on r/Fallout76MarketPlace and performs actions accordingly.
+async def read_comments(
+    reddit_instance: Reddit,
+    karma_db: AsyncIOMotorDatabase,
+    dispatcher: CommandDispatcher,
+    checkpoint: StreamCheckpoint,
+    ledger: ProcessedCommentLedger,
+) -> None:
+    """Checks comments as they come on r/Fallout76MarketPlace and hands the commands over to the dispatcher.
+
+    The commands are executed by the dispatcher workers so that a slow command doesn't hold up the stream. Commands under the same submission are executed
+    in the order they were posted. Commands that were claimed but never completed, e.g., because the bot crashed, and comments posted after the checkpoint
+    while the bot was down or reconnecting are processed before the live stream.
 
     :param reddit_instance: The Reddit Instance from AsyncPRAW. Used to make API calls.
     :param karma_db: MongoDB database used to get the collections
+    :param dispatcher: CommandDispatcher that executes the commands
+    :param checkpoint: Position of the comment stream
+    :param ledger: Ledger of the comments whose commands have already been processed
 
     :returns: Nothing is returned
 
@@ -71,33 +148,126 @@ async def read_comments(reddit_instance: Reddit, karma_db: AsyncIOMotorDatabase)
     fo76_subreddit = await reddit_instance.subreddit("Fallout76Marketplace")
     conn = Connections(fo76_subreddit=fo76_subreddit, karma_db=karma_db)
 
-    async for comment in fo76_subreddit.stream.comments(skip_existing=True):  # Comment
-        if comment.author is None:
-            continue
+    unfinished = await ledger.unfinished_comments()
+    if unfinished:
+        main_logger.info(f"Retrying the commands of {len(unfinished)} comments that were not completed")
+        async for comment in reddit_instance.info(fullnames=[f"t1_{comment_id}" for comment_id in unfinished]):
+            if isinstance(comment, Comment):
+                await dispatch_comment(comment, conn, dispatcher, ledger)
+
+    for comment in await checkpoint.backlog(fo76_subreddit):
+        await dispatch_comment(comment, conn, dispatcher, ledger)
+        checkpoint.advance(comment)
+    await checkpoint.save(force=True)
+
+    # Without a checkpoint there is nothing to catch up on, so the comments already in the listing are skipped
+    async for comment in fo76_subreddit.stream.comments(skip_existing=checkpoint.fullname is None):  # Comment
+        stream_backoff.record_success()
+        stream_lag_seconds.set(time.time() - comment.created_utc)
+        # Comments at or before the checkpoint are dispatched too, e.g., those approved late or released from the spam filter. The ledger rejects the
+        # ones that have been processed already.
+        await dispatch_comment(comment, conn, dispatcher, ledger)
+        checkpoint.advance(comment)
+        await checkpoint.save()
+
+
+def register_runtime_metrics(dispatcher: CommandDispatcher, inbox_dispatcher: CommandDispatcher) -> None:
+    """Lets the metrics read the state of the long-lived services when they are collected.
+
+    :param dispatcher: CommandDispatcher of the comment stream
+    :param inbox_dispatcher: CommandDispatcher of the inbox
+
+    :returns: None
+
+    """
+    dispatcher_queue_depth.set_function(lambda: dispatcher.depth)
+    reddit_rate_limit_remaining.set_function(lambda: request_scheduler.remaining_budget)
+    reddit_requests_waiting.set_function(lambda: request_scheduler.waiting)
+    profile_cache_hits_total.set_function(lambda: profile_cache.hits)
+    profile_cache_misses_total.set_function(lambda: profile_cache.misses)
+    pending_flairs.set_function(lambda: flair_writer.pending)
+    pending_karma_logs.set_function(lambda: karma_log_buffer.pending)
+    stream_circuit_state.set_function(lambda: stream_backoff.state)
+    inbox_queue_depth.set_function(lambda: inbox_dispatcher.depth)
+    inbox_circuit_state.set_function(lambda: inbox_backoff.state)
+
+
+async def wait_for_shutdown_signal(readers: list[asyncio.Task[Never]]) -> None:
+    """Returns when SIGTERM or SIGINT is received, or when a reader stops.
+
+    After the first signal the default handlers are restored, so a second signal stops the bot without waiting for the graceful shutdown.
 
-        if comment.author.name.lower() == "automoderator":
-            continue
+    :param readers: The stream reader tasks.
 
-        comment_body = comment.body.strip().replace("\\", "")
-        if KARMA_PP.search(comment_body):
-            await karma_command(comment, 1, conn)
-        elif KARMA_MM.search(comment_body):
-            await karma_command(comment, -1, conn)
-        elif CLOSE.search(comment_body):
-            await close_command(comment, fo76_subreddit)
+    :returns: None
+
+    """
+    loop = asyncio.get_running_loop()
+    stop_requested = asyncio.Event()
+    for shutdown_signal in SHUTDOWN_SIGNALS:
+        loop.add_signal_handler(shutdown_signal, stop_requested.set)
+    stop_waiter = asyncio.create_task(stop_requested.wait())
+    try:
+        await asyncio.wait([stop_waiter, *readers], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stop_waiter.cancel()
+        for shutdown_signal in SHUTDOWN_SIGNALS:
+            loop.remove_signal_handler(shutdown_signal)
 
 
 async def main() -> None:
+    drain_timeout = float(getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
     async with (
+        error_reporter,
         get_karma_db() as databased,
         create_reddit_instance() as reddit,
+        flair_writer,
+        karma_log_buffer,
+        profile_cache.watching(databased),
+        CommandDispatcher(
+            concurrency=int(getenv("COMMAND_WORKERS", "8")),
+            queue_size=int(getenv("COMMAND_QUEUE_SIZE", "25")),
+        ) as dispatcher,
+        # The inbox has its own workers, so mod commands don't wait behind a backlog of the comment stream
+        CommandDispatcher(
+            concurrency=int(getenv("INBOX_WORKERS", "2")),
+            queue_size=int(getenv("INBOX_QUEUE_SIZE", "10")),
+        ) as inbox_dispatcher,
+        InboxReadMarker(reddit) as read_marker,
+        MetricsServer(registry, host=getenv("METRICS_HOST", "127.0.0.1"), port=int(getenv("METRICS_PORT", "9108"))),
     ):
-        await asyncio.gather(
-            read_comments(reddit, databased),
-        )
+        request_scheduler.attach(reddit)
+        register_runtime_metrics(dispatcher, inbox_dispatcher)
+        await ensure_indexes(databased)
+        checkpoint = StreamCheckpoint(databased)
+        await checkpoint.load()
+        ledger = ProcessedCommentLedger(databased)
+        readers = [
+            asyncio.create_task(read_comments(reddit, databased, dispatcher, checkpoint, ledger), name="comment-stream"),
+            asyncio.create_task(exception_wrapper(read_inbox, backoff=inbox_backoff)(reddit, databased, inbox_dispatcher, ledger, read_marker), name="inbox"),
+        ]
+        await wait_for_shutdown_signal(readers)
+
+        # Stop taking new commands, then let the commands already taken finish so that none is left half done, e.g., logged without the karma change
+        shutdown_start = time.perf_counter()
+        main_logger.info("Shutting down: stopping the streams")
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        # Comments claimed by the cancelled streams are still being handed over to the dispatchers
+        await ledger.wait_for_submissions(drain_timeout)
+        main_logger.info(f"Draining {dispatcher.depth + inbox_dispatcher.depth} queued commands, waiting at most {drain_timeout:.0f} seconds")
+        drained = await asyncio.gather(dispatcher.drain(drain_timeout), inbox_dispatcher.drain(drain_timeout))
+        # Commands dropped by a drain that timed out are retried after the restart
+        released = await ledger.release_unfinished()
+        if released:
+            main_logger.warning(f"Released the claims of {released} commands that did not run, they will be retried on the next start")
+        await checkpoint.save(force=True)
+        # Leaving the context managers flushes the pending inbox reads, karma logs and flairs, then closes the Reddit and MongoDB clients
+        main_logger.info(f"Flushing {karma_log_buffer.pending} karma logs, {flair_writer.pending} flairs and {read_marker.pending} inbox reads")
+
+    main_logger.info(f"Shutdown finished in {time.perf_counter() - shutdown_start:.1f} seconds, {'all' if all(drained) else 'not all'} commands completed")
 
 
 if __name__ == "__main__":
-    cool_down_timer = 0
-    main_logger = create_logger(logger_name="karma_bot", set_format=True)
     asyncio.run(main())
@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import math
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from types import TracebackType
+from typing import Callable, Generator, Iterator, Optional
+
+from aiohttp import web
+
+from utils import create_logger
+
+metrics_logger = create_logger(logger_name="karma_bot")
+
+LabelValues = tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues) -> str:
+    if not names:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class _Metric(ABC):
+    """Base class of the metrics. The values are kept per combination of label values."""
+
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        """Creates the metric without any samples.
+
+        :param name: Name of the metric in the exposition format.
+        :param documentation: Help text of the metric.
+        :param labelnames: Names of the labels every sample has.
+
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._function: Optional[Callable[[], Optional[float]]] = None
+
+    def set_function(self, function: Callable[[], Optional[float]]) -> None:
+        """Reads the value from the function every time the metrics are collected. Only for metrics without labels.
+
+        :param function: Zero argument function returning the current value, or None if the value is unknown.
+
+        :returns: None
+
+        """
+        if self.labelnames:
+            raise ValueError(f"{self.name} has labels and cannot read its value from a function")
+        self._function = function
+
+    def _label_values(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> Iterator[tuple[str, LabelValues, float]]:
+        """Yields the suffix, the label values and the value of every sample."""
+
+    def render(self) -> str:
+        """Returns the metric in the Prometheus text exposition format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        if self._function is not None:
+            value = self._function()
+            if value is not None:
+                lines.append(f"{self.name} {_format_value(value)}")
+        else:
+            for suffix, label_values, value in self.samples():
+                names = self.labelnames + ("le",) if suffix == "_bucket" else self.labelnames
+                lines.append(f"{self.name}{suffix}{_format_labels(names, label_values)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Value that only goes up, e.g., the number of commands per outcome."""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increments the counter of the label values.
+
+        :param amount: Non-negative amount to add.
+        :param labels: Value of every label of the counter.
+
+        :returns: None
+
+        """
+        if amount < 0:
+            raise ValueError("Counters can only be incremented")
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[tuple[str, LabelValues, float]]:
+        for label_values, value in self._values.items():
+            yield "", label_values, value
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, e.g., the stream lag."""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        """Sets the gauge of the label values.
+
+        :param value: The new value.
+        :param labels: Value of every label of the gauge.
+
+        :returns: None
+
+        """
+        self._values[self._label_values(labels)] = value
+
+    def samples(self) -> Iterator[tuple[str, LabelValues, float]]:
+        for label_values, value in self._values.items():
+            yield "", label_values, value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g., command latencies, counted in cumulative buckets."""
+
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...], labelnames: tuple[str, ...] = ()) -> None:
+        """Creates the histogram without any observations.
+
+        :param name: Name of the metric in the exposition format.
+        :param documentation: Help text of the metric.
+        :param buckets: Upper bounds of the buckets in increasing order. The +Inf bucket is added automatically.
+        :param labelnames: Names of the labels every observation has.
+
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Records one observation.
+
+        :param value: The observed value, e.g., a duration in seconds.
+        :param labels: Value of every label of the histogram.
+
+        :returns: None
+
+        """
+        key = self._label_values(labels)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Generator[None, None, None]:
+        """Observes the number of seconds the block takes, including the time spent awaiting inside it.
+
+        :param labels: Value of every label of the histogram.
+
+        :returns: Context manager timing the block.
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[tuple[str, LabelValues, float]]:
+        for label_values, counts in self._counts.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", label_values + (_format_value(upper_bound),), cumulative
+            yield "_sum", label_values, self._sums[label_values]
+            yield "_count", label_values, cumulative
+
+
+class MetricsRegistry:
+    """Collection of the metrics served by the metrics endpoint."""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> None:
+        """Adds the metric to the registry.
+
+        :param metric: The metric. Its name must be unique in the registry.
+
+        :returns: None
+
+        """
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        counter = Counter(name, documentation, labelnames)
+        self.register(counter)
+        return counter
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        gauge = Gauge(name, documentation, labelnames)
+        self.register(gauge)
+        return gauge
+
+    def histogram(self, name: str, documentation: str, buckets: tuple[float, ...], labelnames: tuple[str, ...] = ()) -> Histogram:
+        histogram = Histogram(name, documentation, buckets, labelnames)
+        self.register(histogram)
+        return histogram
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+class MetricsServer:
+    """Serves the metrics of a registry on ``/metrics`` over HTTP while the async context manager is entered.
+
+    Metrics are not essential to the bot, so if the server cannot listen, e.g., because the port is taken, the error is logged and the bot runs without
+    them.
+
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9108) -> None:
+        """Creates the server. It starts listening when entering the async context manager.
+
+        :param registry: The metrics served.
+        :param host: Interface the server listens on. Only local by default.
+        :param port: Port the server listens on.
+
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def __aenter__(self) -> MetricsServer:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError:
+            metrics_logger.error(f"Could not serve metrics on {self.host}:{self.port}, running without them", exc_info=True)
+            await self._runner.cleanup()
+            self._runner = None
+            return self
+        metrics_logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.registry.render().encode(), headers={"Content-Type": self.CONTENT_TYPE})
+
+
+registry = MetricsRegistry()
+
+command_latency_seconds = registry.histogram(
+    "karma_bot_command_latency_seconds",
+    "Seconds from the creation of the command comment until the command has been processed and replied to.",
+    buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600),
+    labelnames=("command",),
+)
+command_stage_seconds = registry.histogram(
+    "karma_bot_command_stage_seconds",
+    "Seconds spent in each stage of a command.",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    labelnames=("stage",),
+)
+karma_check_outcomes_total = registry.counter("karma_bot_karma_check_outcomes_total", "Karma commands per check outcome.", labelnames=("outcome",))
+close_check_outcomes_total = registry.counter("karma_bot_close_check_outcomes_total", "Close commands per check outcome.", labelnames=("outcome",))
+stream_lag_seconds = registry.gauge("karma_bot_stream_lag_seconds", "Seconds between the creation of the last streamed comment and reading it.")
+dispatcher_queue_depth = registry.gauge("karma_bot_dispatcher_queue_depth", "Commands waiting for a dispatcher worker.")
+reddit_rate_limit_remaining = registry.gauge("karma_bot_reddit_rate_limit_remaining", "Reddit API requests left in the current rate limit window.")
+reddit_requests_waiting = registry.gauge("karma_bot_reddit_requests_waiting", "Reddit API requests waiting for a slot of the request scheduler.")
+profile_cache_hits_total = registry.counter("karma_bot_profile_cache_hits_total", "User profile lookups served by the cache.")
+profile_cache_misses_total = registry.counter("karma_bot_profile_cache_misses_total", "User profile lookups that went to MongoDB.")
+pending_flairs = registry.gauge("karma_bot_pending_flairs", "User flairs waiting to be written.")
+pending_karma_logs = registry.gauge("karma_bot_pending_karma_logs", "Karma logs waiting to be inserted.")
+stream_circuit_state = registry.gauge("karma_bot_stream_circuit_state", "Circuit state of the comment stream: 1 closed, 2 open, 3 half-open.")
+inbox_items_total = registry.counter("karma_bot_inbox_items_total", "Unread inbox items read, per kind and mod command.", labelnames=("kind", "command"))
+inbox_queue_depth = registry.gauge("karma_bot_inbox_queue_depth", "Inbox commands waiting for an inbox worker.")
+inbox_circuit_state = registry.gauge("karma_bot_inbox_circuit_state", "Circuit state of the inbox stream: 1 closed, 2 open, 3 half-open.")
@@ -0,0 +1,175 @@
+#!.venv/bin/python
+"""Recomputes the karma of every user from the karma_logs history and corrects user_karma where the running total has drifted.
+
+Karma log entries written before karma_change was recorded have no sign, since both +karma and -karma were logged the same way. The history of a user
+with such entries cannot be summed, so these users are reported and never corrected. Users without any karma log entry are left untouched, and m76_karma
+is not part of the history, so it is never changed. Nothing is written unless --apply is given.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterable, AsyncIterator, Mapping, Optional
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+
+from db_operations import NEW_PROFILE_DEFAULTS, get_mongo_collection
+from utils import create_logger, get_karma_db
+
+load_dotenv()
+
+recompute_logger = create_logger(logger_name="karma_bot", set_format=True)
+
+# Runs on the server, so only one document per user crosses the network. $sum skips the entries without karma_change, which are counted separately.
+KARMA_BY_USER_PIPELINE: list[dict[str, Any]] = [
+    {
+        "$group": {
+            "_id": "$to_user",
+            "karma": {"$sum": "$karma_change"},
+            "log_entries": {"$sum": 1},
+            "unsigned_entries": {"$sum": {"$cond": [{"$eq": [{"$ifNull": ["$karma_change", None]}, None]}, 1, 0]}},
+        }
+    },
+]
+
+
+@dataclass
+class KarmaCorrection:
+    username: str
+    current_karma: Optional[int]  # None if the user has no profile
+    expected_karma: int
+
+    def to_operation(self) -> UpdateOne:
+        """Returns the write that applies the correction.
+
+        The update only matches while the profile still has the karma the correction was computed from, so a karma change made by the bot in the
+        meantime is never overwritten.
+
+        :returns: The update for bulk_write.
+
+        """
+        if self.current_karma is None:
+            return UpdateOne({"reddit_username": self.username}, {"$setOnInsert": NEW_PROFILE_DEFAULTS | {"karma": self.expected_karma}}, upsert=True)
+        return UpdateOne({"reddit_username": self.username, "karma": self.current_karma}, {"$set": {"karma": self.expected_karma}})
+
+
+@dataclass
+class RecomputeStats:
+    log_entries: int = 0
+    users: int = 0
+    corrections: int = 0
+    missing_profiles: int = 0
+    unsigned_users: int = 0
+    applied: int = 0
+    conflicts: int = 0
+
+
+async def in_chunks(documents: AsyncIterable[Mapping[str, Any]], chunk_size: int) -> AsyncIterator[list[Mapping[str, Any]]]:
+    """Groups the documents of a cursor into lists of chunk_size documents.
+
+    :param documents: The cursor.
+    :param chunk_size: Maximum number of documents per chunk.
+
+    :returns: Async generator of chunks.
+
+    """
+    chunk: list[Mapping[str, Any]] = []
+    async for document in documents:
+        chunk.append(document)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def find_corrections(karma_by_user: list[Mapping[str, Any]], users_collection: AsyncIOMotorCollection) -> list[KarmaCorrection]:
+    """Compares the karma computed from the logs with the profiles of the users, using one query for the whole chunk.
+
+    :param karma_by_user: Chunk of the aggregation output, one document per user.
+    :param users_collection: The user_karma collection.
+
+    :returns: The corrections for the users whose profile differs from their history.
+
+    """
+    usernames = [str(group["_id"]) for group in karma_by_user]
+    current_karma: dict[str, int] = {}
+    async for profile in users_collection.find({"reddit_username": {"$in": usernames}}, {"reddit_username": 1, "karma": 1}):
+        current_karma[profile["reddit_username"]] = profile["karma"]
+
+    corrections: list[KarmaCorrection] = []
+    for group in karma_by_user:
+        username, expected_karma = str(group["_id"]), int(group["karma"])
+        current = current_karma.get(username)
+        if current != expected_karma:
+            corrections.append(KarmaCorrection(username=username, current_karma=current, expected_karma=expected_karma))
+    return corrections
+
+
+async def main() -> int:
+    """Prints the karma differences and, if --apply is given, corrects the profiles.
+
+    :returns: Exit code 0.
+
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--apply", action="store_true", help="write the corrections; without it the differences are only printed")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="number of users compared and corrected per round-trip")
+    parser.add_argument("--show", type=int, default=20, help="number of differences printed")
+    args = parser.parse_args()
+
+    stats = RecomputeStats()
+    start = time.perf_counter()
+    async with get_karma_db() as karma_db:
+        logs_collection = await get_mongo_collection(collection_name="karma_logs", fallout76marketplace_karma_db=karma_db)
+        users_collection = await get_mongo_collection(collection_name="user_karma", fallout76marketplace_karma_db=karma_db)
+        karma_by_user = logs_collection.aggregate(KARMA_BY_USER_PIPELINE, allowDiskUse=True, batchSize=args.chunk_size)
+
+        async for chunk in in_chunks(karma_by_user, args.chunk_size):
+            stats.users += len(chunk)
+            stats.log_entries += sum(group["log_entries"] for group in chunk)
+            for group in chunk:
+                if group["unsigned_entries"]:
+                    if stats.unsigned_users < args.show:
+                        print(f"u/{group['_id']}: skipped, {group['unsigned_entries']} of {group['log_entries']} karma log entries have no karma_change")
+                    stats.unsigned_users += 1
+            corrections = await find_corrections([group for group in chunk if not group["unsigned_entries"]], users_collection)
+            for correction in corrections:
+                if stats.corrections < args.show:
+                    print(f"u/{correction.username}: {correction.current_karma} -> {correction.expected_karma}")
+                stats.corrections += 1
+                stats.missing_profiles += correction.current_karma is None
+
+            if args.apply and corrections:
+                result = await users_collection.bulk_write([correction.to_operation() for correction in corrections], ordered=False)
+                stats.applied += result.modified_count + result.upserted_count
+                stats.conflicts += len(corrections) - result.matched_count - result.upserted_count
+
+            elapsed = time.perf_counter() - start
+            recompute_logger.info(f"Compared {stats.users} users from {stats.log_entries} log entries ({stats.log_entries / elapsed:.0f} rows/sec)")
+
+    elapsed = time.perf_counter() - start
+    if stats.corrections > args.show:
+        print(f"... and {stats.corrections - args.show} more")
+    print(
+        f"Aggregated {stats.log_entries} log entries into {stats.users} users in {elapsed:.1f} seconds ({stats.log_entries / max(elapsed, 1e-9):.0f} rows/sec)."
+    )
+    print(f"{stats.corrections} users differ from their history, {stats.missing_profiles} of them have no profile.")
+    if stats.unsigned_users:
+        print(f"{stats.unsigned_users} users were skipped because their history has karma log entries without karma_change; check them by hand.")
+    if args.apply:
+        print(f"Corrected {stats.applied} users. {stats.conflicts} changed while the job was running; run it again to correct them.")
+        if stats.applied:
+            print("Run reconcile_flairs.py to update the flairs of the corrected users.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
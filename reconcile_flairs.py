@@ -0,0 +1,126 @@
+#!.venv/bin/python
+"""Finds users whose subreddit flair doesn't match their karma in the user_karma collection and fixes their flair."""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from asyncpraw.models import Subreddit
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from db_operations import get_mongo_collection
+from flair_functions import FlairWriter, build_user_flair, flair_template_for
+from request_scheduler import Priority, request_scheduler
+from rosters import courier_roster, moderator_cache
+from utils import create_logger, create_reddit_instance, get_karma_db
+
+load_dotenv()
+
+reconcile_logger = create_logger(logger_name="karma_bot", set_format=True)
+
+
+@dataclass
+class FlairDrift:
+    username: str
+    current_text: Optional[str]
+    expected_text: str
+    flair_template_id: str
+
+
+async def current_flairs(subreddit: Subreddit) -> dict[str, str]:
+    """Streams the flair listing of the subreddit.
+
+    :param subreddit: The subreddit whose user flairs are listed.
+
+    :returns: Dict of lowercase username to flair text.
+
+    """
+    flairs: dict[str, str] = {}
+    async for item in subreddit.flair(limit=None):
+        flairs[item["user"].name.lower()] = item["flair_text"] or ""
+    return flairs
+
+
+async def find_drift(subreddit: Subreddit, karma_db: AsyncIOMotorDatabase, cursor_batch_size: int) -> tuple[list[FlairDrift], int]:
+    """Joins the subreddit flairs with the user profiles and returns the users whose flair differs from their profile.
+
+    Profiles with no karma and no gamertags are skipped when the user has no flair, because the bot never flaired them.
+
+    :param subreddit: The subreddit whose user flairs are checked.
+    :param karma_db: MongoDB database used to get the collections
+    :param cursor_batch_size: Number of profiles fetched from MongoDB per round-trip.
+
+    :returns: The differing flairs and the number of profiles checked.
+
+    """
+    flairs = await current_flairs(subreddit)
+    moderators = await moderator_cache.get(subreddit)
+    couriers = await courier_roster.get(subreddit)
+    reconcile_logger.info(f"Fetched {len(flairs)} user flairs")
+
+    users_collection = await get_mongo_collection(collection_name="user_karma", fallout76marketplace_karma_db=karma_db)
+    projection = {"reddit_username": 1, "gamertags": 1, "karma": 1, "m76_karma": 1}
+    drift: list[FlairDrift] = []
+    checked = 0
+    async for profile in users_collection.find({}, projection, batch_size=cursor_batch_size):
+        checked += 1
+        username: str = profile["reddit_username"]
+        current_text = flairs.get(username.lower())
+        if current_text is None and profile["karma"] + profile["m76_karma"] == 0 and not profile["gamertags"]:
+            continue
+
+        is_user_courier = username.lower() in couriers
+        expected_text = build_user_flair(profile, is_user_courier)
+        if current_text != expected_text:
+            flair_template_id = flair_template_for(profile["karma"], is_user_courier or username.lower() in moderators)
+            drift.append(FlairDrift(username=username, current_text=current_text, expected_text=expected_text, flair_template_id=flair_template_id))
+    return drift, checked
+
+
+async def main() -> int:
+    """Prints the flair differences and, unless --dry-run is given, writes the expected flairs.
+
+    :returns: Exit code 0, or 1 if some flairs could not be written.
+
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dry-run", action="store_true", help="only print the differences without changing any flair")
+    parser.add_argument("--batch-size", type=int, default=100, help="number of flairs written per batch")
+    parser.add_argument("--cursor-batch-size", type=int, default=1000, help="number of profiles fetched from MongoDB per round-trip")
+    parser.add_argument("--show", type=int, default=20, help="number of differences printed")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    exit_code = 0
+    async with get_karma_db() as karma_db, create_reddit_instance() as reddit:
+        subreddit = await reddit.subreddit("Fallout76Marketplace")
+        drift, checked = await find_drift(subreddit, karma_db, args.cursor_batch_size)
+
+        for item in drift[: args.show]:
+            print(f"u/{item.username}: {item.current_text!r} -> {item.expected_text!r}")
+        if len(drift) > args.show:
+            print(f"... and {len(drift) - args.show} more")
+        print(f"Checked {checked} profiles, {len(drift)} flairs differ.")
+
+        if not args.dry_run and drift:
+            # The bot shares the rate limit budget, so the corrections yield to its commands
+            request_scheduler.attach(reddit)
+            async with FlairWriter(batch_size=args.batch_size, priority=Priority.LOW) as writer:
+                for item in drift:
+                    await writer.set(subreddit, item.username, text=item.expected_text, flair_template_id=item.flair_template_id)
+            print(f"Updated {writer.written} flairs, {writer.failed} failed.")
+            if writer.failed:
+                reconcile_logger.error(f"{writer.failed} flairs could not be written, run the reconciliation again to retry them")
+                exit_code = 1
+    reconcile_logger.info(f"Reconciliation finished in {time.perf_counter() - start:.1f} seconds")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
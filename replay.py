@@ -0,0 +1,397 @@
+#!.venv/bin/python
+"""Replays a JSONL or Pushshift-style dump of subreddit comments through the command dispatch and the checks, without replying or setting flairs.
+
+The dump is parsed by a pool of processes. By default the replay only reports the outcome of every command. With --write, commands that the bot has not
+processed already are written to processed_comments, user_karma, daily_given_karma and karma_logs with bulk writes, e.g., to rebuild karma after an outage.
+The daily karma limit starts from the counters of the bot, so a replay never lets a user give more karma on a day than the bot would have. Every batch of
+commands is claimed before its karma is written and completed afterwards, so a replay that is interrupted never applies a command twice. Commands left
+claimed but not completed by an interrupted replay are retried by the bot, like those of a crashed bot.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import partial
+from itertools import islice
+from typing import IO, Any, Callable, Iterator, Optional, TypeVar
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from bot_commands import DAILY_KARMA_LIMIT
+from command_context import PostSnapshot, ThreadSnapshot
+from command_parser import CloseCommand, Command, KarmaCommand, parse_command
+from conversation_checks import CloseChecks, KarmaChecks, checks_for_karma_command, evaluate_close_checks
+from db_operations import NEW_PROFILE_DEFAULTS, claim_comments, complete_comments, get_mongo_collection
+from stream_checkpoint import comment_sequence
+from utils import create_logger, get_karma_db, next_midnight_timestamp
+
+load_dotenv()
+
+replay_logger = create_logger(logger_name="karma_bot", set_format=True)
+
+# Commands whose thread is not part of the dump cannot be checked
+MISSING_CONTEXT = "MISSING_CONTEXT"
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class DumpPost:
+    """A comment or submission from the dump, reduced to what the checks and the karma logs need."""
+
+    fullname: str
+    author: Optional[str]  # None if the post has been deleted
+    removed: bool
+    permalink: str
+    created_utc: float
+    link_id: str  # The submission fullname, or the fullname itself for submissions
+    parent_id: str  # Empty for submissions
+    flair: str = ""
+    command: Optional[Command] = None
+
+    def snapshot(self) -> PostSnapshot:
+        return PostSnapshot(fullname=self.fullname, author=self.author, removed=self.removed, permalink=self.permalink)
+
+
+def parse_posts(lines: list[bytes], kind: str, subreddit: str) -> list[DumpPost]:
+    """Parses a chunk of dump lines. Runs in the worker processes.
+
+    :param lines: JSON lines of comments or submissions.
+    :param kind: t1 for comments, t3 for submissions.
+    :param subreddit: Lowercase name of the subreddit whose posts are kept.
+
+    :returns: The posts of the subreddit.
+
+    """
+    posts: list[DumpPost] = []
+    for line in lines:
+        if not line.strip():
+            continue
+        item: dict[str, Any] = json.loads(line)
+        if str(item.get("subreddit", subreddit)).lower() != subreddit:
+            continue
+
+        post_id = str(item["id"])
+        author = item.get("author")
+        text = item.get("body" if kind == "t1" else "selftext") or ""
+        fullname = f"{kind}_{post_id}"
+        link_id = str(item["link_id"]) if kind == "t1" else fullname
+        permalink = item.get("permalink") or f"/r/{item.get('subreddit', subreddit)}/comments/{link_id.split('_', 1)[1]}/_/{post_id}/"
+        posts.append(
+            DumpPost(
+                fullname=fullname,
+                author=None if author in (None, "[deleted]") else str(author),
+                removed=text == "[removed]" or bool(item.get("removed_by_category") or item.get("removed")),
+                permalink=permalink,
+                created_utc=float(item.get("created_utc", 0)),
+                link_id=link_id,
+                parent_id=str(item.get("parent_id", "")),
+                flair=item.get("link_flair_text") or "",
+                command=parse_command(text) if kind == "t1" else None,
+            )
+        )
+    return posts
+
+
+def parse_dump(path: str, parse: Callable[[list[bytes]], list[DumpPost]], workers: int, chunk_lines: int) -> Iterator[DumpPost]:
+    """Parses the dump in chunks on a process pool, keeping a bounded number of chunks in flight.
+
+    :param path: Path of the JSONL dump. Files ending in .gz are decompressed.
+    :param parse: Picklable function parsing one chunk of lines.
+    :param workers: Number of worker processes.
+    :param chunk_lines: Number of lines per chunk.
+
+    :returns: Generator of the posts in dump order.
+
+    """
+    opener: Callable[[str, str], IO[bytes]] = gzip.open if path.endswith(".gz") else open  # type: ignore[assignment]
+    with opener(path, "rb") as dump, ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: deque[Future[list[DumpPost]]] = deque()
+        for lines in iter(lambda: list(islice(dump, chunk_lines)), []):
+            pending.append(pool.submit(parse, lines))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+@dataclass
+class Replay:
+    """Replays the commands in order, keeping the state the checks depend on in memory instead of the database."""
+
+    submissions: dict[str, DumpPost]
+    comments: dict[str, DumpPost]
+    moderators: frozenset[str]
+    couriers: frozenset[str]
+    # Permalinks of the logged karma by (from_user, to_user, submission_id)
+    rewarded: dict[tuple[str, str, str], str] = field(default_factory=dict[tuple[str, str, str], str])
+    processed: set[str] = field(default_factory=set[str])  # Ids of the comments the bot has processed already
+    daily_given: Counter[tuple[str, float]] = field(default_factory=Counter[tuple[str, float]])  # Karma given by (from_user, day)
+    # The (from_user, day) counter of the commands whose karma counts towards the daily limit, by the id of the command comment
+    daily_counted: dict[str, tuple[str, float]] = field(default_factory=dict[str, tuple[str, float]])
+    outcomes: Counter[str] = field(default_factory=Counter[str])
+    karma_changes: Counter[str] = field(default_factory=Counter[str])
+    karma_logs: dict[str, dict[str, Any]] = field(default_factory=dict[str, dict[str, Any]])  # Karma logs by the id of the command comment
+    replayed_ids: list[str] = field(default_factory=list[str])
+
+    def thread(self, comment: DumpPost) -> Optional[ThreadSnapshot]:
+        """Builds the snapshot of the comment, its parent and the submission from the dump.
+
+        :param comment: The command comment.
+
+        :returns: The snapshot, or None if the parent or the submission is not in the dump.
+
+        """
+        submission = self.submissions.get(comment.link_id)
+        is_root = comment.parent_id == comment.link_id
+        parent = submission if is_root else self.comments.get(comment.parent_id)
+        if submission is None or parent is None:
+            return None
+        return ThreadSnapshot(
+            comment=comment.snapshot(), parent=parent.snapshot(), submission=submission.snapshot(), submission_flair=submission.flair, is_root=is_root
+        )
+
+    async def run(self, commands: list[DumpPost]) -> None:
+        """Replays the commands like the dispatcher would, oldest first.
+
+        :param commands: The comments containing a command.
+
+        :returns: None
+
+        """
+        for comment in sorted(commands, key=lambda command: comment_sequence(command.fullname)):
+            comment_id = comment.fullname.split("_", 1)[1]
+            if comment.author is None or comment.author.lower() == "automoderator" or comment_id in self.processed:
+                continue
+
+            thread = self.thread(comment)
+            if thread is None:
+                self.outcomes[MISSING_CONTEXT] += 1
+            elif isinstance(comment.command, KarmaCommand):
+                self.outcomes[(await self.karma(comment, comment.author, thread, comment.command.delta)).name] += 1
+            elif isinstance(comment.command, CloseCommand):
+                close_checks = CloseChecks.CLOSE_CHECKS_PASSED if comment.author.lower() in self.moderators else evaluate_close_checks(thread)
+                self.outcomes[close_checks.name] += 1
+            self.processed.add(comment_id)
+            self.replayed_ids.append(comment_id)
+
+    async def karma(self, comment: DumpPost, from_user: str, thread: ThreadSnapshot, karma_change: int) -> KarmaChecks:
+        """Runs the checks of the karma command against the state in memory and records the karma change if they pass.
+
+        :param comment: The command comment.
+        :param from_user: Author of the command comment.
+        :param thread: Snapshot of the thread around the comment.
+        :param karma_change: +1 or -1.
+
+        :returns: The outcome of the checks.
+
+        """
+        comment_id, submission_id = comment.fullname.split("_", 1)[1], comment.link_id[3:]
+
+        async def snapshot() -> ThreadSnapshot:
+            return thread
+
+        async def privileged() -> frozenset[str]:
+            return self.moderators | self.couriers
+
+        async def find_reward(to_user: str) -> Optional[str]:
+            return self.rewarded.get((from_user, to_user, submission_id))
+
+        async def reserve() -> bool:
+            day = next_midnight_timestamp(comment.created_utc)
+            if self.daily_given[from_user, day] >= DAILY_KARMA_LIMIT:
+                return False
+            self.daily_given[from_user, day] += 1
+            self.daily_counted[comment_id] = (from_user, day)
+            return True
+
+        karma_checks, _ = await checks_for_karma_command(karma_change, from_user.lower() in self.moderators, snapshot, privileged, find_reward, reserve)
+        if karma_checks == KarmaChecks.KARMA_CHECKS_PASSED and thread.parent.author is not None:
+            to_user = thread.parent.author
+            self.rewarded[from_user, to_user, submission_id] = comment.permalink
+            self.karma_changes[to_user] += karma_change
+            self.karma_logs[comment_id] = {
+                "from_user": from_user,
+                "to_user": to_user,
+                "karma_change": karma_change,
+                "submission_id": submission_id,
+                "comment_permalink": comment.permalink,
+                "utc_created": comment.created_utc,
+            }
+        return karma_checks
+
+
+def chunked(items: list[T], size: int) -> Iterator[list[T]]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+async def load_processed(replay: Replay, commands: list[DumpPost], karma_db: AsyncIOMotorDatabase, batch_size: int) -> None:
+    """Loads which commands the bot has processed already, which karma it has logged on the replayed submissions, and how much karma the authors of
+    the commands have given on the replayed days.
+
+    :param replay: The replay whose state is seeded.
+    :param commands: The comments containing a command.
+    :param karma_db: MongoDB database used to get the collections
+    :param batch_size: Number of ids per query.
+
+    :returns: None
+
+    """
+    processed_comments = await get_mongo_collection(collection_name="processed_comments", fallout76marketplace_karma_db=karma_db)
+    karma_logs = await get_mongo_collection(collection_name="karma_logs", fallout76marketplace_karma_db=karma_db)
+    daily_given_karma = await get_mongo_collection(collection_name="daily_given_karma", fallout76marketplace_karma_db=karma_db)
+    comment_ids = [command.fullname.split("_", 1)[1] for command in commands]
+    for ids in chunked(comment_ids, batch_size):
+        async for claim in processed_comments.find({"_id": {"$in": ids}}, {"_id": 1}):
+            replay.processed.add(claim["_id"])
+
+    submission_ids = sorted({command.link_id[3:] for command in commands})
+    for ids in chunked(submission_ids, batch_size):
+        projection = {"from_user": 1, "to_user": 1, "submission_id": 1, "comment_permalink": 1}
+        async for karma_log in karma_logs.find({"submission_id": {"$in": ids}}, projection):
+            replay.rewarded[karma_log["from_user"], karma_log["to_user"], karma_log["submission_id"]] = karma_log["comment_permalink"]
+
+    # Counters of the days that ended more than a day ago have expired, so the days of old dumps start from zero
+    user_days = sorted({(command.author, next_midnight_timestamp(command.created_utc)) for command in commands if command.author is not None})
+    for pairs in chunked(user_days, batch_size):
+        query = {"$or": [{"from_user": from_user, "day": day} for from_user, day in pairs]}
+        async for counter in daily_given_karma.find(query, {"from_user": 1, "day": 1, "count": 1}):
+            replay.daily_given[counter["from_user"], counter["day"]] = counter["count"]
+
+
+async def write_results(replay: Replay, karma_db: AsyncIOMotorDatabase, batch_size: int) -> None:
+    """Writes the claims, the karma changes, the daily karma counters and the karma logs of the replayed comments in batches of unordered bulk writes.
+
+    Every batch is claimed first and completed last. Comments claimed by the bot while the replay was running are left to the bot. The karma and the
+    daily counters are changed before the karma logs are written, like the bot does, so that a retry by the bot of a batch left unfinished never changes
+    the karma twice.
+
+    :param replay: The finished replay.
+    :param karma_db: MongoDB database used to get the collections
+    :param batch_size: Number of writes per bulk write.
+
+    :returns: None
+
+    """
+    karma_logs = await get_mongo_collection(collection_name="karma_logs", fallout76marketplace_karma_db=karma_db)
+    users = await get_mongo_collection(collection_name="user_karma", fallout76marketplace_karma_db=karma_db)
+    daily_given_karma = await get_mongo_collection(collection_name="daily_given_karma", fallout76marketplace_karma_db=karma_db)
+
+    written_logs, changed_users = 0, 0
+    for ids in chunked(replay.replayed_ids, batch_size):
+        claimed = await claim_comments(ids, karma_db)
+        if len(claimed) < len(ids):
+            replay_logger.warning(f"Skipping {len(ids) - len(claimed)} comments that the bot has claimed while the replay was running")
+
+        logs = [replay.karma_logs[comment_id] for comment_id in claimed if comment_id in replay.karma_logs]
+        karma_changes: Counter[str] = Counter()
+        for karma_log in logs:
+            karma_changes[karma_log["to_user"]] += karma_log["karma_change"]
+        updates = [
+            UpdateOne({"reddit_username": username}, {"$inc": {"karma": karma_change}, "$setOnInsert": NEW_PROFILE_DEFAULTS}, upsert=True)
+            for username, karma_change in karma_changes.items()
+            if karma_change
+        ]
+        if updates:
+            await users.bulk_write(updates, ordered=False)
+        daily_counts = Counter(replay.daily_counted[comment_id] for comment_id in claimed if comment_id in replay.daily_counted)
+        counter_updates = [
+            UpdateOne(
+                {"from_user": from_user, "day": day},
+                {"$inc": {"count": count}, "$setOnInsert": {"expire_at": datetime.fromtimestamp(day + 86400, tz=timezone.utc)}},
+                upsert=True,
+            )
+            for (from_user, day), count in daily_counts.items()
+        ]
+        if counter_updates:
+            await daily_given_karma.bulk_write(counter_updates, ordered=False)
+        if logs:
+            await karma_logs.insert_many(logs, ordered=False)
+        if claimed:
+            await complete_comments(claimed, karma_db)
+        written_logs += len(logs)
+        changed_users += len(updates)
+    replay_logger.info(f"Wrote {written_logs} karma logs and {changed_users} karma changes")
+
+
+async def main() -> int:
+    """Parses the dumps, replays the commands and prints the outcomes.
+
+    :returns: Exit code 0.
+
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--comments", required=True, help="JSONL dump of the comments, optionally gzipped")
+    parser.add_argument("--submissions", required=True, help="JSONL dump of the submissions, optionally gzipped")
+    parser.add_argument("--subreddit", default="Fallout76Marketplace", help="subreddit whose posts are replayed")
+    parser.add_argument("--moderators", default="", help="comma separated moderator names")
+    parser.add_argument("--couriers", default="", help="comma separated courier names")
+    parser.add_argument("--workers", type=int, default=None, help="number of parsing processes, defaults to the number of CPUs")
+    parser.add_argument("--chunk-lines", type=int, default=20_000, help="number of dump lines per parsing task")
+    parser.add_argument("--batch-size", type=int, default=1000, help="number of documents per database round-trip")
+    parser.add_argument("--write", action="store_true", help="skip the commands the bot has processed and write the karma of the others")
+    parser.add_argument("--show", type=int, default=20, help="number of karma changes printed")
+    args = parser.parse_args()
+
+    subreddit = args.subreddit.lower()
+    workers = args.workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    submissions = {
+        post.fullname: post for post in parse_dump(args.submissions, partial(parse_posts, kind="t3", subreddit=subreddit), workers, args.chunk_lines)
+    }
+    comments: dict[str, DumpPost] = {}
+    commands: list[DumpPost] = []
+    for post in parse_dump(args.comments, partial(parse_posts, kind="t1", subreddit=subreddit), workers, args.chunk_lines):
+        comments[post.fullname] = post
+        if post.command is not None:
+            commands.append(post)
+    parsed_in = time.perf_counter() - start
+    parse_rate = len(comments) / max(parsed_in, 1e-9)
+    print(f"Parsed {len(submissions)} submissions and {len(comments)} comments in {parsed_in:.1f} seconds ({parse_rate:.0f} comments/sec)")
+
+    replay = Replay(
+        submissions=submissions,
+        comments=comments,
+        moderators=frozenset(name.strip().lower() for name in args.moderators.split(",") if name.strip()),
+        couriers=frozenset(name.strip().lower() for name in args.couriers.split(",") if name.strip()),
+    )
+    if args.write:
+        async with get_karma_db() as karma_db:
+            await load_processed(replay, commands, karma_db, args.batch_size)
+            print(f"{len(replay.processed)} commands have been processed by the bot already")
+            replay_start = time.perf_counter()
+            await replay.run(commands)
+            replayed_in = time.perf_counter() - replay_start
+            await write_results(replay, karma_db, args.batch_size)
+    else:
+        replay_start = time.perf_counter()
+        await replay.run(commands)
+        replayed_in = time.perf_counter() - replay_start
+
+    replay_rate = len(commands) / max(replayed_in, 1e-9)
+    print(f"Replayed {len(replay.replayed_ids)} of {len(commands)} commands in {replayed_in:.2f} seconds ({replay_rate:.0f} commands/sec)")
+    for outcome, count in replay.outcomes.most_common():
+        print(f"  {outcome:<32} {count:>8}")
+    for username, karma_change in replay.karma_changes.most_common(args.show):
+        print(f"u/{username}: {karma_change:+d}")
+    if args.write and replay.karma_changes:
+        print("Run reconcile_flairs.py to update the flairs of the changed users.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum, auto
+from typing import AsyncGenerator, Optional
+
+from asyncpraw import Reddit
+from asyncprawcore.rate_limit import RateLimiter
+
+from utils import create_logger
+
+scheduler_logger = create_logger(logger_name="karma_bot")
+
+
+class Priority(IntEnum):
+    HIGH = auto()  # Command replies and the thread fetches of commands
+    NORMAL = auto()  # User flair writes
+    LOW = auto()  # Background work, e.g., roster refreshes and flair reconciliation
+
+
+class RequestScheduler:
+    """Hands out slots for Reddit API requests by priority, based on the rate limit budget reported by Reddit.
+
+    Reddit reports the requests left in the current rate limit window in the ``X-Ratelimit-*`` response headers, which asyncprawcore records on its rate
+    limiter. Every priority keeps a reserve of requests for the priorities above it: once the remaining budget drops to a priority's reserve, its requests
+    wait for the window to reset while higher priority requests still go through. Waiting requests are started highest priority first, and at most
+    ``max_concurrency`` requests are in flight.
+
+    Stream polling and paging through listings happen inside asyncpraw and don't take a slot, so they always go first.
+
+    """
+
+    DEFAULT_RESERVES = {Priority.HIGH: 0, Priority.NORMAL: 10, Priority.LOW: 30}
+
+    def __init__(self, max_concurrency: int = 10, reserves: Optional[dict[Priority, float]] = None) -> None:
+        """Creates the scheduler. Until :meth:`attach` is called the budget is unknown and only the concurrency is limited.
+
+        :param max_concurrency: Maximum number of requests in flight.
+        :param reserves: Number of remaining requests below which requests of the priority wait for the next window.
+
+        """
+        self.max_concurrency = max_concurrency
+        self.reserves = dict(self.DEFAULT_RESERVES if reserves is None else reserves)
+        self.in_flight = 0
+        self._rate_limiter: Optional[RateLimiter] = None
+        self._waiters: list[tuple[Priority, int, asyncio.Future[None]]] = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    def attach(self, reddit: Reddit) -> None:
+        """Reads the rate limit budget from the Reddit instance's session.
+
+        :param reddit: The authorized Reddit instance.
+
+        :returns: None
+
+        """
+        core = reddit._core
+        if core is None:
+            scheduler_logger.warning("The Reddit instance has no session, the rate limit budget stays unknown")
+            return
+        self._rate_limiter = core._rate_limiter
+
+    @property
+    def remaining_budget(self) -> Optional[float]:
+        """Requests left in the current rate limit window, or None before the first response."""
+        if self._rate_limiter is None:
+            return None
+        remaining: Optional[float] = self._rate_limiter.remaining
+        return remaining
+
+    @property
+    def used(self) -> Optional[int]:
+        """Requests used in the current rate limit window, or None before the first response."""
+        if self._rate_limiter is None:
+            return None
+        used: Optional[int] = self._rate_limiter.used
+        return used
+
+    @property
+    def seconds_to_reset(self) -> float:
+        """Seconds until the rate limit window resets, 0 if unknown."""
+        if self._rate_limiter is None or self._rate_limiter.reset_timestamp is None:
+            return 0
+        reset_timestamp: float = self._rate_limiter.reset_timestamp
+        return max(0, reset_timestamp - time.time())
+
+    @property
+    def waiting(self) -> int:
+        """Number of requests waiting for a slot."""
+        return sum(not future.done() for _, _, future in self._waiters)
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority) -> AsyncGenerator[None, None]:
+        """Waits for a slot of the priority and holds it while the request is made.
+
+        :param priority: Priority of the request.
+
+        :returns: Async context manager holding the slot.
+
+        """
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _has_budget(self, priority: Priority) -> bool:
+        remaining = self.remaining_budget
+        if remaining is None or self.seconds_to_reset == 0:
+            return True
+        return remaining > self.reserves[priority]
+
+    async def _acquire(self, priority: Priority) -> None:
+        if not self._waiters and self.in_flight < self.max_concurrency and self._has_budget(priority):
+            self.in_flight += 1
+            return
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Starts the waiting requests in priority order while there are free slots and budget."""
+        while self._waiters and self.in_flight < self.max_concurrency:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            # Lower priorities have larger reserves, so nothing behind the first waiter has budget either
+            if not self._has_budget(priority):
+                self._wake_up_at_reset(priority)
+                return
+            heapq.heappop(self._waiters)
+            self.in_flight += 1
+            future.set_result(None)
+
+    def _wake_up_at_reset(self, priority: Priority) -> None:
+        if self._wakeup is not None and not self._wakeup.cancelled():
+            return
+        delay = self.seconds_to_reset
+        scheduler_logger.info(
+            f"{self.waiting} Reddit requests waiting {delay:.0f} seconds for the rate limit to reset: {self.remaining_budget} left, "
+            f"{priority.name} priority keeps {self.reserves[priority]}"
+        )
+
+        def wake_up() -> None:
+            self._wakeup = None
+            self._dispatch()
+
+        self._wakeup = asyncio.get_running_loop().call_later(delay, wake_up)
+
+
+request_scheduler = RequestScheduler()
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import yaml
+from asyncpraw.models import Subreddit
+
+from request_scheduler import Priority, request_scheduler
+from utils import create_logger
+
+rosters_logger = create_logger(logger_name="karma_bot")
+
+
+class _TTLRoster(ABC):
+    """Base class for a set of lowercase usernames that is refreshed from Reddit once it is older than ``ttl`` seconds.
+
+    Concurrent callers that find the roster stale wait for a single refresh instead of each fetching it. Once the roster has been fetched, a stale roster is
+    still served while it is refreshed in the background at low request priority, so commands don't wait for the refresh.
+
+    """
+
+    def __init__(self, ttl: float) -> None:
+        """Creates an empty roster. The names are fetched on first use.
+
+        :param ttl: Number of seconds the roster is considered fresh.
+
+        """
+        self.ttl = ttl
+        self._names: frozenset[str] = frozenset()
+        self._expires_at = 0.0
+        self._servable = False
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task[None]] = None
+
+    def invalidate(self) -> None:
+        """Marks the roster as stale so that the next lookup fetches it again.
+
+        :returns: None
+
+        """
+        self._expires_at = 0.0
+        self._servable = False
+
+    async def get(self, subreddit: Subreddit) -> frozenset[str]:
+        """Returns the lowercase names in the roster, fetching them if they have not been fetched yet.
+
+        A stale roster is returned as is and refreshed in the background.
+
+        :param subreddit: The subreddit the roster belongs to.
+
+        :returns: Frozenset of lowercase usernames.
+
+        """
+        if time.monotonic() < self._expires_at:
+            return self._names
+
+        if self._servable:
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.create_task(self._refresh_in_background(subreddit), name=f"{type(self).__name__}-refresh")
+            return self._names
+
+        await self._refresh(subreddit, Priority.HIGH)
+        return self._names
+
+    async def _refresh(self, subreddit: Subreddit, priority: Priority) -> None:
+        async with self._lock:
+            # Another caller may have refreshed the roster while we were waiting for the lock
+            if time.monotonic() < self._expires_at:
+                return
+
+            async with request_scheduler.slot(priority):
+                self._names = await self._fetch(subreddit)
+            self._expires_at = time.monotonic() + self.ttl
+            self._servable = True
+
+    async def _refresh_in_background(self, subreddit: Subreddit) -> None:
+        try:
+            await self._refresh(subreddit, Priority.LOW)
+        except Exception:
+            rosters_logger.exception(f"Failed to refresh {type(self).__name__}, serving the stale roster", exc_info=True)
+
+    async def contains(self, username: str, subreddit: Subreddit) -> bool:
+        """Checks if the user is in the roster.
+
+        :param username: The username to look up. The lookup is case-insensitive.
+        :param subreddit: The subreddit the roster belongs to.
+
+        :returns: True if the user is in the roster, otherwise False.
+
+        """
+        return username.lower() in await self.get(subreddit)
+
+    @abstractmethod
+    async def _fetch(self, subreddit: Subreddit) -> frozenset[str]:
+        """Fetches the lowercase names of the roster from Reddit."""
+
+
+class ModeratorCache(_TTLRoster):
+    """Caches the lowercase names of the subreddit moderators."""
+
+    def __init__(self, ttl: float = 900) -> None:
+        super().__init__(ttl)
+
+    async def _fetch(self, subreddit: Subreddit) -> frozenset[str]:
+        moderators = await subreddit.moderator()
+        names = frozenset(moderator.name.lower() for moderator in moderators)
+        rosters_logger.info(f"Refreshed moderator list of r/{subreddit.display_name}: {len(names)} moderators")
+        return names
+
+
+class CourierRoster(_TTLRoster):
+    """Caches the lowercase names of the verified couriers listed on the ``custom_bot_config/courier_list`` wiki page.
+
+    The wiki page is only parsed again when its revision changes.
+
+    """
+
+    WIKI_PAGE = "custom_bot_config/courier_list"
+
+    def __init__(self, ttl: float = 300) -> None:
+        super().__init__(ttl)
+        self._revision_id: Optional[str] = None
+
+    async def _fetch(self, subreddit: Subreddit) -> frozenset[str]:
+        wiki = await subreddit.wiki.get_page(self.WIKI_PAGE)
+        if wiki.revision_id == self._revision_id:
+            return self._names
+
+        yaml_format = yaml.safe_load(wiki.content_md)
+        names = frozenset(str(courier).lower() for courier in yaml_format["couriers"])
+        self._revision_id = wiki.revision_id
+        rosters_logger.info(f"Loaded courier list revision {wiki.revision_id}: {len(names)} couriers")
+        return names
+
+
+moderator_cache = ModeratorCache()
+courier_roster = CourierRoster()
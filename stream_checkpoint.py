@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import time
+from typing import AsyncIterator, Optional
+
+from asyncpraw.models import Comment, Subreddit
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from db_operations import get_stream_checkpoint, save_stream_checkpoint
+from utils import create_logger
+
+checkpoint_logger = create_logger(logger_name="karma_bot")
+
+
+def comment_sequence(fullname: str) -> int:
+    """Converts a comment fullname to its position in time. Reddit assigns base 36 comment ids in increasing order.
+
+    :param fullname: Fullname (t1_abc123) or id of the comment.
+
+    :returns: The comment id as an integer.
+
+    """
+    return int(fullname.rsplit("_", 1)[-1], 36)
+
+
+class StreamCheckpoint:
+    """Keeps track of the last comment read from the subreddit stream and persists it to MongoDB.
+
+    The checkpoint is advanced for every comment in memory and written to the database at most once per ``save_interval`` seconds, so that the bot can
+    catch up on the comments it missed while it was down. It only bounds that catch-up. Live comments are never skipped for being older than the
+    checkpoint, since comments can enter the listing late, and repeats are rejected by the ProcessedCommentLedger instead.
+
+    """
+
+    STREAM_NAME = "comment_stream"
+
+    def __init__(self, karma_db: AsyncIOMotorDatabase, save_interval: float = 30) -> None:
+        """Creates an empty checkpoint. Call :meth:`load` to restore the saved position.
+
+        :param karma_db: MongoDB database used to get the collections
+        :param save_interval: Minimum number of seconds between two writes to the database.
+
+        """
+        self.karma_db = karma_db
+        self.save_interval = save_interval
+        self.fullname: Optional[str] = None
+        self.utc_created = 0.0
+        self._saved_fullname: Optional[str] = None
+        self._saved_at = 0.0
+
+    async def load(self) -> None:
+        """Restores the last saved position from the database.
+
+        :returns: None
+
+        """
+        checkpoint = await get_stream_checkpoint(self.STREAM_NAME, self.karma_db)
+        if checkpoint is not None:
+            self.fullname = self._saved_fullname = checkpoint["fullname"]
+            self.utc_created = checkpoint["utc_created"]
+        checkpoint_logger.info(f"Loaded stream checkpoint: {self.fullname}")
+
+    def is_processed(self, comment: Comment) -> bool:
+        """Checks if the comment is at or before the checkpoint.
+
+        :param comment: Comment from the subreddit.
+
+        :returns: True if the comment is at or before the checkpoint, otherwise False.
+
+        """
+        return self.fullname is not None and comment_sequence(comment.fullname) <= comment_sequence(self.fullname)
+
+    def advance(self, comment: Comment) -> None:
+        """Moves the checkpoint to the comment if it is newer. The new position is only saved by :meth:`save`.
+
+        :param comment: Comment that has been read.
+
+        :returns: None
+
+        """
+        if not self.is_processed(comment):
+            self.fullname = comment.fullname
+            self.utc_created = comment.created_utc
+
+    async def save(self, force: bool = False) -> None:
+        """Writes the checkpoint to the database if it has moved and the save interval has passed.
+
+        :param force: Write regardless of the save interval, e.g., on shutdown.
+
+        :returns: None
+
+        """
+        if self.fullname is None or self.fullname == self._saved_fullname:
+            return
+        if not force and time.monotonic() - self._saved_at < self.save_interval:
+            return
+
+        await save_stream_checkpoint(self.STREAM_NAME, self.fullname, self.utc_created, self.karma_db)
+        self._saved_fullname = self.fullname
+        self._saved_at = time.monotonic()
+
+    async def backlog(self, subreddit: Subreddit) -> list[Comment]:
+        """Fetches the comments posted after the checkpoint by paging back through the subreddit comments listing.
+
+        Reddit only lists roughly the last 1000 comments. If the checkpoint is older than that, the comments in between cannot be recovered.
+
+        :param subreddit: The subreddit whose comments are fetched.
+
+        :returns: The missed comments, oldest first. Empty if there is no checkpoint.
+
+        """
+        if self.fullname is None:
+            return []
+
+        missed: list[Comment] = []
+        reached_checkpoint = False
+        comments: AsyncIterator[Comment] = subreddit.comments(limit=None)
+        async for comment in comments:
+            if self.is_processed(comment):
+                reached_checkpoint = True
+                break
+            missed.append(comment)
+
+        if not reached_checkpoint:
+            checkpoint_logger.warning(f"Could not page back to the checkpoint {self.fullname}. Comments older than the {len(missed)} fetched ones are lost.")
+        checkpoint_logger.info(f"Catching up on {len(missed)} comments posted after {self.fullname}")
+        missed.reverse()
+        return missed
@@ -1,16 +1,18 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import json
+import time
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from logging import Logger, config, getLogger
 from os import getenv
 from pathlib import Path
-from traceback import print_exc
+from types import TracebackType
 from typing import AsyncGenerator, Optional
 
-import aiohttp
 import yaml
 from aiohttp import ClientSession
 from asyncpraw import Reddit
@@ -22,59 +24,162 @@ Path("logs").mkdir(exist_ok=True)
 conf_file = Path("logging.conf")
 config.fileConfig(str(conf_file))
 
+utils_logger = getLogger("karma_bot")
 
-async def post_to_pastebin(title: str, body: str) -> Optional[str]:
-    """Uploads the text to PasteBin and returns the url of the Paste
 
-    :param title: Title of the Paste
-    :param body: Body of Paste
+class ErrorReporter:
+    """Reports exceptions to the Discord webhook with the traceback uploaded to PasteBin.
 
-    :returns: url of Paste
+    Reports are queued and sent by a background task, so reporting never blocks the caller. All requests share one ClientSession and the PasteBin user key
+    is only requested once. Exceptions raised from the same place are reported at most once per ``dedup_window`` seconds; the number of suppressed repeats
+    is added to the next report.
 
     """
-    login_data = {"api_dev_key": getenv("PASTEBIN_DEV_KEY"), "api_user_name": getenv("PASTEBIN_USERNAME"), "api_user_password": getenv("PASTEBIN_PASSWORD")}
-
-    data = {
-        "api_option": "paste",
-        "api_dev_key": getenv("PASTEBIN_DEV_KEY"),
-        "api_paste_code": body,
-        "api_paste_name": title,
-        "api_paste_expire_date": "1W",
-        "api_user_key": None,
-        "api_paste_format": "python",
-    }
-
-    try:
-        async with ClientSession() as session:
-            login_resp = await session.post("https://pastebin.com/api/api_login.php", data=login_data)
-            if login_resp.status == 200:
-                data["api_user_key"] = await login_resp.text()
-                post_resp = await session.post("https://pastebin.com/api/api_post.php", data=data)
-                if post_resp.status == 200:
-                    return await post_resp.text()
-    except aiohttp.ClientError:
-        print_exc()
-    return None
 
+    def __init__(self, dedup_window: float = 600, queue_size: int = 50) -> None:
+        """Creates the reporter. The session and the background task are started when entering the async context manager.
+
+        :param dedup_window: Number of seconds during which repeats of a reported exception are suppressed.
+        :param queue_size: Maximum number of reports waiting to be sent. Reports beyond that are dropped.
+
+        """
+        self.dedup_window = dedup_window
+        self._queue: asyncio.Queue[tuple[str, str, str]] = asyncio.Queue(maxsize=queue_size)
+        self._last_reported: dict[str, float] = {}
+        self._suppressed: dict[str, int] = {}
+        self._session: Optional[ClientSession] = None
+        self._worker: Optional[asyncio.Task[None]] = None
+        self._pastebin_user_key: Optional[str] = None
+
+    async def __aenter__(self) -> ErrorReporter:
+        self._session = ClientSession()
+        self._worker = asyncio.create_task(self._send_reports(), name="error-reporter")
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=10)
+        except TimeoutError:
+            utils_logger.warning(f"Dropped {self._queue.qsize()} unsent error reports on shutdown")
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+    @staticmethod
+    def fingerprint(exception_name: str, exception_body: str) -> str:
+        """Identifies where an exception was raised, ignoring the message which often contains ids.
+
+        :param exception_name: The name of the exception.
+        :param exception_body: The full traceback of the exception.
+
+        :returns: Hex digest identifying the exception type and stack.
+
+        """
+        frames = [line for line in exception_body.splitlines() if line.lstrip().startswith("File ")]
+        return hashlib.sha1("\n".join([exception_name, *frames]).encode()).hexdigest()
+
+    def report(self, exception_name: str, exception_message: str, exception_body: str) -> None:
+        """Queues the exception to be sent to the Discord webhook unless the same exception was reported recently.
+
+        :param exception_name: The name of the exception.
+        :param exception_message: A brief summary of the exception.
+        :param exception_body: The full traceback of the exception.
+
+        :returns: None
+
+        """
+        fingerprint = self.fingerprint(exception_name, exception_body)
+        now = time.monotonic()
+        if now - self._last_reported.get(fingerprint, -self.dedup_window) < self.dedup_window:
+            self._suppressed[fingerprint] = self._suppressed.get(fingerprint, 0) + 1
+            return
+
+        suppressed = self._suppressed.pop(fingerprint, 0)
+        if suppressed:
+            exception_message += f" (repeated {suppressed} more times)"
+        try:
+            self._queue.put_nowait((exception_name, exception_message, exception_body))
+        except asyncio.QueueFull:
+            utils_logger.warning(f"Error report queue is full, dropping report for {exception_name}")
+            return
+        self._last_reported[fingerprint] = now
+
+    async def post_to_pastebin(self, title: str, body: str) -> Optional[str]:
+        """Uploads the text to PasteBin and returns the url of the Paste
+
+        :param title: Title of the Paste
+        :param body: Body of Paste
+
+        :returns: url of Paste
+
+        """
+        assert self._session is not None, "ErrorReporter must be used as an async context manager"
+        if self._pastebin_user_key is None:
+            login_data = {
+                "api_dev_key": getenv("PASTEBIN_DEV_KEY"),
+                "api_user_name": getenv("PASTEBIN_USERNAME"),
+                "api_user_password": getenv("PASTEBIN_PASSWORD"),
+            }
+            async with self._session.post("https://pastebin.com/api/api_login.php", data=login_data) as login_resp:
+                if login_resp.status != 200:
+                    return None
+                self._pastebin_user_key = await login_resp.text()
+
+        data = {
+            "api_option": "paste",
+            "api_dev_key": getenv("PASTEBIN_DEV_KEY"),
+            "api_paste_code": body,
+            "api_paste_name": title,
+            "api_paste_expire_date": "1W",
+            "api_user_key": self._pastebin_user_key,
+            "api_paste_format": "python",
+        }
+        async with self._session.post("https://pastebin.com/api/api_post.php", data=data) as post_resp:
+            if post_resp.status == 200:
+                return await post_resp.text()
+            # The user key may have expired, log in again for the next paste
+            self._pastebin_user_key = None
+        return None
+
+    async def send_traceback_to_discord(self, exception_name: str, exception_message: str, exception_body: str) -> None:
+        """Send the traceback of an exception to a Discord webhook.
+
+        :param exception_name: The name of the exception.
+        :param exception_message: A brief summary of the exception.
+        :param exception_body: The full traceback of the exception.
+
+        """
+        assert self._session is not None, "ErrorReporter must be used as an async context manager"
+        paste_bin_url = await self.post_to_pastebin(f"{exception_name}: {exception_message}", exception_body)
+
+        if paste_bin_url is None:
+            return
+
+        webhook = getenv("DISCORD_WEBHOOK", "deadass")
+        data = {"content": f"[{exception_name}: {exception_message}]({paste_bin_url})", "username": "Lemmy_BasedCountBot"}
+        async with self._session.post(url=webhook, data=json.dumps(data), headers={"Content-Type": "application/json"}):
+            pass
 
-async def send_traceback_to_discord(exception_name: str, exception_message: str, exception_body: str) -> None:
-    """Send the traceback of an exception to a Discord webhook.
+    async def _send_reports(self) -> None:
+        """Sends the queued reports one at a time. Failures are logged and do not stop the task.
 
-    :param exception_name: The name of the exception.
-    :param exception_message: A brief summary of the exception.
-    :param exception_body: The full traceback of the exception.
+        :returns: None
 
-    """
-    paste_bin_url = await post_to_pastebin(f"{exception_name}: {exception_message}", exception_body)
+        """
+        while True:
+            report = await self._queue.get()
+            try:
+                await self.send_traceback_to_discord(*report)
+            except Exception:
+                # Timeouts and anything else must not stop the task, or every later report would be lost without notice
+                utils_logger.exception("Failed to send error report", exc_info=True)
+            finally:
+                self._queue.task_done()
 
-    if paste_bin_url is None:
-        return
 
-    webhook = getenv("DISCORD_WEBHOOK", "deadass")
-    data = {"content": f"[{exception_name}: {exception_message}]({paste_bin_url})", "username": "Lemmy_BasedCountBot"}
-    async with ClientSession(headers={"Content-Type": "application/json"}) as session:
-        async with session.post(url=webhook, data=json.dumps(data)):
-            pass
+error_reporter = ErrorReporter()
 
 
 @dataclass
@@ -122,13 +227,15 @@ async def create_reddit_instance() -> AsyncGenerator[Reddit, None]:
         await reddit.close()
 
 
-def next_midnight_timestamp() -> float:
+def next_midnight_timestamp(timestamp: Optional[float] = None) -> float:
     """Get the timestamp of the next midnight.
 
+    :param timestamp: The time after which the next midnight is returned. Defaults to now.
+
     :returns: Timestamp of the next midnight.
 
     """
-    now = datetime.now()
+    now = datetime.now() if timestamp is None else datetime.fromtimestamp(timestamp)
     midnight: datetime = now.replace(hour=0, minute=0, second=0, microsecond=0)
     next_midnight: datetime = midnight + timedelta(days=1)
     return next_midnight.timestamp()